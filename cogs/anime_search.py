@@ -1,30 +1,88 @@
 """Cog that lets users search for video examples from an anime database (for language learning)."""
 import asyncio
+import hashlib
 import json
 import os
 import pkgutil
 import random
 import re
 import shutil
-import subprocess
 import tempfile
+import time
+from bisect import bisect_left
+from collections import OrderedDict
 
 import discord
 from discord.ext import commands
-import pysubs2
+from discord.ext import tasks
 
+from . import anime_search_engines
+from . import anime_search_rendering
+from . import anime_search_subtitles
 from . import data_management
 
+
+def load_setting(file_name: str, default: str):
+    """Read an optional setting from the config folder."""
+    try:
+        return pkgutil.get_data(__package__, f"config/{file_name}").decode().strip()
+    except FileNotFoundError:
+        return default
+
+
 # Ensure folder existence and load config
 DATABASE_BUCKET = pkgutil.get_data(__package__, "config/database_bucket.txt").decode()
-LOCAL_DATABASE_PATH = 'data/anime_search_database'
+SEARCH_ENGINE_NAME = load_setting("anime_search_engine.txt", anime_search_engines.GroongaSearchEngine.name)
+LOCAL_DATABASE_PATH = anime_search_engines.LOCAL_DATABASE_PATH
 REMOTE_DATABASE_PATH = "database/"
+REMOTE_SUBTITLE_PATH = "9_finished_subs/"
+DATABASE_VERSIONS_PATH = 'data/anime_search_database_versions'
+DATABASE_MANIFEST_NAME = "manifest.json"
+DATABASE_SYNC_CONCURRENCY = 4
+ANIME_CATALOG_NAME = "anime_names.json"
+LEGACY_ANIME_CATALOG_PATH = "data/database/anime_names.json"
+ANIME_LIST_PAGE_CHARACTERS = 4000
 SEARCH_RESULT_PATH = 'data/search_result'
+SEARCH_RESULT_QUOTA_BYTES = int(load_setting("anime_search_result_quota_bytes.txt", str(10 * 1024 ** 3)))
+# Result views time out after a few minutes, folders older than this are leftovers.
+SEARCH_RESULT_MAX_AGE_SECONDS = 3600
+# Folders younger than this may still be in use by a running request and are never evicted.
+SEARCH_RESULT_MIN_EVICTION_AGE_SECONDS = 300
+DOWNLOAD_CACHE_PATH = 'data/anime_search_cache'
+DOWNLOAD_CACHE_MAX_BYTES = int(load_setting("anime_search_cache_bytes.txt", str(20 * 1024 ** 3)))
+DOWNLOAD_CACHE_REVALIDATE_SECONDS = 24 * 3600
+CLIP_CACHE_PATH = 'data/anime_search_clips'
+CLIP_CACHE_MAX_BYTES = int(load_setting("anime_search_clip_cache_bytes.txt", str(2 * 1024 ** 3)))
+# Part of the clip cache key, change it whenever the trim command or its options change.
+CLIP_ENCODER_SETTINGS = "ffmpeg_smart_trim"
+# Discord attachment URLs are signed and expire, so they are only reused for a while.
+ATTACHMENT_URL_TTL_SECONDS = 12 * 3600
+ENCODE_WORKER_COUNT = int(load_setting("anime_search_encode_workers.txt", "2"))
+# "full" downloads whole episodes, "range" reads only the byte ranges of the clip from S3.
+VIDEO_FETCH_MODE = load_setting("anime_search_fetch_mode.txt", "full")
+PREFETCH_ENABLED = load_setting("anime_search_prefetch.txt", "off") == "on"
+PREFETCH_DOWNLOADS_PER_GUILD = 2
+SEARCH_CACHE_SIZE = 512
+RESULTS_PER_PAGE = 5
+# Each search picks one of a few fixed orderings so that repeated searches can share cached pages.
+# Every seed is its own ordering. A fixed set lets users searching the same text share cached pages.
+SEARCH_ORDERING_SEED_COUNT = 256
+SEARCH_ORDERING_SEEDS = [random.Random(index).randrange(anime_search_engines.SEED_LIMIT)
+                         for index in range(SEARCH_ORDERING_SEED_COUNT)]
+SEARCH_CACHE_TTL_SECONDS = 3600
 
 if not os.path.exists(LOCAL_DATABASE_PATH):
     os.mkdir(LOCAL_DATABASE_PATH)
+if not os.path.exists(DATABASE_VERSIONS_PATH):
+    os.mkdir(DATABASE_VERSIONS_PATH)
 if not os.path.exists(SEARCH_RESULT_PATH):
     os.mkdir(SEARCH_RESULT_PATH)
+if not os.path.exists(DOWNLOAD_CACHE_PATH):
+    os.mkdir(DOWNLOAD_CACHE_PATH)
+if not os.path.exists(CLIP_CACHE_PATH):
+    os.mkdir(CLIP_CACHE_PATH)
+if not os.path.exists(anime_search_subtitles.SUBTITLE_INDEX_PATH):
+    os.mkdir(anime_search_subtitles.SUBTITLE_INDEX_PATH)
 
 
 ##############################################
@@ -33,10 +91,9 @@ if not os.path.exists(SEARCH_RESULT_PATH):
 class SelectResultButton(discord.ui.Button):
     """Button that lets users select a search result. If a result is chosen a video will be encoded and sent."""
 
-    def __init__(self, result_index: int, search_results: list, interaction_user: discord.User,
-                 current_offset: int):
+    def __init__(self, result_index: int, selected_result: dict, interaction_user: discord.User):
         super().__init__(label=str(result_index + 1), style=discord.ButtonStyle.primary, row=0)
-        self.selected_result = search_results[current_offset + result_index]
+        self.selected_result = selected_result
         self.check_user_id = interaction_user.id
 
     async def callback(self, interaction: discord.Interaction):
@@ -45,29 +102,44 @@ class SelectResultButton(discord.ui.Button):
             return
 
         await interaction.response.send_message("Generating clip...", ephemeral=True)
-        cut_file_name, text_summary, random_folder, video_file, subtitle_file = await generate_clip(
-            self.selected_result)
+
+        async def report_progress(progress_text):
+            await interaction.edit_original_response(content=progress_text)
+
+        clip_task = asyncio.ensure_future(generate_clip(self.selected_result, interaction.user.id, report_progress))
+        self.view.pending_tasks.add(clip_task)
+        try:
+            cut_file_name, text_summary, random_folder, video_file, subtitle_file, clip_key = await clip_task
+        except asyncio.CancelledError:
+            await interaction.edit_original_response(content="Selection timed out before the clip was finished.")
+            return
+        finally:
+            self.view.pending_tasks.discard(clip_task)
         text_embed = discord.Embed(title=f"{interaction.user} requested from {self.selected_result['anime_name']}:",
                                    description=f"`{text_summary}`")
 
         full_context_view = await create_full_context_view(random_folder, video_file, subtitle_file, interaction)
         await interaction.edit_original_response(content="Finished creating clip.")
-        await interaction.message.reply(embed=text_embed,
-                                        file=discord.File(f"{random_folder}/{cut_file_name}"),
-                                        view=full_context_view)
+        attachment_url = clip_cache.attachment_url(clip_key)
+        if attachment_url:
+            await interaction.message.reply(attachment_url, embed=text_embed, view=full_context_view)
+        else:
+            clip_message = await interaction.message.reply(embed=text_embed,
+                                                           file=discord.File(f"{random_folder}/{cut_file_name}"),
+                                                           view=full_context_view)
+            if clip_message.attachments:
+                clip_cache.store_attachment_url(clip_key, clip_message.attachments[0].url)
 
 
 class ShiftResultsButton(discord.ui.Button):
     """Button that shifts result left or right."""
 
-    def __init__(self, label: str, current_offset: int, interaction_user: discord.User,
-                 searched_text: str, search_results: list):
+    def __init__(self, label: str, current_offset: int, interaction_user: discord.User, search_query):
         super().__init__(label=label, style=discord.ButtonStyle.secondary, row=1)
         self.current_offset = current_offset
         self.check_user_id = interaction_user.id
         self.label = label
-        self.searched_text = searched_text
-        self.search_results = search_results
+        self.search_query = search_query
 
     async def callback(self, interaction: discord.Interaction):
         if interaction.user.id != self.check_user_id:
@@ -76,15 +148,20 @@ class ShiftResultsButton(discord.ui.Button):
 
         await interaction.response.defer()
         if self.label == "<":
-            new_offset = self.current_offset - 5
+            new_offset = self.current_offset - RESULTS_PER_PAGE
         else:
-            new_offset = self.current_offset + 5
+            new_offset = self.current_offset + RESULTS_PER_PAGE
         if new_offset <= 0:
             new_offset = 0
+        if new_offset >= self.search_query.hit_count:
+            new_offset = self.current_offset
 
-        result_embed = await create_result_embed(self.search_results, self.searched_text, new_offset)
+        for prefetch_task in self.view.prefetch_tasks:
+            prefetch_task.cancel()
+        page_results = await self.search_query.fetch_page(new_offset)
+        result_embed = await create_result_embed(self.search_query, page_results, new_offset)
         interaction_message = await interaction.original_response()
-        result_view = await create_result_view(self.search_results, interaction.user, new_offset, self.searched_text,
+        result_view = await create_result_view(self.search_query, page_results, interaction.user, new_offset,
                                                interaction_message)
 
         await interaction.edit_original_response(embed=result_embed, view=result_view)
@@ -106,17 +183,34 @@ class FullContextButton(discord.ui.Button):
             return
 
         await interaction.response.send_message("Fetching full context...", ephemeral=True)
-        subtitle = pysubs2.load(f"{self.random_folder}/{self.subtitle_file}")
-        full_text = "\n".join([line.text for line in subtitle])
+        subtitle_index = await load_subtitle_index(self.subtitle_file)
+        full_text = subtitle_index.full_text()
+        if not os.path.exists(f"{self.random_folder}/{self.video_file}"):
+            await fetch_to_folder(f"8_finished_clips/{self.video_file}", f"{self.random_folder}/{self.video_file}")
         full_context_embed = discord.Embed(title=f"Full context requested by {self.interaction_user}",
                                            description=f'```{full_text[0:4000]}```')
         await interaction.message.reply(embed=full_context_embed,
                                         file=discord.File(f"{self.random_folder}/{self.video_file}"))
         await interaction.message.edit(view=None)
-        try:
-            shutil.rmtree(self.random_folder)
-        except FileNotFoundError:
-            pass
+        result_folder_janitor.release_folder(self.random_folder)
+
+
+class AnimeListPageButton(discord.ui.Button):
+    """Button that flips through the pages of the anime list."""
+
+    def __init__(self, label: str, page_index: int, interaction_user: discord.User):
+        super().__init__(label=label, style=discord.ButtonStyle.secondary)
+        self.page_index = page_index
+        self.check_user_id = interaction_user.id
+
+    async def callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.check_user_id:
+            await interaction.response.send_message("This button is not for you :).", ephemeral=True)
+            return
+
+        anime_list_embed = create_anime_list_embed(self.page_index)
+        anime_list_view = create_anime_list_view(self.page_index, interaction.user, interaction.message)
+        await interaction.response.edit_message(embed=anime_list_embed, view=anime_list_view)
 
 
 ##############################################
@@ -128,31 +222,51 @@ class SelfClearingView(discord.ui.View):
         super().__init__()
         self.interaction_message = interaction_message
         self.folder_to_clear = folder_to_clear
+        self.pending_tasks = set()
+        self.prefetch_tasks = set()
 
     async def on_timeout(self):
+        for pending_task in self.pending_tasks | self.prefetch_tasks:
+            pending_task.cancel()
         self.clear_items()
         await self.interaction_message.edit(content="Selection timed out.", view=self)
         if self.folder_to_clear:
-            try:
-                shutil.rmtree(self.folder_to_clear)
-            except FileNotFoundError:
-                pass
+            result_folder_janitor.release_folder(self.folder_to_clear)
 
 
 ##############################################
 
-async def create_result_view(search_results, interaction_user, current_offset, searched_text, interaction_message):
+async def create_result_view(search_query, page_results, interaction_user, current_offset, interaction_message):
     choice_menu = SelfClearingView(interaction_message)
-    for index, result in enumerate(search_results[current_offset:current_offset + 5]):
-        select_button = SelectResultButton(index, search_results, interaction_user, current_offset)
+    if PREFETCH_ENABLED and interaction_message.guild:
+        choice_menu.prefetch_tasks.add(result_prefetcher.prefetch_page(interaction_message.guild.id, page_results))
+    for index, result in enumerate(page_results):
+        select_button = SelectResultButton(index, result, interaction_user)
         choice_menu.add_item(select_button)
-    cycle_left_button = ShiftResultsButton("<", current_offset, interaction_user, searched_text, search_results)
-    cycle_right_button = ShiftResultsButton(">", current_offset, interaction_user, searched_text, search_results)
+    cycle_left_button = ShiftResultsButton("<", current_offset, interaction_user, search_query)
+    cycle_right_button = ShiftResultsButton(">", current_offset, interaction_user, search_query)
     choice_menu.add_item(cycle_left_button)
     choice_menu.add_item(cycle_right_button)
     return choice_menu
 
 
+def create_anime_list_view(page_index: int, interaction_user, interaction_message):
+    anime_list_view = SelfClearingView(interaction_message)
+    page_count = anime_catalog.page_count()
+    if page_index > 0:
+        anime_list_view.add_item(AnimeListPageButton("<", page_index - 1, interaction_user))
+    if page_index < page_count - 1:
+        anime_list_view.add_item(AnimeListPageButton(">", page_index + 1, interaction_user))
+    return anime_list_view
+
+
+def create_anime_list_embed(page_index: int):
+    page_count = anime_catalog.page_count()
+    anime_list_embed = discord.Embed(title="Anime in database", description="\n".join(anime_catalog.page(page_index)))
+    anime_list_embed.set_footer(text=f"Page {page_index + 1}/{page_count} | {len(anime_catalog.names)} anime")
+    return anime_list_embed
+
+
 async def create_full_context_view(random_folder, video_file, subtitle_file, interaction: discord.Interaction):
     full_context_menu = SelfClearingView(interaction.message, random_folder)
     full_context_button = FullContextButton(interaction.user, random_folder, video_file, subtitle_file)
@@ -160,123 +274,800 @@ async def create_full_context_view(random_folder, video_file, subtitle_file, int
     return full_context_menu
 
 
-async def create_result_embed(search_results, text_to_search, offset=0):
+async def create_result_embed(search_query, page_results, offset=0):
+    text_to_search = search_query.searched_text
+    if search_query.anime_name:
+        text_to_search = f"{text_to_search}' in '{search_query.anime_name}"
     if not offset:
         result_embed = discord.Embed(title=f"Search result for '{text_to_search}'", colour=discord.Colour.gold())
     else:
         result_embed = discord.Embed(title=f"Search result for '{text_to_search}' [Offset: {offset}]",
                                      colour=discord.Colour.gold())
-    for index, result in enumerate(search_results[offset:offset + 5]):
+    for index, result in enumerate(page_results):
         result_embed.add_field(name=f"Result from {result['anime_name']}",
                                value=f"**{index + 1}.** `{result['text']}`", inline=False)
+    result_embed.set_footer(text=f"{search_query.hit_count} results")
     return result_embed
 
 
-async def cut_clip(start_time, end_time, video_file_name, folder_name):
+class S3FileCache:
+    """Disk cache for S3 objects, content addressed by key and ETag, with a total size limit and LRU eviction.
+
+    Entries validated within the revalidation window are served without contacting S3. Concurrent requests for the
+    same object share one download."""
+
+    def __init__(self, cache_folder: str, max_bytes: int, bucket: str):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.bucket = bucket
+        self.entries = OrderedDict()
+        self.in_flight = dict()
+        self.object_etags = dict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.load_existing_entries()
+
+    @staticmethod
+    def key_hash(remote_path: str):
+        return hashlib.sha1(remote_path.encode()).hexdigest()
+
+    def load_existing_entries(self):
+        cached_files = []
+        for file_name in os.listdir(self.cache_folder):
+            file_path = f"{self.cache_folder}/{file_name}"
+            if file_name.endswith(".part"):
+                os.remove(file_path)
+                continue
+            key_hash, _, etag_and_extension = file_name.partition("_")
+            etag = os.path.splitext(etag_and_extension)[0]
+            cached_files.append((os.path.getmtime(file_path), key_hash, etag, file_path))
+
+        for validated_at, key_hash, etag, file_path in sorted(cached_files):
+            size = os.path.getsize(file_path)
+            self.entries[key_hash] = [etag, file_path, size, validated_at]
+            self.total_bytes += size
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key_hash, (etag, file_path, size, validated_at) = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    async def fetch(self, remote_path: str):
+        """Return the local path of a cached copy of the S3 object, downloading it if needed."""
+        key_hash = self.key_hash(remote_path)
+        entry = self.entries.get(key_hash)
+        if entry and time.time() - entry[3] < DOWNLOAD_CACHE_REVALIDATE_SECONDS and os.path.exists(entry[1]):
+            self.entries.move_to_end(key_hash)
+            self.hits += 1
+            return entry[1]
+
+        refresh_task = self.in_flight.get(key_hash)
+        if refresh_task is None:
+            refresh_task = asyncio.create_task(self.refresh(remote_path, key_hash))
+            self.in_flight[key_hash] = refresh_task
+            # Forgotten as soon as it finishes, even if every waiter was cancelled before.
+            refresh_task.add_done_callback(lambda finished_task: self.forget_in_flight(key_hash, finished_task))
+        return await asyncio.shield(refresh_task)
+
+    def forget_in_flight(self, key_hash: str, finished_task: asyncio.Task):
+        if self.in_flight.get(key_hash) is finished_task:
+            del self.in_flight[key_hash]
+
+    async def refresh(self, remote_path: str, key_hash: str):
+        object_metadata = await data_management.head_from_s3(remote_path, bucket=self.bucket)
+        etag = object_metadata["ETag"].strip('"')
+        entry = self.entries.get(key_hash)
+        if entry and entry[0] == etag and os.path.exists(entry[1]):
+            entry[3] = time.time()
+            os.utime(entry[1])
+            self.entries.move_to_end(key_hash)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        file_path = f"{self.cache_folder}/{key_hash}_{etag}{os.path.splitext(remote_path)[1]}"
+        await data_management.download_from_s3(f"{file_path}.part", remote_path, bucket=self.bucket)
+        os.replace(f"{file_path}.part", file_path)
+
+        if entry:
+            self.total_bytes -= entry[2]
+            if entry[1] != file_path and os.path.exists(entry[1]):
+                os.remove(entry[1])
+        size = os.path.getsize(file_path)
+        self.entries[key_hash] = [etag, file_path, size, time.time()]
+        self.entries.move_to_end(key_hash)
+        self.total_bytes += size
+        self.evict()
+        return file_path
+
+    async def etag(self, remote_path: str):
+        """Current ETag of an S3 object without downloading it, revalidated as often as the cached files."""
+        key_hash = self.key_hash(remote_path)
+        entry = self.entries.get(key_hash)
+        if entry and time.time() - entry[3] < DOWNLOAD_CACHE_REVALIDATE_SECONDS:
+            return entry[0]
+        etag, validated_at = self.object_etags.get(key_hash, (None, 0))
+        if etag and time.time() - validated_at < DOWNLOAD_CACHE_REVALIDATE_SECONDS:
+            return etag
+        object_metadata = await data_management.head_from_s3(remote_path, bucket=self.bucket)
+        etag = object_metadata["ETag"].strip('"')
+        self.object_etags[key_hash] = (etag, time.time())
+        return etag
+
+    def stats_string(self):
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups if lookups else 0.0
+        return f"{len(self.entries)} files, {self.total_bytes / 1024 ** 3:.2f}/{self.max_bytes / 1024 ** 3:.2f}GiB, " \
+               f"{self.hits} hits, {self.misses} misses ({hit_ratio:.1%} hit ratio)"
+
+
+download_cache = S3FileCache(DOWNLOAD_CACHE_PATH, DOWNLOAD_CACHE_MAX_BYTES, DATABASE_BUCKET)
+
+
+class RenderedClipCache:
+    """Size bounded LRU cache of trimmed clips keyed by video and its ETag, start, end and encoder settings.
+
+    Also remembers the Discord attachment URL of a clip once it has been uploaded."""
+
+    def __init__(self, cache_folder: str, max_bytes: int):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.attachment_urls = dict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        cached_files = [f"{cache_folder}/{file_name}" for file_name in os.listdir(cache_folder)
+                        if not file_name.endswith(".part")]
+        for file_path in sorted(cached_files, key=os.path.getmtime):
+            clip_key = os.path.splitext(os.path.basename(file_path))[0]
+            self.entries[clip_key] = (file_path, os.path.getsize(file_path))
+            self.total_bytes += self.entries[clip_key][1]
+
+    @staticmethod
+    def key(video_file: str, video_etag: str, start_time: int, end_time: int):
+        key_string = f"{video_file}\0{video_etag}\0{start_time}\0{end_time}\0{CLIP_ENCODER_SETTINGS}"
+        return hashlib.sha1(key_string.encode()).hexdigest()
+
+    def get(self, clip_key: str):
+        entry = self.entries.get(clip_key)
+        if not entry or not os.path.exists(entry[0]):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(clip_key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, clip_key: str, clip_path: str, extension: str):
+        file_path = f"{self.cache_folder}/{clip_key}{extension}"
+        link_or_copy(clip_path, f"{file_path}.part")
+        os.replace(f"{file_path}.part", file_path)
+        old_entry = self.entries.pop(clip_key, None)
+        if old_entry:
+            self.total_bytes -= old_entry[1]
+        self.entries[clip_key] = (file_path, os.path.getsize(file_path))
+        self.total_bytes += self.entries[clip_key][1]
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            evicted_key, (evicted_path, evicted_size) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+            self.attachment_urls.pop(evicted_key, None)
+            try:
+                os.remove(evicted_path)
+            except FileNotFoundError:
+                pass
+
+    def attachment_url(self, clip_key: str):
+        url, stored_at = self.attachment_urls.get(clip_key, (None, 0))
+        if url and time.time() - stored_at < ATTACHMENT_URL_TTL_SECONDS:
+            return url
+        return None
+
+    def store_attachment_url(self, clip_key: str, url: str):
+        self.attachment_urls[clip_key] = (url, time.time())
+
+    def stats_string(self):
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups if lookups else 0.0
+        return f"{len(self.entries)} clips, {self.total_bytes / 1024 ** 2:.1f}/{self.max_bytes / 1024 ** 2:.1f}MiB, " \
+               f"{len(self.attachment_urls)} attachment URLs, {self.hits} hits, {self.misses} misses " \
+               f"({hit_ratio:.1%} hit ratio)"
+
+
+def link_or_copy(source_path: str, target_path: str):
+    """Hard link a cached file into a result folder so that cache eviction cannot remove it while in use."""
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+
+
+clip_cache = RenderedClipCache(CLIP_CACHE_PATH, CLIP_CACHE_MAX_BYTES)
+
+
+async def fetch_to_folder(remote_path: str, target_path: str):
+    cached_path = await download_cache.fetch(remote_path)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, link_or_copy, cached_path, target_path)
+
+
+class ResultFolderJanitor:
+    """Owns the per-request folders in SEARCH_RESULT_PATH.
+
+    Removes folders left behind by crashes or restarts and keeps the total size under a quota by evicting the
+    oldest folders first."""
+
+    def __init__(self, result_folder: str, quota_bytes: int):
+        self.result_folder = result_folder
+        self.quota_bytes = quota_bytes
+        self.folder_owners = dict()
+        self.total_bytes = 0
+        self.removed_folders = 0
+        self.evicted_folders = 0
+
+    def create_folder(self, owner_id: int):
+        folder_path = tempfile.mkdtemp(dir=self.result_folder)
+        self.folder_owners[folder_path] = owner_id
+        return folder_path
+
+    def release_folder(self, folder_path: str):
+        self.folder_owners.pop(folder_path, None)
+        shutil.rmtree(folder_path, ignore_errors=True)
+
+    @staticmethod
+    def folder_size(folder_path: str):
+        size = 0
+        for root, _, file_names in os.walk(folder_path):
+            for file_name in file_names:
+                try:
+                    size += os.path.getsize(f"{root}/{file_name}")
+                except FileNotFoundError:
+                    pass
+        return size
+
+    def sweep(self, remove_untracked=False):
+        """Remove expired and, if requested, untracked folders, then evict the oldest folders over the quota."""
+        now = time.time()
+        folders = []
+        for folder_name in os.listdir(self.result_folder):
+            folder_path = f"{self.result_folder}/{folder_name}"
+            try:
+                age = now - os.path.getmtime(folder_path)
+            except FileNotFoundError:
+                continue
+            untracked = folder_path not in self.folder_owners
+            if age > SEARCH_RESULT_MAX_AGE_SECONDS or \
+                    (remove_untracked and untracked and age > SEARCH_RESULT_MIN_EVICTION_AGE_SECONDS):
+                print(f"Removing {'orphaned' if untracked else 'expired'} search result folder {folder_path}")
+                self.release_folder(folder_path)
+                self.removed_folders += 1
+                continue
+            folders.append((age, folder_path, self.folder_size(folder_path)))
+
+        self.total_bytes = sum(size for _, _, size in folders)
+        for age, folder_path, size in sorted(folders, reverse=True):
+            if self.total_bytes <= self.quota_bytes:
+                break
+            if age < SEARCH_RESULT_MIN_EVICTION_AGE_SECONDS:
+                continue
+            print(f"Evicting search result folder {folder_path} of user {self.folder_owners.get(folder_path)} "
+                  f"to stay within the disk quota")
+            self.release_folder(folder_path)
+            self.total_bytes -= size
+            self.evicted_folders += 1
+
+    def stats_string(self):
+        return f"{len(self.folder_owners)} folders, {self.total_bytes / 1024 ** 3:.2f}/" \
+               f"{self.quota_bytes / 1024 ** 3:.2f}GiB at last sweep, {self.removed_folders} expired or orphaned " \
+               f"folders removed, {self.evicted_folders} evicted over quota"
+
+
+result_folder_janitor = ResultFolderJanitor(SEARCH_RESULT_PATH, SEARCH_RESULT_QUOTA_BYTES)
+clip_render_service = anime_search_rendering.ClipRenderService(ENCODE_WORKER_COUNT)
+
+
+async def cut_clip(start_time, end_time, video_file_name, folder_name, user_id=0, progress_callback=None):
     start_time = str(start_time / 1000.0)
     end_time = str(end_time / 1000.0)
+    trim_arguments = [f"{folder_name}/{video_file_name}",
+                      "--start_time",
+                      start_time,
+                      "--end_time",
+                      end_time,
+                      "--output",
+                      f"{folder_name}/trimmed_{video_file_name}"]
+
+    await clip_render_service.render(user_id, trim_arguments, progress_callback)
+    return f"trimmed_{video_file_name}"
 
-    def cut_video():
-        cut_command = ["python3",
-                       "-m",
-                       "ffmpeg_smart_trim.trim",
-                       f"{folder_name}/{video_file_name}",
-                       "--start_time",
-                       start_time,
-                       "--end_time",
-                       end_time,
-                       "--output",
-                       f"{folder_name}/trimmed_{video_file_name}"]
-
-        encode_job = subprocess.Popen(cut_command)
-        encode_job.wait()
-        return True
 
+async def fetch_video_segment(video_file: str, start_time: int, end_time: int, segment_path: str):
+    """Copy the part of an episode around [start_time, end_time] from S3 with range requests.
+
+    Returns the segment start in milliseconds, which is the keyframe at or before start_time."""
+    video_url = await data_management.generate_presigned_url_s3(f"8_finished_clips/{video_file}",
+                                                                 bucket=DATABASE_BUCKET)
     loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, cut_video)
-    return f"trimmed_{video_file_name}"
+    return await loop.run_in_executor(None, anime_search_rendering.fetch_segment, video_url, start_time, end_time,
+                                      segment_path)
+
+
+subtitle_etags = dict()
+
+
+def load_subtitle_etags():
+    subtitle_etags.clear()
+    subtitle_etags.update(anime_search_subtitles.read_subtitle_manifest(LOCAL_DATABASE_PATH))
+
+
+async def load_subtitle_index(subtitle_file: str):
+    """Load the index of a subtitle file that sync_database built, without downloading the subtitle.
+
+    Subtitles uploaded after the last sync have no ETag in the manifest yet, they are looked up on S3 and indexed
+    once on first use."""
+    remote_path = f"{REMOTE_SUBTITLE_PATH}{subtitle_file}"
+    etag = subtitle_etags.get(subtitle_file)
+    if etag is None:
+        object_metadata = await data_management.head_from_s3(remote_path, bucket=DATABASE_BUCKET)
+        etag = object_metadata["ETag"].strip('"')
+    index_path = anime_search_subtitles.index_path_for(subtitle_file, etag)
+    loop = asyncio.get_running_loop()
+    if not os.path.exists(index_path):
+        subtitle_path = await download_cache.fetch(remote_path)
+        await loop.run_in_executor(None, anime_search_subtitles.build_subtitle_index, subtitle_path, index_path)
+    return await loop.run_in_executor(None, anime_search_subtitles.load_subtitle_index, index_path)
+
+
+class ResultPrefetcher:
+    """Warms the download cache and subtitle indexes for the results a user is looking at.
 
+    Each guild may only run a few prefetch downloads at once. A slot stays taken until its download finishes, so
+    cancelling a prefetch with its view stops further downloads without freeing slots for more of them."""
 
-async def generate_clip(result):
+    def __init__(self, downloads_per_guild: int):
+        self.downloads_per_guild = downloads_per_guild
+        self.guild_budgets = dict()
+        self.prefetched_results = 0
+        self.cancelled_pages = 0
+
+    def prefetch_page(self, guild_id: int, page_results: list):
+        return asyncio.create_task(self.prefetch(guild_id, page_results))
+
+    async def prefetch(self, guild_id: int, page_results: list):
+        guild_budget = self.guild_budgets.setdefault(guild_id, asyncio.Semaphore(self.downloads_per_guild))
+        try:
+            for result in page_results:
+                await guild_budget.acquire()
+                result_download = asyncio.create_task(self.prefetch_result(result))
+                result_download.add_done_callback(lambda finished_download: guild_budget.release())
+                # The S3 downloads are shared with other requests and keep running when the page is cancelled.
+                await asyncio.shield(result_download)
+        except asyncio.CancelledError:
+            self.cancelled_pages += 1
+            raise
+
+    async def prefetch_result(self, result):
+        try:
+            await load_subtitle_index(result["subtitle_file"])
+            if VIDEO_FETCH_MODE != "range":
+                await download_cache.fetch(f"8_finished_clips/{result['video_file']}")
+        except Exception as error:
+            print(f"Prefetching search results failed: {error}")
+            return
+        self.prefetched_results += 1
+
+    def stats_string(self):
+        return f"{'enabled' if PREFETCH_ENABLED else 'disabled'}, {self.prefetched_results} results prefetched, " \
+               f"{self.cancelled_pages} pages cancelled"
+
+
+result_prefetcher = ResultPrefetcher(PREFETCH_DOWNLOADS_PER_GUILD)
+
+
+async def generate_clip(result, user_id=0, progress_callback=None):
+    random_folder = result_folder_janitor.create_folder(user_id)
+    try:
+        return await generate_clip_in_folder(result, random_folder, user_id, progress_callback)
+    except asyncio.CancelledError:
+        result_folder_janitor.release_folder(random_folder)
+        raise
+
+
+async def generate_clip_in_folder(result, random_folder, user_id, progress_callback):
     video_file = result["video_file"]
     subtitle_file = result["subtitle_file"]
-    random_folder = tempfile.mkdtemp(dir=SEARCH_RESULT_PATH)
-    await data_management.download_from_s3(f"{random_folder}/{video_file}", f"8_finished_clips/{video_file}",
-                                           bucket=DATABASE_BUCKET)
-    await data_management.download_from_s3(f"{random_folder}/{subtitle_file}", f"9_finished_subs/{subtitle_file}",
-                                           bucket=DATABASE_BUCKET)
-
-    subtitle = pysubs2.load(f"{random_folder}/{subtitle_file}")
-    start_time = result["start_time"]
-    relevant_sub = next((line for line in subtitle if line.start == start_time), None)
-    if not subtitle.index(relevant_sub) == 0:
-        previous_sub = subtitle[subtitle.index(relevant_sub) - 1]
-    else:
-        previous_sub = None
-    if not subtitle[-1] == relevant_sub:
-        next_sub = subtitle[subtitle.index(relevant_sub) + 1]
-    else:
-        next_sub = None
+    subtitle_index = await load_subtitle_index(subtitle_file)
+
+    previous_sub, relevant_sub, next_sub = subtitle_index.neighbours(result["start_time"])
+    if not relevant_sub:
+        relevant_sub = (result["start_time"], result["end_time"], result["text"])
 
     texts = []
 
     if previous_sub:
-        texts.append(previous_sub.text)
-        start_time = previous_sub.start - 1000
+        texts.append(previous_sub[2])
+        start_time = previous_sub[0] - 1000
     else:
-        start_time = relevant_sub.start - 1000
+        start_time = relevant_sub[0] - 1000
 
-    texts.append(relevant_sub.text)
+    texts.append(relevant_sub[2])
 
     if next_sub:
-        texts.append(next_sub.text)
-        end_time = next_sub.end + 500
+        texts.append(next_sub[2])
+        end_time = next_sub[1] + 500
     else:
-        end_time = relevant_sub.end + 500
+        end_time = relevant_sub[1] + 500
 
     if start_time < 0:
         start_time = 0
 
-    cut_file_name = await cut_clip(start_time, end_time, video_file, random_folder)
+    # A re-uploaded episode gets a new ETag, so clips cut from the old file are not served anymore.
+    video_etag = await download_cache.etag(f"8_finished_clips/{video_file}")
+    clip_key = clip_cache.key(video_file, video_etag, start_time, end_time)
+    cached_clip_path = clip_cache.get(clip_key)
+    loop = asyncio.get_running_loop()
+    if cached_clip_path:
+        cut_file_name = f"trimmed_{video_file}"
+        await loop.run_in_executor(None, link_or_copy, cached_clip_path, f"{random_folder}/{cut_file_name}")
+    elif VIDEO_FETCH_MODE == "range":
+        segment_file = f"segment_{video_file}"
+        segment_start = await fetch_video_segment(video_file, start_time, end_time, f"{random_folder}/{segment_file}")
+        cut_file_name = await cut_clip(start_time - segment_start, end_time - segment_start, segment_file,
+                                       random_folder, user_id, progress_callback)
+        clip_cache.put(clip_key, f"{random_folder}/{cut_file_name}", os.path.splitext(video_file)[1])
+    else:
+        # Only fetched on a clip cache miss. Buttons that need the full episode fetch it themselves if missing.
+        await fetch_to_folder(f"8_finished_clips/{video_file}", f"{random_folder}/{video_file}")
+        cut_file_name = await cut_clip(start_time, end_time, video_file, random_folder, user_id, progress_callback)
+        clip_cache.put(clip_key, f"{random_folder}/{cut_file_name}", os.path.splitext(video_file)[1])
+
     text_summary = '\n'.join(texts)
-    return cut_file_name, text_summary, random_folder, video_file, subtitle_file
+    return cut_file_name, text_summary, random_folder, video_file, subtitle_file, clip_key
+
+
+class SearchResultCache:
+    """LRU cache for parsed search results. Entries expire after the TTL and the cache keeps hit statistics."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            stored_at, value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats_string(self):
+        return f"{len(self.entries)}/{self.max_entries} entries, {self.hits} hits, {self.misses} misses " \
+               f"({self.hit_ratio():.1%} hit ratio)"
+
+
+search_engine = anime_search_engines.create_search_engine(SEARCH_ENGINE_NAME)
+search_result_cache = SearchResultCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL_SECONDS)
+
 
+def normalize_search_text(text_to_search: str):
+    text_to_search = re.sub(r"\s", "", text_to_search.lower().strip())
+    return re.sub(r"[a-zA-Z]", "", text_to_search)
 
-async def perform_search_query(searched_text: str):
-    search_command = ["groonga", f"{LOCAL_DATABASE_PATH}/JPSUBS.db",
-                      f"select --table MainSubs --limit 100 --query text:@{searched_text}"]
 
-    def run_search():
-        search = subprocess.run(search_command, capture_output=True)
-        return search
+async def perform_search_query(searched_text: str, offset: int, seed: int, anime_name=None):
+    """Fetch one page of results and the total hit count for a query in the ordering given by the seed."""
+    cache_key = (searched_text, anime_name, seed, offset)
+    cached_page = search_result_cache.get(cache_key)
+    if cached_page is None:
+        loop = asyncio.get_running_loop()
+        hit_count, page_results = await loop.run_in_executor(None, search_engine.search, searched_text, offset,
+                                                             RESULTS_PER_PAGE, seed, anime_name)
+        cached_page = (hit_count, tuple(page_results))
+        search_result_cache.put(cache_key, cached_page)
 
+    hit_count, page_results = cached_page
+    return hit_count, list(page_results)
+
+
+class SearchQuery:
+    """Handle to a search that views keep instead of the results. Pages are fetched from the engine on demand."""
+
+    def __init__(self, searched_text: str, seed: int, anime_name=None):
+        self.searched_text = searched_text
+        self.seed = seed
+        self.anime_name = anime_name
+        self.hit_count = 0
+
+    async def fetch_page(self, offset: int):
+        self.hit_count, page_results = await perform_search_query(self.searched_text, offset, self.seed,
+                                                                  self.anime_name)
+        return page_results
+
+
+class AnimeCatalog:
+    """Names of all anime in the database, kept in memory with indexes for autocomplete.
+
+    Prefix matches use binary search over the sorted lowercase names. Substring matches intersect the sets of
+    names containing each character bigram of the input and check the few remaining candidates directly."""
+
+    def __init__(self):
+        self.names = []
+        self.name_set = set()
+        self.sorted_keys = []
+        self.bigram_index = dict()
+        self.pages = [[]]
+
+    @staticmethod
+    def catalog_path():
+        database_catalog_path = f"{LOCAL_DATABASE_PATH}/{ANIME_CATALOG_NAME}"
+        if os.path.exists(database_catalog_path):
+            return database_catalog_path
+        return LEGACY_ANIME_CATALOG_PATH
+
+    def load(self):
+        try:
+            with open(self.catalog_path()) as json_file:
+                anime_data = json.load(json_file)
+        except FileNotFoundError:
+            anime_data = dict()
+
+        names = sorted(set(anime_data.values()), key=str.lower)
+        sorted_keys = [(name.lower(), name_index) for name_index, name in enumerate(names)]
+        bigram_index = dict()
+        for name_index, name in enumerate(names):
+            lowered_name = name.lower()
+            for position in range(len(lowered_name) - 1):
+                bigram_index.setdefault(lowered_name[position:position + 2], set()).add(name_index)
+
+        pages = [[]]
+        page_length = 0
+        for name in names:
+            if page_length + len(name) + 1 > ANIME_LIST_PAGE_CHARACTERS and pages[-1]:
+                pages.append([])
+                page_length = 0
+            pages[-1].append(name)
+            page_length += len(name) + 1
+
+        self.names, self.name_set, self.sorted_keys, self.bigram_index, self.pages = \
+            names, set(names), sorted_keys, bigram_index, pages
+        return len(names)
+
+    def __contains__(self, anime_name: str):
+        return anime_name in self.name_set
+
+    def page_count(self):
+        return len(self.pages)
+
+    def page(self, page_index: int):
+        return self.pages[min(max(page_index, 0), len(self.pages) - 1)]
+
+    def prefix_matches(self, lowered_input: str, limit: int):
+        matches = []
+        key_index = bisect_left(self.sorted_keys, (lowered_input, -1))
+        while key_index < len(self.sorted_keys) and len(matches) < limit:
+            lowered_name, name_index = self.sorted_keys[key_index]
+            if not lowered_name.startswith(lowered_input):
+                break
+            matches.append(self.names[name_index])
+            key_index += 1
+        return matches
+
+    def substring_matches(self, lowered_input: str, limit: int):
+        if len(lowered_input) < 2:
+            candidates = range(len(self.names))
+        else:
+            bigram_sets = [self.bigram_index.get(lowered_input[position:position + 2], set())
+                           for position in range(len(lowered_input) - 1)]
+            candidates = sorted(set.intersection(*sorted(bigram_sets, key=len)))
+        matches = []
+        for name_index in candidates:
+            if lowered_input in self.names[name_index].lower():
+                matches.append(self.names[name_index])
+                if len(matches) >= limit:
+                    break
+        return matches
+
+    def autocomplete(self, current_input: str, limit=25):
+        """Names starting with the input first, then names containing it."""
+        lowered_input = current_input.lower().strip()
+        if not lowered_input:
+            return self.names[:limit]
+        matches = self.prefix_matches(lowered_input, limit)
+        for name in self.substring_matches(lowered_input, limit + len(matches)):
+            if len(matches) >= limit:
+                break
+            if name not in matches:
+                matches.append(name)
+        return matches
+
+
+anime_catalog = AnimeCatalog()
+
+
+async def anime_name_autocomplete(interaction: discord.Interaction, current_input: str):
+    # Choice values are limited to 100 characters, longer names could not be matched against the catalog.
+    return [discord.app_commands.Choice(name=anime_name, value=anime_name)
+            for anime_name in anime_catalog.autocomplete(current_input) if len(anime_name) <= 100]
+
+
+database_sync_lock = asyncio.Lock()
+
+
+def read_database_manifest(database_folder: str):
+    try:
+        with open(f"{database_folder}/{DATABASE_MANIFEST_NAME}") as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return dict()
+
+
+def stage_database_version(files_to_replace: list):
+    """Create a new version folder that hard links everything from the live database except files to replace."""
+    staging_folder = tempfile.mkdtemp(dir=DATABASE_VERSIONS_PATH, prefix=time.strftime("%Y%m%d-%H%M%S-"))
+    shutil.copytree(os.path.realpath(LOCAL_DATABASE_PATH), staging_folder, copy_function=os.link,
+                    dirs_exist_ok=True)
+    for file_name in files_to_replace:
+        staged_path = f"{staging_folder}/{file_name}"
+        if os.path.lexists(staged_path):
+            os.remove(staged_path)
+    return staging_folder
+
+
+def sqlite_index_outdated(staging_folder: str, updated_files: list):
+    """Whether the staged version has a local SQLite index that does not reflect the updated groonga files."""
+    sqlite_name = anime_search_engines.SQLITE_DATABASE_NAME
+    if sqlite_name in updated_files or not os.path.exists(f"{staging_folder}/{sqlite_name}"):
+        return False
+    return any(file_name.startswith(anime_search_engines.GROONGA_DATABASE_NAME) for file_name in updated_files)
+
+
+def swap_database_version(staging_folder: str):
+    """Atomically point LOCAL_DATABASE_PATH at the staged version. Keeps the previous version for running queries."""
+    previous_folder = os.path.realpath(LOCAL_DATABASE_PATH)
+    if not os.path.islink(LOCAL_DATABASE_PATH):
+        # First sync after switching to versioned folders. Move the plain folder in with the other versions.
+        previous_folder = tempfile.mkdtemp(dir=DATABASE_VERSIONS_PATH, prefix="legacy-")
+        os.rmdir(previous_folder)
+        os.rename(LOCAL_DATABASE_PATH, previous_folder)
+
+    swap_link_path = f"{LOCAL_DATABASE_PATH}.swap"
+    if os.path.lexists(swap_link_path):
+        os.remove(swap_link_path)
+    os.symlink(os.path.relpath(staging_folder, os.path.dirname(LOCAL_DATABASE_PATH)), swap_link_path)
+    os.replace(swap_link_path, LOCAL_DATABASE_PATH)
+
+    for version_name in os.listdir(DATABASE_VERSIONS_PATH):
+        version_folder = os.path.realpath(f"{DATABASE_VERSIONS_PATH}/{version_name}")
+        if version_folder not in (os.path.realpath(staging_folder), os.path.realpath(previous_folder)):
+            shutil.rmtree(version_folder, ignore_errors=True)
+
+
+async def index_subtitles(staging_folder: str, remote_subtitle_etags: dict, download_slots: asyncio.Semaphore):
+    """Build the indexes of new and changed subtitles in the staged version and remove outdated ones.
+
+    Subtitles that fail to index are left out and indexed on first use instead. Returns the number of built indexes."""
+    index_folder = f"{staging_folder}/{anime_search_subtitles.SUBTITLE_INDEX_FOLDER_NAME}"
+    missing_indexes = [(subtitle_file, anime_search_subtitles.index_path_for(subtitle_file, etag, index_folder))
+                       for subtitle_file, etag in remote_subtitle_etags.items()
+                       if not os.path.exists(anime_search_subtitles.index_path_for(subtitle_file, etag, index_folder))]
     loop = asyncio.get_running_loop()
-    finished_query = await loop.run_in_executor(None, run_search)
-
-    json_results = json.loads(finished_query.stdout.decode("utf-8"))[1][0][2:]
-    search_results = []
-    for json_result in json_results:
-        result = dict()
-        result["anime_name"] = json_result[2]
-        result["subtitle_file"] = json_result[5]
-        result["video_file"] = json_result[7]
-        result["text"] = json_result[6]
-        result["start_time"] = json_result[4]
-        result["end_time"] = json_result[3]
-        result["context_name"] = json_result[1]
-        search_results.append(result)
-
-    random.shuffle(search_results)
-    return search_results
-
-
-async def download_db():
-    file_list = await data_management.list_files_from_s3(folder_path=REMOTE_DATABASE_PATH, bucket=DATABASE_BUCKET)
-    for file in file_list:
-        await data_management.download_from_s3(f'{LOCAL_DATABASE_PATH}/{file}',
-                                               f"{REMOTE_DATABASE_PATH}{file}",
-                                               bucket=DATABASE_BUCKET)
-    return
+
+    async def index_subtitle(subtitle_file, index_path):
+        subtitle_path = f"{index_path}.source{os.path.splitext(subtitle_file)[1]}"
+        async with download_slots:
+            try:
+                os.makedirs(os.path.dirname(index_path), exist_ok=True)
+                await data_management.download_from_s3(subtitle_path, f"{REMOTE_SUBTITLE_PATH}{subtitle_file}",
+                                                       bucket=DATABASE_BUCKET)
+                await loop.run_in_executor(None, anime_search_subtitles.build_subtitle_index, subtitle_path,
+                                           index_path)
+            except Exception as error:
+                print(f"Unable to index subtitle {subtitle_file}: {error}")
+                return False
+            finally:
+                if os.path.exists(subtitle_path):
+                    os.remove(subtitle_path)
+        return True
+
+    indexed = await asyncio.gather(*(index_subtitle(subtitle_file, index_path)
+                                     for subtitle_file, index_path in missing_indexes))
+    await loop.run_in_executor(None, anime_search_subtitles.remove_outdated_indexes, remote_subtitle_etags,
+                               staging_folder)
+    anime_search_subtitles.write_subtitle_manifest(remote_subtitle_etags, staging_folder)
+    return sum(indexed)
+
+
+async def sync_database():
+    """Download changed database files into a staging folder in parallel, index changed subtitles and swap it in once
+    complete.
+
+    Returns the number of downloaded and removed files and of indexed subtitles."""
+    async with database_sync_lock:
+        remote_objects = await data_management.list_objects_from_s3(folder_path=REMOTE_DATABASE_PATH,
+                                                                    bucket=DATABASE_BUCKET)
+        remote_manifest = dict()
+        for remote_object in remote_objects:
+            file_name = remote_object["Key"][len(REMOTE_DATABASE_PATH):]
+            if file_name and not file_name.endswith("/"):
+                remote_manifest[file_name] = {"size": remote_object["Size"],
+                                              "etag": remote_object["ETag"].strip('"')}
+        remote_subtitle_objects = await data_management.list_objects_from_s3(folder_path=REMOTE_SUBTITLE_PATH,
+                                                                             bucket=DATABASE_BUCKET)
+        remote_subtitle_etags = dict()
+        for remote_object in remote_subtitle_objects:
+            subtitle_file = remote_object["Key"][len(REMOTE_SUBTITLE_PATH):]
+            if subtitle_file and not subtitle_file.endswith("/"):
+                remote_subtitle_etags[subtitle_file] = remote_object["ETag"].strip('"')
+
+        local_manifest = read_database_manifest(LOCAL_DATABASE_PATH)
+        changed_files = [file_name for file_name, file_data in remote_manifest.items()
+                         if local_manifest.get(file_name) != file_data]
+        removed_files = [file_name for file_name in local_manifest if file_name not in remote_manifest]
+        subtitles_changed = anime_search_subtitles.read_subtitle_manifest(LOCAL_DATABASE_PATH) != remote_subtitle_etags
+        if not changed_files and not removed_files and not subtitles_changed:
+            return 0, 0, 0
+
+        loop = asyncio.get_running_loop()
+        staging_folder = await loop.run_in_executor(None, stage_database_version,
+                                                    changed_files + removed_files + [DATABASE_MANIFEST_NAME])
+        download_slots = asyncio.Semaphore(DATABASE_SYNC_CONCURRENCY)
+
+        async def download_file(file_name):
+            async with download_slots:
+                os.makedirs(os.path.dirname(f"{staging_folder}/{file_name}"), exist_ok=True)
+                await data_management.download_from_s3(f"{staging_folder}/{file_name}",
+                                                       f"{REMOTE_DATABASE_PATH}{file_name}",
+                                                       bucket=DATABASE_BUCKET)
+
+        try:
+            await asyncio.gather(*(download_file(file_name) for file_name in changed_files))
+            if sqlite_index_outdated(staging_folder, changed_files + removed_files):
+                if anime_search_engines.groonga_installed():
+                    # The SQLite index is built locally from groonga and was hard linked from the previous version.
+                    await loop.run_in_executor(None, anime_search_engines.import_from_groonga, staging_folder)
+                else:
+                    print("Groonga is not installed, keeping the previous SQLite index. It is missing the updated "
+                          "lines until it is rebuilt.")
+            indexed_count = await index_subtitles(staging_folder, remote_subtitle_etags, download_slots)
+        except Exception:
+            shutil.rmtree(staging_folder, ignore_errors=True)
+            raise
+
+        with open(f"{staging_folder}/{DATABASE_MANIFEST_NAME}", "w") as manifest_file:
+            json.dump(remote_manifest, manifest_file)
+        await loop.run_in_executor(None, swap_database_version, staging_folder)
+        search_engine.reset()
+        search_result_cache.clear()
+        anime_search_subtitles.load_subtitle_index.cache_clear()
+        await loop.run_in_executor(None, load_subtitle_etags)
+        await loop.run_in_executor(None, anime_catalog.load)
+        return len(changed_files), len(removed_files), indexed_count
 
 
 ##############################################
@@ -286,22 +1077,45 @@ class AnimeSearch(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+    async def cog_load(self):
+        anime_search_rendering.check_main_module()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, result_folder_janitor.sweep, True)
+        await loop.run_in_executor(None, anime_catalog.load)
+        await loop.run_in_executor(None, load_subtitle_etags)
+        self.clean_result_folders.start()
+
+    async def cog_unload(self):
+        clip_render_service.stop()
+        self.clean_result_folders.cancel()
+
+    @tasks.loop(minutes=10)
+    async def clean_result_folders(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, result_folder_janitor.sweep)
+
     @discord.app_commands.command(
         name="search",
         description="Search in the anime example database.")
     @discord.app_commands.guild_only()
-    async def search(self, interaction: discord.Interaction, text_to_search: str):
-        text_to_search = re.sub(r"\s", "", text_to_search.lower().strip())
-        text_to_search = re.sub(r"[a-zA-Z]", "", text_to_search)
+    @discord.app_commands.describe(anime_name="Only search in this anime.")
+    @discord.app_commands.autocomplete(anime_name=anime_name_autocomplete)
+    async def search(self, interaction: discord.Interaction, text_to_search: str, anime_name: str = None):
+        text_to_search = normalize_search_text(text_to_search)
         if not text_to_search:
             await interaction.response.send_message("Invalid search. Please search in Japanese.")
             return
+        if anime_name and anime_name not in anime_catalog:
+            await interaction.response.send_message(f"Unknown anime '{anime_name}'. Please choose one from the list.",
+                                                    ephemeral=True)
+            return
 
         await interaction.response.defer()
-        search_results = await perform_search_query(text_to_search)
-        result_embed = await create_result_embed(search_results, text_to_search)
+        search_query = SearchQuery(text_to_search, random.choice(SEARCH_ORDERING_SEEDS), anime_name)
+        page_results = await search_query.fetch_page(0)
+        result_embed = await create_result_embed(search_query, page_results)
         interaction_message = await interaction.original_response()
-        result_view = await create_result_view(search_results, interaction.user, 0, text_to_search, interaction_message)
+        result_view = await create_result_view(search_query, page_results, interaction.user, 0, interaction_message)
 
         await interaction.edit_original_response(content="", embed=result_embed, view=result_view)
 
@@ -310,21 +1124,49 @@ class AnimeSearch(commands.Cog):
         description="List the anime in the database.")
     @discord.app_commands.guild_only()
     async def list_anime(self, interaction: discord.Interaction):
-        with open("data/database/anime_names.json") as json_file:
-            anime_data = json.load(json_file)
-
-        anime_in_db = list(anime_data.values())
+        anime_list_embed = create_anime_list_embed(0)
+        if anime_catalog.page_count() == 1:
+            await interaction.response.send_message(embed=anime_list_embed)
+            return
 
-        anime_list_embed = discord.Embed(title="Anime in database", description="\n".join(anime_in_db))
         await interaction.response.send_message(embed=anime_list_embed)
+        interaction_message = await interaction.original_response()
+        anime_list_view = create_anime_list_view(0, interaction.user, interaction_message)
+        await interaction.edit_original_response(view=anime_list_view)
 
     @commands.command(name='update_anime_db')
     @commands.has_permissions(administrator=True)
     async def update_anime_db(self, ctx: commands.Context):
         """Download the search database from S3"""
         reply = await ctx.reply("Downloading database...")
-        await download_db()
-        await reply.edit(content="Finished downloading database.")
+        downloaded_count, removed_count, indexed_count = await sync_database()
+        await reply.edit(content=f"Finished downloading database. Downloaded {downloaded_count} changed files, "
+                                 f"removed {removed_count} files and indexed {indexed_count} subtitles.")
+
+    @commands.command(name='build_sqlite_search_index')
+    @commands.has_permissions(administrator=True)
+    async def build_sqlite_search_index(self, ctx: commands.Context):
+        """Build the SQLite FTS5 search index from the local groonga database."""
+        reply = await ctx.reply("Building SQLite search index...")
+        loop = asyncio.get_running_loop()
+        row_count = await loop.run_in_executor(None, anime_search_engines.import_from_groonga)
+        search_engine.reset()
+        search_result_cache.clear()
+        await reply.edit(content=f"Finished building SQLite search index with {row_count} lines.")
+
+    @commands.command(name='anime_search_stats')
+    @commands.has_permissions(administrator=True)
+    async def anime_search_stats(self, ctx: commands.Context):
+        """Show cache and engine statistics for the anime search."""
+        stats_lines = [f"Search engine: {search_engine.name}",
+                       f"Search result cache: {search_result_cache.stats_string()}",
+                       f"Anime catalog: {len(anime_catalog.names)} anime on {anime_catalog.page_count()} pages",
+                       f"Download cache: {download_cache.stats_string()}",
+                       f"Clip cache: {clip_cache.stats_string()}",
+                       f"Clip rendering: {clip_render_service.stats_string()}",
+                       f"Prefetching: {result_prefetcher.stats_string()}",
+                       f"Result folders: {result_folder_janitor.stats_string()}"]
+        await ctx.reply("\n".join(stats_lines))
 
 
 async def setup(bot):
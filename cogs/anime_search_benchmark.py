@@ -0,0 +1,408 @@
+"""Offline benchmark and replay harness for the anime search pipeline.
+
+Runs perform_search_query, generate_clip and cut_clip against a generated fixture in a temporary folder: a small
+in-memory (or SQLite) search engine, a local folder standing in for S3 with sample videos and subtitles, and a trimmer
+stub that copies the requested file instead of encoding it. Reports p50/p95/p99 latency and peak Python memory per
+stage, the memory from a second pass with empty caches so that tracing doesn't slow the timed pass. It needs no
+network, so it can run in CI:
+    python -m cogs.anime_search_benchmark
+    python -m cogs.anime_search_benchmark --engine sqlite --replay queries.txt --budget search_cold=20
+
+The config files read by data_management and anime_search have to exist, placeholder values are fine since S3 is
+never contacted. Run it as its own process, it patches module globals of the anime search cog.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+FIXTURE_WORDS = ["猫", "犬", "食べる", "大丈夫", "学校", "先生", "今日", "明日", "行く", "見る", "電車", "友達"]
+FIXTURE_ANIME = ["Fixture Anime A", "Fixture Anime B", "Fixture Anime C"]
+BENCHMARK_SEED = 12345
+
+
+def copy_trim(trim_arguments: list, delay_seconds=0.0):
+    """Trimmer stub with the argument format of ffmpeg_smart_trim that copies the input instead of encoding it."""
+    input_path = trim_arguments[0]
+    output_path = trim_arguments[trim_arguments.index("--output") + 1]
+    if delay_seconds:
+        time.sleep(delay_seconds)
+    shutil.copyfile(input_path, output_path)
+    return True
+
+
+class DelayedCopyTrim:
+    """Picklable trimmer stub that simulates a fixed encode time."""
+
+    def __init__(self, delay_seconds: float):
+        self.delay_seconds = delay_seconds
+
+    def __call__(self, trim_arguments: list):
+        return copy_trim(trim_arguments, self.delay_seconds)
+
+
+##############################################
+
+# Fixture
+
+def format_ass_time(milliseconds: int):
+    hours, rest = divmod(milliseconds, 3600000)
+    minutes, rest = divmod(rest, 60000)
+    seconds, rest = divmod(rest, 1000)
+    return f"{hours}:{minutes:02}:{seconds:02}.{rest // 10:02}"
+
+
+def write_ass_file(subtitle_path: str, lines: list):
+    with open(subtitle_path, "w", encoding="utf-8") as subtitle_file:
+        subtitle_file.write("[Script Info]\nScriptType: v4.00+\n\n[V4+ Styles]\n"
+                            "Format: Name, Fontname, Fontsize\nStyle: Default,Arial,20\n\n[Events]\n"
+                            "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n")
+        for start_time, end_time, text in lines:
+            subtitle_file.write(f"Dialogue: 0,{format_ass_time(start_time)},{format_ass_time(end_time)},"
+                                f"Default,,0,0,0,,{text}\n")
+
+
+def create_fixture(fixture_folder: str, video_count: int, lines_per_video: int, video_bytes: int):
+    """Write sample videos and subtitles into a folder laid out like the S3 bucket. Returns the search rows."""
+    fixture_random = random.Random(BENCHMARK_SEED)
+    os.makedirs(f"{fixture_folder}/8_finished_clips", exist_ok=True)
+    os.makedirs(f"{fixture_folder}/9_finished_subs", exist_ok=True)
+    rows = []
+    for video_index in range(video_count):
+        anime_name = FIXTURE_ANIME[video_index % len(FIXTURE_ANIME)]
+        video_file = f"fixture_{video_index:03}.mp4"
+        subtitle_file = f"fixture_{video_index:03}.ass"
+        with open(f"{fixture_folder}/8_finished_clips/{video_file}", "wb") as video:
+            video.write(fixture_random.randbytes(video_bytes))
+
+        lines = []
+        start_time = 1000
+        for _ in range(lines_per_video):
+            text = "、".join(fixture_random.sample(FIXTURE_WORDS, 3)) + "。"
+            # ASS stores centiseconds, so times stay multiples of 10 to match the subtitle index exactly.
+            end_time = start_time + fixture_random.randrange(1000, 4000, 10)
+            lines.append((start_time, end_time, text))
+            rows.append({"anime_name": anime_name, "subtitle_file": subtitle_file, "video_file": video_file,
+                         "text": text, "start_time": start_time, "end_time": end_time,
+                         "context_name": f"{anime_name} {video_index + 1}"})
+            start_time = end_time + fixture_random.randrange(100, 1500, 10)
+        write_ass_file(f"{fixture_folder}/9_finished_subs/{subtitle_file}", lines)
+    return rows
+
+
+class LocalObjectStore:
+    """Stand-in for the S3 functions of data_management that serves objects from a local folder."""
+
+    def __init__(self, root_folder: str):
+        self.root_folder = root_folder
+        self.downloads = 0
+
+    async def download_from_s3(self, local_path: str, remote_path: str, bucket=None):
+        self.downloads += 1
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, shutil.copyfile, f"{self.root_folder}/{remote_path}", local_path)
+        return True
+
+    async def head_from_s3(self, remote_path: str, bucket=None):
+        object_stat = os.stat(f"{self.root_folder}/{remote_path}")
+        return {"ETag": f'"{object_stat.st_size:x}{object_stat.st_mtime_ns:x}"', "ContentLength": object_stat.st_size}
+
+    async def list_objects_from_s3(self, folder_path="", bucket=None):
+        objects = []
+        for local_folder, _, file_names in os.walk(f"{self.root_folder}/{folder_path}"):
+            for file_name in sorted(file_names):
+                remote_path = os.path.relpath(f"{local_folder}/{file_name}", self.root_folder)
+                object_metadata = await self.head_from_s3(remote_path)
+                objects.append({"Key": remote_path, "Size": object_metadata["ContentLength"],
+                                "ETag": object_metadata["ETag"]})
+        return objects
+
+    async def generate_presigned_url_s3(self, remote_path: str, bucket=None, expires_in=3600):
+        return f"{self.root_folder}/{remote_path}"
+
+    def install(self, data_management):
+        data_management.download_from_s3 = self.download_from_s3
+        data_management.head_from_s3 = self.head_from_s3
+        data_management.generate_presigned_url_s3 = self.generate_presigned_url_s3
+        data_management.list_objects_from_s3 = self.list_objects_from_s3
+
+
+def create_fixture_engine(anime_search_engines, rows: list):
+
+    class FixtureSearchEngine(anime_search_engines.SearchEngine):
+        """In-memory engine over the fixture rows with the same seeded ordering as the real engines."""
+        name = "fixture"
+
+        def search(self, searched_text: str, offset: int, limit: int, seed: int, anime_name=None):
+            matches = [(row_id, row) for row_id, row in enumerate(rows)
+                       if searched_text in row["text"] and (not anime_name or row["anime_name"] == anime_name)]
+            matches.sort(key=lambda match: (anime_search_engines.seeded_order_key(match[0], seed), match[0]))
+            return len(matches), [dict(row) for _, row in matches[offset:offset + limit]]
+
+        def index_size(self):
+            return sum(len(row["text"].encode("utf-8")) for row in rows)
+
+        def database_path(self):
+            return "memory"
+
+        def is_available(self):
+            return True
+
+    return FixtureSearchEngine()
+
+
+##############################################
+
+# Measurements
+
+def percentile(sorted_values: list, fraction: float):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class StageTimer:
+    """Collects latencies or the peak traced memory of each stage.
+
+    Tracing memory slows allocations down, so latencies and memory are measured in separate passes."""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.latencies = dict()
+        self.peak_memory = dict()
+
+    async def run(self, stage_name: str, calls: list):
+        """Await each coroutine factory in calls in order and record its latency or memory under stage_name."""
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            for call in calls:
+                await call()
+            self.peak_memory[stage_name] = max(self.peak_memory.get(stage_name, 0),
+                                               tracemalloc.get_traced_memory()[1])
+            return
+
+        stage_latencies = self.latencies.setdefault(stage_name, [])
+        for call in calls:
+            start = time.perf_counter()
+            await call()
+            stage_latencies.append((time.perf_counter() - start) * 1000)
+
+    def report(self, memory_timer):
+        report = dict()
+        for stage_name, stage_latencies in self.latencies.items():
+            if not stage_latencies:
+                continue
+            sorted_latencies = sorted(stage_latencies)
+            report[stage_name] = {
+                "count": len(sorted_latencies),
+                "p50_ms": statistics.median(sorted_latencies),
+                "p95_ms": percentile(sorted_latencies, 0.95),
+                "p99_ms": percentile(sorted_latencies, 0.99),
+                "peak_memory_bytes": memory_timer.peak_memory.get(stage_name, 0),
+            }
+        return report
+
+
+def format_report(report: dict):
+    lines = []
+    for stage_name, values in report.items():
+        lines.append(f"{stage_name}: {values['count']} runs | p50 {values['p50_ms']:.2f}ms | "
+                     f"p95 {values['p95_ms']:.2f}ms | p99 {values['p99_ms']:.2f}ms | "
+                     f"peak memory {values['peak_memory_bytes'] / 1024 / 1024:.2f}MiB")
+    return "\n".join(lines)
+
+
+def check_budgets(report: dict, budgets: list):
+    """Return the violated budgets. Each budget is a 'stage=milliseconds' limit on the stage's p95."""
+    violations = []
+    for budget in budgets:
+        stage_name, _, limit = budget.partition("=")
+        if stage_name not in report:
+            violations.append(f"{stage_name}: stage was not measured")
+        elif report[stage_name]["p95_ms"] > float(limit):
+            violations.append(f"{stage_name}: p95 {report[stage_name]['p95_ms']:.2f}ms exceeds {float(limit):.2f}ms")
+    return violations
+
+
+##############################################
+
+# Pipeline runs
+
+def reset_caches(anime_search, anime_search_subtitles):
+    """Start the next pass with the same empty caches as the first one."""
+    anime_search.search_result_cache.clear()
+    anime_search_subtitles.load_subtitle_index.cache_clear()
+    for cache_folder in (anime_search.DOWNLOAD_CACHE_PATH, anime_search.CLIP_CACHE_PATH):
+        shutil.rmtree(cache_folder)
+        os.makedirs(cache_folder)
+    anime_search.download_cache = anime_search.S3FileCache(anime_search.DOWNLOAD_CACHE_PATH,
+                                                           anime_search.DOWNLOAD_CACHE_MAX_BYTES,
+                                                           anime_search.DATABASE_BUCKET)
+    anime_search.clip_cache = anime_search.RenderedClipCache(anime_search.CLIP_CACHE_PATH,
+                                                             anime_search.CLIP_CACHE_MAX_BYTES)
+
+
+async def run_pipeline(anime_search, queries: list, iterations: int, timer: StageTimer):
+    seeds = anime_search.SEARCH_ORDERING_SEEDS
+
+    def search_call(query, seed, clear_cache):
+        async def call():
+            if clear_cache:
+                anime_search.search_result_cache.clear()
+            await anime_search.perform_search_query(query, 0, seed)
+        return call
+
+    for iteration in range(iterations):
+        seed = seeds[iteration % len(seeds)]
+        await timer.run("search_cold", [search_call(query, seed, True) for query in queries])
+        # Clearing the cache before each cold query leaves only the last one cached.
+        for query in queries:
+            await anime_search.perform_search_query(query, 0, seed)
+        await timer.run("search_cached", [search_call(query, seed, False) for query in queries])
+
+    clip_results = []
+    for query in queries:
+        _, page_results = await anime_search.perform_search_query(query, 0, seeds[0])
+        clip_results.extend(page_results)
+    clip_results = clip_results[:max(iterations, 1) * 2]
+
+    def clip_call(result):
+        async def call():
+            clip_data = await anime_search.generate_clip(result)
+            anime_search.result_folder_janitor.release_folder(clip_data[2])
+        return call
+
+    await timer.run("generate_clip", [clip_call(result) for result in clip_results])
+    await timer.run("generate_clip_cached", [clip_call(result) for result in clip_results])
+
+    cut_folder = anime_search.result_folder_janitor.create_folder(0)
+    video_files = sorted({result["video_file"] for result in clip_results})
+    for video_file in video_files:
+        await anime_search.fetch_to_folder(f"8_finished_clips/{video_file}", f"{cut_folder}/{video_file}")
+
+    def cut_call(result):
+        async def call():
+            await anime_search.cut_clip(result["start_time"], result["end_time"], result["video_file"], cut_folder)
+        return call
+
+    await timer.run("cut_clip", [cut_call(result) for result in clip_results])
+    anime_search.result_folder_janitor.release_folder(cut_folder)
+
+    def replay_call(query, seed):
+        async def call():
+            _, page_results = await anime_search.perform_search_query(query, 0, seed)
+            if page_results:
+                clip_data = await anime_search.generate_clip(page_results[0])
+                anime_search.result_folder_janitor.release_folder(clip_data[2])
+        return call
+
+    await timer.run("end_to_end", [replay_call(query, seeds[query_index % len(seeds)])
+                                   for query_index, query in enumerate(queries)])
+
+
+def read_replay_queries(replay_path: str):
+    with open(replay_path, encoding="utf-8") as replay_file:
+        return [line.strip() for line in replay_file if line.strip()]
+
+
+def run_benchmark(arguments):
+    work_folder = tempfile.mkdtemp(prefix="anime_search_benchmark_")
+    original_folder = os.getcwd()
+    try:
+        rows = create_fixture(f"{work_folder}/bucket", arguments.videos, arguments.lines, arguments.video_bytes)
+        # The cog resolves its data folders relative to the working directory. data_management creates them on
+        # import but expects cogs/ to exist already.
+        os.makedirs(f"{work_folder}/cogs/config", exist_ok=True)
+        os.chdir(work_folder)
+        from . import anime_search
+        from . import anime_search_engines
+        from . import anime_search_rendering
+        from . import anime_search_subtitles
+        from . import data_management
+        # Only needed for the import. Left in place, it would shadow the cogs package in the encoder processes, which
+        # are forked from a server that runs in this folder.
+        shutil.rmtree(f"{work_folder}/cogs")
+
+        object_store = LocalObjectStore(f"{work_folder}/bucket")
+        object_store.install(data_management)
+        if arguments.engine == "sqlite":
+            anime_search_engines.build_sqlite_index(rows, anime_search.LOCAL_DATABASE_PATH)
+            anime_search.search_engine = anime_search_engines.create_search_engine("sqlite")
+        else:
+            anime_search.search_engine = create_fixture_engine(anime_search_engines, rows)
+        anime_search.VIDEO_FETCH_MODE = "full"
+        trim_function = DelayedCopyTrim(arguments.trim_delay_ms / 1000.0) if arguments.trim_delay_ms else copy_trim
+        anime_search.clip_render_service = anime_search_rendering.ClipRenderService(arguments.workers, trim_function)
+
+        queries = read_replay_queries(arguments.replay) if arguments.replay else FIXTURE_WORDS
+
+        async def benchmark():
+            timing_timer = StageTimer()
+            memory_timer = StageTimer(trace_memory=True)
+            try:
+                # Builds the subtitle indexes like an update of the bot's database does.
+                await anime_search.sync_database()
+                object_store.downloads = 0
+                await run_pipeline(anime_search, queries, arguments.iterations, timing_timer)
+                timing_downloads = object_store.downloads
+                reset_caches(anime_search, anime_search_subtitles)
+                tracemalloc.start()
+                try:
+                    await run_pipeline(anime_search, queries, arguments.iterations, memory_timer)
+                finally:
+                    tracemalloc.stop()
+            finally:
+                anime_search.clip_render_service.stop()
+            return timing_timer.report(memory_timer), timing_downloads
+
+        report, s3_downloads = asyncio.run(benchmark())
+        report["fixture"] = {"engine": anime_search.search_engine.name, "rows": len(rows),
+                             "s3_downloads": s3_downloads,
+                             "peak_memory_bytes": max(values["peak_memory_bytes"] for values in report.values())}
+        return report
+    finally:
+        os.chdir(original_folder)
+        if arguments.keep:
+            print(f"Kept benchmark folder {work_folder}")
+        else:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+
+def main(arguments: list):
+    parser = argparse.ArgumentParser(description="Benchmark the anime search pipeline offline.")
+    parser.add_argument("--engine", choices=("fixture", "sqlite"), default="fixture")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--videos", type=int, default=3)
+    parser.add_argument("--lines", type=int, default=200, help="Subtitle lines per video.")
+    parser.add_argument("--video-bytes", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--workers", type=int, default=2, help="Encoder processes.")
+    parser.add_argument("--trim-delay-ms", type=float, default=0.0, help="Simulated encode time per clip.")
+    parser.add_argument("--replay", help="File with one query per line to use instead of the fixture words.")
+    parser.add_argument("--budget", action="append", default=[], help="Fail if a stage's p95 exceeds it, "
+                                                                      "e.g. search_cold=20.")
+    parser.add_argument("--json", help="Also write the report to this file.")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary fixture folder.")
+    parsed_arguments = parser.parse_args(arguments)
+
+    report = run_benchmark(parsed_arguments)
+    fixture_data = report.pop("fixture")
+    print(f"Engine {fixture_data['engine']}, {fixture_data['rows']} rows, {fixture_data['s3_downloads']} "
+          f"S3 downloads, overall peak memory {fixture_data['peak_memory_bytes'] / 1024 / 1024:.2f}MiB")
+    print(format_report(report))
+    if parsed_arguments.json:
+        with open(parsed_arguments.json, "w") as json_file:
+            json.dump({**report, "fixture": fixture_data}, json_file, indent=2)
+
+    violations = check_budgets(report, parsed_arguments.budget)
+    for violation in violations:
+        print(f"Budget exceeded: {violation}")
+    return 1 if violations else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,351 @@
+"""Search engines for the anime example database. Groonga runs as an external binary, SQLite FTS5 runs in-process.
+
+Build the SQLite index from an existing groonga database and compare both engines with:
+    python -m cogs.anime_search_engines import
+    python -m cogs.anime_search_engines benchmark 猫 学校 食べる 大丈夫
+
+Check that groonga sorts results exactly like the seeded order computed in Python with:
+    python -m cogs.anime_search_engines verify-order 猫 学校
+
+Queries shorter than three characters are reported separately as well, the trigram index cannot serve them.
+"""
+import glob
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+LOCAL_DATABASE_PATH = 'data/anime_search_database'
+GROONGA_DATABASE_NAME = "JPSUBS.db"
+SQLITE_DATABASE_NAME = "JPSUBS.sqlite"
+
+RESULT_COLUMNS = ("anime_name", "subtitle_file", "video_file", "text", "start_time", "end_time", "context_name")
+
+# The trigram tokenizer can only match queries of at least three characters through the index.
+TRIGRAM_LENGTH = 3
+
+# Results are ordered by a multiply-xorshift hash of the row id and the seed, a stable shuffle for each seed. Values
+# are kept to 32 bits after every step, so the products never leave 64 bit integers, and the result fits into
+# groonga's Int32 score.
+SEED_LIMIT = 2 ** 31
+ORDER_HASH_MULTIPLIER = 73244475
+ORDER_HASH_MASK = 4294967295
+ORDER_SCORE_MASK = 2147483647
+
+
+def seed_offset(seed: int):
+    """Offset of the row ids for a seed. Close seeds get far apart offsets, so their orderings share no pattern."""
+    return (seed % SEED_LIMIT) * ORDER_HASH_MULTIPLIER & ORDER_HASH_MASK
+
+
+def seeded_order_key(row_id: int, seed: int):
+    value = (row_id + seed_offset(seed)) & ORDER_HASH_MASK
+    for _ in range(2):
+        value = ((value >> 16) ^ value) * ORDER_HASH_MULTIPLIER & ORDER_HASH_MASK
+    return ((value >> 16) ^ value) & ORDER_SCORE_MASK
+
+
+def seeded_order_expression(id_column: str, seed: int):
+    """seeded_order_key written as a groonga script expression."""
+    value = f"(({id_column} + {seed_offset(seed)}) & {ORDER_HASH_MASK})"
+    for _ in range(2):
+        value = f"((((({value}) >> 16) ^ {value}) * {ORDER_HASH_MULTIPLIER}) & {ORDER_HASH_MASK})"
+    return f"(((({value}) >> 16) ^ {value}) & {ORDER_SCORE_MASK})"
+
+
+def groonga_installed():
+    return shutil.which("groonga") is not None
+
+
+def groonga_row_to_result(json_result: list):
+    result = dict()
+    result["anime_name"] = json_result[2]
+    result["subtitle_file"] = json_result[5]
+    result["video_file"] = json_result[7]
+    result["text"] = json_result[6]
+    result["start_time"] = json_result[4]
+    result["end_time"] = json_result[3]
+    result["context_name"] = json_result[1]
+    return result
+
+
+##############################################
+
+# Engines
+
+class SearchEngine:
+    """Blocking search interface. Methods are called from an executor thread."""
+    name = "base"
+
+    def search(self, searched_text: str, offset: int, limit: int, seed: int, anime_name=None):
+        """Return the total hit count and one page of results in the order given by the seed.
+
+        If anime_name is given only lines from that anime are matched."""
+        raise NotImplementedError
+
+    def index_size(self):
+        raise NotImplementedError
+
+    def reset(self):
+        """Called after the database folder was swapped so that open handles are replaced."""
+        pass
+
+    def is_available(self):
+        return os.path.exists(self.database_path())
+
+    def database_path(self):
+        raise NotImplementedError
+
+
+class GroongaSearchEngine(SearchEngine):
+    name = "groonga"
+
+    def __init__(self, database_folder=LOCAL_DATABASE_PATH):
+        self.database_folder = database_folder
+
+    def database_path(self):
+        return f"{self.database_folder}/{GROONGA_DATABASE_NAME}"
+
+    def is_available(self):
+        return groonga_installed() and super().is_available()
+
+    def run_select(self, select_command: str):
+        finished_query = subprocess.run(["groonga", self.database_path(), select_command], capture_output=True)
+        return json.loads(finished_query.stdout.decode("utf-8"))[1][0]
+
+    def search(self, searched_text: str, offset: int, limit: int, seed: int, anime_name=None):
+        filter_string = ""
+        if anime_name:
+            escaped_name = anime_name.replace("\\", "\\\\").replace('"', '\\"').replace("'", "\\'")
+            filter_string = f"--filter 'anime_name == \"{escaped_name}\"' "
+        select_result = self.run_select(f"select --table MainSubs --query text:@{searched_text} {filter_string}"
+                                        f"--scorer '_score = {seeded_order_expression('_id', seed)}' "
+                                        f"--sort_keys _score,_id --offset {offset} --limit {limit}")
+        hit_count = select_result[0][0]
+        return hit_count, [groonga_row_to_result(json_result) for json_result in select_result[2:]]
+
+    def iterate_all_rows(self, chunk_size=10000):
+        offset = 0
+        while True:
+            select_result = self.run_select(f"select --table MainSubs --offset {offset} --limit {chunk_size}")
+            rows = select_result[2:]
+            if not rows:
+                return
+            for json_result in rows:
+                yield groonga_row_to_result(json_result)
+            offset += chunk_size
+
+    def index_size(self):
+        return sum(os.path.getsize(file_path) for file_path in glob.glob(f"{self.database_path()}*"))
+
+
+class SQLiteSearchEngine(SearchEngine):
+    """FTS5 trigram index opened read-only, with one connection per executor thread.
+
+    The trigram index cannot serve queries shorter than three characters. Those go to groonga if it is installed and
+    its database is next to the index, otherwise they scan the table once per page."""
+    name = "sqlite"
+
+    def __init__(self, database_folder=LOCAL_DATABASE_PATH):
+        self.database_folder = database_folder
+        self.local_connections = threading.local()
+        self.generation = 0
+        self.short_query_engine = GroongaSearchEngine(database_folder)
+
+    def database_path(self):
+        return f"{self.database_folder}/{SQLITE_DATABASE_NAME}"
+
+    def reset(self):
+        self.generation += 1
+
+    def get_connection(self):
+        connection = getattr(self.local_connections, "connection", None)
+        if connection is not None and self.local_connections.generation != self.generation:
+            connection.close()
+            connection = None
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.database_path()}?mode=ro", uri=True, check_same_thread=False)
+            connection.execute("PRAGMA query_only = ON")
+            # SQLite has no xor operator, so the ordering hash runs as a function.
+            connection.create_function("seeded_order_key", 2, seeded_order_key, deterministic=True)
+            self.local_connections.connection = connection
+            self.local_connections.generation = self.generation
+        return connection
+
+    def search(self, searched_text: str, offset: int, limit: int, seed: int, anime_name=None):
+        if len(searched_text) >= TRIGRAM_LENGTH:
+            condition = "text MATCH ?"
+            parameters = ['"' + searched_text.replace('"', '""') + '"']
+        elif self.short_query_engine.is_available():
+            return self.short_query_engine.search(searched_text, offset, limit, seed, anime_name)
+        else:
+            escaped_text = searched_text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            condition = "text LIKE ? ESCAPE '\\'"
+            parameters = [f"%{escaped_text}%"]
+        if anime_name:
+            condition += " AND anime_name = ?"
+            parameters.append(anime_name)
+
+        # The window count comes out of the same scan as the page, so each page reads the matches only once.
+        columns_string = ", ".join(RESULT_COLUMNS)
+        connection = self.get_connection()
+        rows = connection.execute(f"SELECT {columns_string}, count(*) OVER () FROM MainSubs WHERE {condition} "
+                                  f"ORDER BY seeded_order_key(rowid, ?), rowid LIMIT ? OFFSET ?",
+                                  (*parameters, seed, limit, offset)).fetchall()
+        if rows:
+            hit_count = rows[0][-1]
+        else:
+            # Past the last page there is no row to carry the count.
+            hit_count = connection.execute(f"SELECT count(*) FROM MainSubs WHERE {condition}",
+                                           parameters).fetchone()[0]
+        return hit_count, [dict(zip(RESULT_COLUMNS, row[:-1])) for row in rows]
+
+    def index_size(self):
+        return os.path.getsize(self.database_path())
+
+
+SEARCH_ENGINES = {GroongaSearchEngine.name: GroongaSearchEngine,
+                  SQLiteSearchEngine.name: SQLiteSearchEngine}
+
+
+def create_search_engine(engine_name: str, database_folder=LOCAL_DATABASE_PATH):
+    try:
+        return SEARCH_ENGINES[engine_name](database_folder)
+    except KeyError:
+        raise ValueError(f"Unknown search engine '{engine_name}'. Choose from: {', '.join(SEARCH_ENGINES)}")
+
+
+##############################################
+
+# Importer
+
+def build_sqlite_index(rows, database_folder=LOCAL_DATABASE_PATH, batch_size=5000):
+    """Write all rows into a fresh FTS5 database and move it in place once complete."""
+    final_path = f"{database_folder}/{SQLITE_DATABASE_NAME}"
+    building_path = f"{final_path}.building"
+    if os.path.exists(building_path):
+        os.remove(building_path)
+
+    connection = sqlite3.connect(building_path)
+    columns_string = ", ".join(RESULT_COLUMNS)
+    unindexed_columns = ", ".join(f"{column} UNINDEXED" for column in RESULT_COLUMNS if column != "text")
+    insert_statement = f"INSERT INTO MainSubs ({columns_string}) VALUES ({', '.join('?' * len(RESULT_COLUMNS))})"
+    row_count = 0
+    with connection:
+        connection.execute(f"CREATE VIRTUAL TABLE MainSubs USING fts5(text, {unindexed_columns}, "
+                           f"tokenize='trigram')")
+        batch = []
+        for result in rows:
+            batch.append(tuple(result[column] for column in RESULT_COLUMNS))
+            if len(batch) >= batch_size:
+                connection.executemany(insert_statement, batch)
+                row_count += len(batch)
+                batch = []
+        if batch:
+            connection.executemany(insert_statement, batch)
+            row_count += len(batch)
+        connection.execute("INSERT INTO MainSubs(MainSubs) VALUES ('optimize')")
+    connection.execute("VACUUM")
+    connection.close()
+
+    os.replace(building_path, final_path)
+    print(f"Built SQLite search index with {row_count} lines at {final_path}")
+    return row_count
+
+
+def import_from_groonga(database_folder=LOCAL_DATABASE_PATH):
+    groonga_engine = GroongaSearchEngine(database_folder)
+    return build_sqlite_index(groonga_engine.iterate_all_rows(), database_folder)
+
+
+##############################################
+
+# Benchmark
+
+def benchmark_engines(engines: list, queries: list, repeat=5, limit=100):
+    """Run every query against every engine and return latency percentiles in milliseconds and index sizes."""
+    report = dict()
+    for engine in engines:
+        latencies = []
+        short_query_latencies = []
+        hit_counts = []
+        for _ in range(repeat):
+            for query in queries:
+                start = time.perf_counter()
+                hit_count, results = engine.search(query, 0, limit, 1)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if len(query) < TRIGRAM_LENGTH:
+                    short_query_latencies.append(latencies[-1])
+                hit_counts.append(len(results))
+
+        latencies.sort()
+        report[engine.name] = {
+            "p50_ms": statistics.median(latencies),
+            "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "max_ms": latencies[-1],
+            "mean_hits": statistics.mean(hit_counts),
+            "index_bytes": engine.index_size(),
+        }
+        if short_query_latencies:
+            report[engine.name]["short_p50_ms"] = statistics.median(short_query_latencies)
+    return report
+
+
+def verify_groonga_order(queries: list, seeds: list, database_folder=LOCAL_DATABASE_PATH):
+    """Check that groonga sorts all matches of each query exactly by seeded_order_key. Returns the mismatches."""
+    groonga_engine = GroongaSearchEngine(database_folder)
+    mismatches = []
+    for query in queries:
+        for seed in seeds:
+            select_result = groonga_engine.run_select(
+                f"select --table MainSubs --query text:@{query} --output_columns _id "
+                f"--scorer '_score = {seeded_order_expression('_id', seed)}' --sort_keys _score,_id --limit -1")
+            row_ids = [json_result[0] for json_result in select_result[2:]]
+            expected_ids = sorted(row_ids, key=lambda row_id: (seeded_order_key(row_id, seed), row_id))
+            if row_ids != expected_ids:
+                mismatches.append(f"{query} with seed {seed}: groonga returned {row_ids[:10]}, "
+                                  f"expected {expected_ids[:10]}")
+    return mismatches
+
+
+def format_benchmark_report(report: dict):
+    lines = []
+    for engine_name, values in report.items():
+        short_query_string = f" | short queries p50 {values['short_p50_ms']:.1f}ms" if "short_p50_ms" in values else ""
+        lines.append(f"{engine_name}: p50 {values['p50_ms']:.1f}ms | p95 {values['p95_ms']:.1f}ms | "
+                     f"max {values['max_ms']:.1f}ms | {values['mean_hits']:.1f} hits | "
+                     f"index {values['index_bytes'] / 1024 / 1024:.1f}MiB{short_query_string}")
+    return "\n".join(lines)
+
+
+def main(arguments: list):
+    if not arguments or arguments[0] not in ("import", "benchmark", "verify-order"):
+        print(__doc__)
+        return 1
+
+    if arguments[0] == "import":
+        import_from_groonga()
+        return 0
+
+    if arguments[0] == "verify-order":
+        seeds = [1, 12345, SEED_LIMIT - 1]
+        mismatches = verify_groonga_order(arguments[1:] or ["猫", "学校", "食べる", "大丈夫"], seeds)
+        for mismatch in mismatches:
+            print(f"Order mismatch for {mismatch}")
+        print("groonga orders results by seeded_order_key." if not mismatches else "groonga order differs.")
+        return 1 if mismatches else 0
+
+    engines = [engine_class() for engine_class in SEARCH_ENGINES.values()]
+    engines = [engine for engine in engines if engine.is_available()]
+    report = benchmark_engines(engines, arguments[1:] or ["猫", "学校", "食べる", "大丈夫"])
+    print(format_benchmark_report(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,306 @@
+"""Bounded worker pool for rendering anime search clips with ffmpeg_smart_trim.
+
+Kept free of discord imports so that worker processes stay light. Encoder processes are started through a
+forkserver (spawn where that is unavailable), which imports the bot's main module again in every encoder. The main
+script therefore has to keep its startup code behind if __name__ == "__main__", rendering refuses to start otherwise.
+"""
+import ast
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import runpy
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from collections import deque
+
+TRIM_MODULE = "ffmpeg_smart_trim.trim"
+KEYFRAME_SEARCH_WINDOWS = (10.0, 60.0, None)
+
+
+def main_module_is_guarded():
+    """Whether the main script keeps its top level code behind if __name__ == "__main__"."""
+    main_path = getattr(sys.modules["__main__"], "__file__", None)
+    if not main_path or not main_path.endswith(".py"):
+        return True
+    with open(main_path, encoding="utf-8") as main_file:
+        main_tree = ast.parse(main_file.read())
+    return any(isinstance(statement, ast.If) and ast.unparse(statement.test) in ("__name__ == '__main__'",
+                                                                                 "'__main__' == __name__")
+               for statement in main_tree.body)
+
+
+def check_main_module():
+    if not main_module_is_guarded():
+        raise RuntimeError(f"{sys.modules['__main__'].__file__} has no if __name__ == \"__main__\" guard. Clip "
+                           f"encoders import it again and would each start another bot.")
+
+
+def encoder_context():
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    # Encoders are forked from a server that already imported the trimming code, not from the bot.
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def start_encoder_process():
+    """Initializer of encoder processes. A process group of their own lets a cancelled encode be stopped together
+    with the ffmpeg processes it started."""
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+
+
+def kill_encoder_process(process_id: int):
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process_id, signal.SIGKILL)
+        else:
+            os.kill(process_id, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_trim(trim_arguments: list):
+    """Run the trim module inside a warm worker process instead of starting a new interpreter per clip."""
+    sys.argv = [TRIM_MODULE, *trim_arguments]
+    try:
+        runpy.run_module(TRIM_MODULE, run_name="__main__", alter_sys=True)
+    except SystemExit as exit_signal:
+        if exit_signal.code:
+            raise RuntimeError(f"Trimming failed with exit code {exit_signal.code}: {trim_arguments}")
+    return True
+
+
+def find_keyframe_before(video_url: str, time_seconds: float):
+    """Return the time of the last video keyframe at or before time_seconds.
+
+    ffprobe seeks with the container index, so for remote URLs only small byte ranges around the window are read."""
+    for window in KEYFRAME_SEARCH_WINDOWS:
+        window_start = 0.0 if window is None else max(time_seconds - window, 0.0)
+        probe_command = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-skip_frame", "nokey",
+                         "-read_intervals", f"{window_start}%{time_seconds + 0.001}",
+                         "-show_entries", "frame=pts_time", "-of", "csv=p=0", video_url]
+        probe_output = subprocess.run(probe_command, capture_output=True, check=True).stdout.decode()
+        keyframe_times = [float(line.strip().rstrip(",")) for line in probe_output.splitlines()
+                          if line.strip() and line.strip() != "N/A"]
+        keyframe_times = [keyframe_time for keyframe_time in keyframe_times if keyframe_time <= time_seconds]
+        if keyframe_times:
+            return max(keyframe_times)
+        if window_start == 0.0:
+            break
+    return 0.0
+
+
+def copy_segment(video_url: str, start_seconds: float, end_seconds: float, output_path: str):
+    """Copy [start, end] without re-encoding. start has to be a keyframe so that the segment starts cleanly."""
+    copy_command = ["ffmpeg", "-v", "error", "-y", "-ss", str(start_seconds), "-i", video_url,
+                    "-t", str(end_seconds - start_seconds), "-map", "0:v:0", "-map", "0:a?", "-c", "copy",
+                    "-avoid_negative_ts", "make_zero", output_path]
+    subprocess.run(copy_command, capture_output=True, check=True)
+    return True
+
+
+def fetch_segment(video_url: str, start_ms: int, end_ms: int, output_path: str):
+    """Fetch only the part of a remote video needed for a clip. Returns the segment start in milliseconds."""
+    segment_start = find_keyframe_before(video_url, start_ms / 1000.0)
+    copy_segment(video_url, segment_start, end_ms / 1000.0, output_path)
+    return int(segment_start * 1000)
+
+
+class RenderJob:
+
+    def __init__(self, user_id: int, trim_arguments: list, progress_callback):
+        self.user_id = user_id
+        self.trim_arguments = trim_arguments
+        self.progress_callback = progress_callback
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.perf_counter()
+
+
+class EncoderSlot:
+    """One warm encoder process. A running encode is stopped by killing the process, which is then replaced."""
+
+    def __init__(self, trim_function):
+        self.trim_function = trim_function
+        self.process_pool = None
+        self.process_id = None
+        self.restarts = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=encoder_context(),
+                                                                   initializer=start_encoder_process)
+        self.process_id = await loop.run_in_executor(self.process_pool, os.getpid)
+
+    def stop(self):
+        if not self.process_pool:
+            return
+        if self.process_id:
+            kill_encoder_process(self.process_id)
+        self.process_pool.shutdown(wait=False, cancel_futures=True)
+        self.process_pool = None
+        self.process_id = None
+
+    async def run(self, job: RenderJob):
+        """Encode a job. A job whose encoder process died is retried once in a new process.
+
+        Returns as soon as the job is cancelled, the encode is stopped then instead of finishing it for nobody."""
+        for attempt in range(2):
+            try:
+                return await self.run_once(job)
+            except concurrent.futures.process.BrokenProcessPool:
+                print("Clip encoder process died, starting a new one.")
+                self.stop()
+                self.restarts += 1
+                if attempt:
+                    raise
+
+    async def run_once(self, job: RenderJob):
+        if not self.process_pool:
+            await self.start()
+        loop = asyncio.get_running_loop()
+        encode = loop.run_in_executor(self.process_pool, self.trim_function, job.trim_arguments)
+        await asyncio.wait([encode, job.future], return_when=asyncio.FIRST_COMPLETED)
+        if not encode.done():
+            encode.cancel()
+            self.stop()
+            return None
+        return encode.result()
+
+
+class ClipRenderService:
+    """Queues render jobs per user and hands them out round-robin to a fixed number of encoder processes."""
+
+    def __init__(self, worker_count: int, trim_function=run_trim):
+        self.worker_count = worker_count
+        self.trim_function = trim_function
+        self.user_queues = OrderedDict()
+        self.job_available = None
+        self.encoder_slots = []
+        self.workers = []
+        self.running_jobs = 0
+        self.finished_jobs = 0
+        self.cancelled_jobs = 0
+        self.stopped_encodes = 0
+        self.failed_jobs = 0
+        self.encode_times = deque(maxlen=200)
+        self.wait_times = deque(maxlen=200)
+
+    def start(self):
+        if self.workers:
+            return
+        check_main_module()
+        self.job_available = asyncio.Event()
+        self.encoder_slots = [EncoderSlot(self.trim_function) for _ in range(self.worker_count)]
+        self.workers = [asyncio.create_task(self.work(encoder_slot)) for encoder_slot in self.encoder_slots]
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        for encoder_slot in self.encoder_slots:
+            encoder_slot.stop()
+        for user_queue in self.user_queues.values():
+            for job in user_queue:
+                job.future.cancel()
+        self.user_queues.clear()
+
+    def queue_depth(self):
+        return sum(1 for user_queue in self.user_queues.values() for job in user_queue if not job.future.done())
+
+    def queue_position(self, job: RenderJob):
+        """Position of a job if the round-robin order stays as it is now."""
+        own_queue = self.user_queues.get(job.user_id, deque())
+        own_index = own_queue.index(job) if job in own_queue else 0
+        position = 1
+        for user_id, user_queue in self.user_queues.items():
+            if user_id == job.user_id:
+                position += own_index
+            else:
+                position += min(len(user_queue), own_index + 1)
+        return position
+
+    def next_job(self):
+        while self.user_queues:
+            user_id, user_queue = self.user_queues.popitem(last=False)
+            job = user_queue.popleft()
+            if user_queue:
+                self.user_queues[user_id] = user_queue
+            if not job.future.done():
+                return job
+        return None
+
+    async def report(self, job: RenderJob, text: str):
+        if not job.progress_callback:
+            return
+        try:
+            await job.progress_callback(text)
+        except Exception as error:
+            print(f"Unable to report clip progress: {error}")
+
+    async def render(self, user_id: int, trim_arguments: list, progress_callback=None):
+        """Queue a trim and wait for it. Cancelling the caller drops the job from the queue."""
+        self.start()
+        job = RenderJob(user_id, trim_arguments, progress_callback)
+        self.user_queues.setdefault(user_id, deque()).append(job)
+        self.job_available.set()
+        if self.running_jobs >= self.worker_count:
+            await self.report(job, f"Waiting for an encoder... (position {self.queue_position(job)} in queue)")
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            if not job.future.done():
+                job.future.cancel()
+            self.cancelled_jobs += 1
+            raise
+
+    async def work(self, encoder_slot: EncoderSlot):
+        while True:
+            job = self.next_job()
+            if not job:
+                self.job_available.clear()
+                await self.job_available.wait()
+                continue
+
+            self.running_jobs += 1
+            self.wait_times.append(time.perf_counter() - job.enqueued_at)
+            await self.report(job, "Encoding clip...")
+            encode_start = time.perf_counter()
+            try:
+                result = await encoder_slot.run(job)
+            except Exception as error:
+                self.failed_jobs += 1
+                if not job.future.done():
+                    job.future.set_exception(error)
+            else:
+                if job.future.done():
+                    self.stopped_encodes += 1
+                else:
+                    self.finished_jobs += 1
+                    self.encode_times.append(time.perf_counter() - encode_start)
+                    job.future.set_result(result)
+            finally:
+                self.running_jobs -= 1
+
+    def stats_string(self):
+        if self.encode_times:
+            sorted_times = sorted(self.encode_times)
+            encode_string = f"encode p50 {statistics.median(sorted_times):.1f}s, " \
+                            f"p95 {sorted_times[min(len(sorted_times) - 1, int(len(sorted_times) * 0.95))]:.1f}s"
+        else:
+            encode_string = "no encodes yet"
+        if self.wait_times:
+            wait_string = f"queue wait p50 {statistics.median(self.wait_times):.1f}s"
+        else:
+            wait_string = "no queue waits yet"
+        return f"{self.running_jobs}/{self.worker_count} encoding, {self.queue_depth()} queued, " \
+               f"{self.finished_jobs} finished, {self.failed_jobs} failed, {self.cancelled_jobs} cancelled " \
+               f"({self.stopped_encodes} while encoding), " \
+               f"{sum(encoder_slot.restarts for encoder_slot in self.encoder_slots)} encoder restarts, " \
+               f"{encode_string}, {wait_string}"
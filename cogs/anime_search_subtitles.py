@@ -0,0 +1,173 @@
+"""Compact subtitle indexes for the anime search, so that requests never have to parse ASS files.
+
+An index holds the start and end times of all lines sorted by start time, plus the line texts as one UTF-8 blob
+with an offset array. Indexes are named after the subtitle file and its S3 ETag, so an updated subtitle never reuses
+the index of its previous version. They are built while the anime search database is synced, which also records the
+ETags in a subtitle manifest next to the indexes. Rebuild the indexes of a database folder from local copies of the
+subtitles with:
+    python -m cogs.anime_search_subtitles <subtitle_folder> [<database_folder>]
+"""
+import functools
+import json
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+LOCAL_DATABASE_PATH = 'data/anime_search_database'
+SUBTITLE_INDEX_FOLDER_NAME = "subtitle_index"
+SUBTITLE_INDEX_PATH = f"{LOCAL_DATABASE_PATH}/{SUBTITLE_INDEX_FOLDER_NAME}"
+SUBTITLE_MANIFEST_NAME = "subtitle_manifest.json"
+INDEX_MAGIC = b"SUBIDX1\0"
+INDEX_EXTENSION = ".idx"
+
+
+class SubtitleIndex:
+
+    def __init__(self, start_times: array, end_times: array, text_offsets: array, text_blob: bytes):
+        self.start_times = start_times
+        self.end_times = end_times
+        self.text_offsets = text_offsets
+        self.text_blob = text_blob
+
+    def __len__(self):
+        return len(self.start_times)
+
+    def text(self, line_index: int):
+        return self.text_blob[self.text_offsets[line_index]:self.text_offsets[line_index + 1]].decode("utf-8")
+
+    def line(self, line_index: int):
+        return self.start_times[line_index], self.end_times[line_index], self.text(line_index)
+
+    def find(self, start_time: int):
+        """Binary search for the first line starting at start_time. Returns None if there is none."""
+        line_index = bisect_left(self.start_times, start_time)
+        if line_index < len(self) and self.start_times[line_index] == start_time:
+            return line_index
+        return None
+
+    def neighbours(self, start_time: int):
+        """Return the previous, matching and next line as (start, end, text) tuples, or None where missing."""
+        line_index = self.find(start_time)
+        if line_index is None:
+            return None, None, None
+        previous_line = self.line(line_index - 1) if line_index > 0 else None
+        next_line = self.line(line_index + 1) if line_index < len(self) - 1 else None
+        return previous_line, self.line(line_index), next_line
+
+    def full_text(self):
+        return "\n".join(self.text(line_index) for line_index in range(len(self)))
+
+
+def index_path_for(subtitle_file: str, etag: str, index_folder=SUBTITLE_INDEX_PATH):
+    return f"{index_folder}/{subtitle_file}.{etag}{INDEX_EXTENSION}"
+
+
+def read_subtitle_manifest(database_folder=LOCAL_DATABASE_PATH):
+    """ETags of the subtitle files the indexes of a database folder were built from, by subtitle file name."""
+    try:
+        with open(f"{database_folder}/{SUBTITLE_MANIFEST_NAME}") as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return dict()
+
+
+def write_subtitle_manifest(subtitle_etags: dict, database_folder=LOCAL_DATABASE_PATH):
+    # Replaced instead of rewritten, a staged database version shares its files with the live one.
+    manifest_path = f"{database_folder}/{SUBTITLE_MANIFEST_NAME}"
+    with open(f"{manifest_path}.part", "w") as manifest_file:
+        json.dump(subtitle_etags, manifest_file)
+    os.replace(f"{manifest_path}.part", manifest_path)
+
+
+def remove_outdated_indexes(subtitle_etags: dict, database_folder=LOCAL_DATABASE_PATH):
+    """Delete the indexes of subtitle versions that are not in subtitle_etags. Returns the number of removed files."""
+    index_folder = f"{database_folder}/{SUBTITLE_INDEX_FOLDER_NAME}"
+    current_paths = {os.path.normpath(index_path_for(subtitle_file, etag, index_folder))
+                     for subtitle_file, etag in subtitle_etags.items()}
+    removed_count = 0
+    for folder_path, _, file_names in os.walk(index_folder):
+        for file_name in file_names:
+            index_path = os.path.normpath(f"{folder_path}/{file_name}")
+            if index_path not in current_paths:
+                os.remove(index_path)
+                removed_count += 1
+    return removed_count
+
+
+def build_subtitle_index(subtitle_path: str, index_path: str):
+    import pysubs2
+
+    subtitle = pysubs2.load(subtitle_path)
+    lines = sorted(((line.start, line.end, line.text) for line in subtitle), key=lambda line: line[0])
+
+    start_times = array("i", (line[0] for line in lines))
+    end_times = array("i", (line[1] for line in lines))
+    text_offsets = array("I", [0])
+    encoded_texts = []
+    for _, _, text in lines:
+        encoded_text = text.encode("utf-8")
+        encoded_texts.append(encoded_text)
+        text_offsets.append(text_offsets[-1] + len(encoded_text))
+
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(f"{index_path}.part", "wb") as index_file:
+        index_file.write(INDEX_MAGIC)
+        index_file.write(struct.pack("<I", len(lines)))
+        for values in (start_times, end_times, text_offsets):
+            if sys.byteorder != "little":
+                values.byteswap()
+            index_file.write(values.tobytes())
+        index_file.write(b"".join(encoded_texts))
+    os.replace(f"{index_path}.part", index_path)
+    return len(lines)
+
+
+@functools.lru_cache(maxsize=256)
+def load_subtitle_index(index_path: str):
+    with open(index_path, "rb") as index_file:
+        index_data = index_file.read()
+    if not index_data.startswith(INDEX_MAGIC):
+        raise ValueError(f"{index_path} is not a subtitle index.")
+
+    position = len(INDEX_MAGIC)
+    line_count = struct.unpack_from("<I", index_data, position)[0]
+    position += 4
+    arrays = []
+    for type_code, length in (("i", line_count), ("i", line_count), ("I", line_count + 1)):
+        values = array(type_code)
+        byte_count = values.itemsize * length
+        values.frombytes(index_data[position:position + byte_count])
+        if sys.byteorder != "little":
+            values.byteswap()
+        arrays.append(values)
+        position += byte_count
+
+    start_times, end_times, text_offsets = arrays
+    return SubtitleIndex(start_times, end_times, text_offsets, index_data[position:])
+
+
+def main(arguments: list):
+    if not arguments:
+        print(__doc__)
+        return 1
+    subtitle_folder = arguments[0]
+    database_folder = arguments[1] if len(arguments) > 1 else LOCAL_DATABASE_PATH
+    subtitle_etags = read_subtitle_manifest(database_folder)
+    if not subtitle_etags:
+        print(f"{database_folder} has no {SUBTITLE_MANIFEST_NAME}, sync the database first to record the ETags.")
+        return 1
+    index_folder = f"{database_folder}/{SUBTITLE_INDEX_FOLDER_NAME}"
+    for subtitle_file, etag in sorted(subtitle_etags.items()):
+        subtitle_path = f"{subtitle_folder}/{subtitle_file}"
+        if not os.path.exists(subtitle_path):
+            print(f"Skipping {subtitle_file}, it is not in {subtitle_folder}")
+            continue
+        line_count = build_subtitle_index(subtitle_path, index_path_for(subtitle_file, etag, index_folder))
+        print(f"Indexed {line_count} lines of {subtitle_file}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -8,6 +8,7 @@ from discord.ext import commands
 from discord.ext import tasks
 
 from . import data_management
+from . import pinned_boards
 
 #########################################
 
@@ -158,15 +159,36 @@ async def increment_leaderboard_points(bump_member: discord.Member):
     return old_points, new_points
 
 
-async def make_leaderboard_post(bump_channel: discord.TextChannel, past_bot_pins: list, embed: discord.Embed,
-                                current_index: int):
-    try:
-        current_pin: discord.Message = past_bot_pins[current_index]
-    except IndexError:
-        current_pin = await bump_channel.send("Bump Leaderboard")
-        await current_pin.pin()
+LEADERBOARD_TITLE = "Bump Leaderboard"
+DESCRIPTION_CHARACTER_LIMIT = 4000
+
+
+def generate_leaderboard_embeds(guild: discord.Guild, bump_leaderboard: dict):
+    sorted_ids = sorted(bump_leaderboard.items(), key=lambda key_value: key_value[1], reverse=True)
+
+    embeds = []
+    embed_description_strings = []
+    description_length = 0
+    for index, user_info in enumerate(sorted_ids):
+        member = guild.get_member(int(user_info[0]))
+        points = user_info[1][1]
+        if not member:
+            user_mention = user_info[1][0]
+        else:
+            user_mention = member.mention
+        leaderboard_line = f"{index + 1}. {user_mention} **{points}点**"
+        added_length = len(leaderboard_line) + 1 if embed_description_strings else len(leaderboard_line)
+        if embed_description_strings and description_length + added_length > DESCRIPTION_CHARACTER_LIMIT:
+            embeds.append(discord.Embed(title=LEADERBOARD_TITLE, description='\n'.join(embed_description_strings)))
+            embed_description_strings = [leaderboard_line]
+            description_length = len(leaderboard_line)
+        else:
+            embed_description_strings.append(leaderboard_line)
+            description_length += added_length
 
-    await current_pin.edit(content="", embed=embed)
+    if embed_description_strings:
+        embeds.append(discord.Embed(title=LEADERBOARD_TITLE, description='\n'.join(embed_description_strings)))
+    return embeds
 
 
 #########################################
@@ -277,36 +299,13 @@ class BumpReminder(commands.Cog):
         bump_leaderboard: dict = await load_leaderboard(bump_channel.guild.id)
         if not bump_leaderboard:
             return
-        sorted_ids = sorted(bump_leaderboard.items(), key=lambda key_value: key_value[1], reverse=True)
-        past_bot_pins = [pin for pin in await bump_channel.pins() if pin.author.id == self.bot.user.id]
-
-        leaderboard_embed = discord.Embed(title="Bump Leaderboard")
-        embed_description_strings = []
-        current_embed_index = 0
-        for index, user_info in enumerate(sorted_ids):
-            user_id = int(user_info[0])
-            member = bump_channel.guild.get_member(user_id)
-            points = user_info[1][1]
-            if not member:
-                user_mention = user_info[1][0]
-            else:
-                user_mention = member.mention
-            leaderboard_line = f"{index + 1}. {user_mention} **{points}点**"
-            embed_description_strings.append(leaderboard_line)
-            if len('\n'.join(embed_description_strings)) > 4000:
-                embed_description_strings.pop()
-                embed_description = '\n'.join(embed_description_strings)
-                leaderboard_embed.description = embed_description
-                await make_leaderboard_post(bump_channel, past_bot_pins, leaderboard_embed, current_embed_index)
-
-                leaderboard_embed = discord.Embed(title="Bump Leaderboard")
-                embed_description_strings = [leaderboard_line]
-                current_embed_index += 1
-
-        if embed_description_strings:
-            embed_description = '\n'.join(embed_description_strings)
-            leaderboard_embed.description = embed_description
-            await make_leaderboard_post(bump_channel, past_bot_pins, leaderboard_embed, current_embed_index)
+
+        def is_leaderboard_pin(pin: discord.Message):
+            return pin.author.id == self.bot.user.id
+
+        leaderboard_embeds = generate_leaderboard_embeds(bump_channel.guild, bump_leaderboard)
+        await pinned_boards.render(bump_channel, LEADERBOARD_TITLE, is_leaderboard_pin, leaderboard_embeds,
+                                   placeholder_content=LEADERBOARD_TITLE)
 
     @tasks.loop(minutes=60.0)
     async def update_leaderboards(self):
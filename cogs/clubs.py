@@ -1,107 +1,358 @@
 """Framework for clubs with a role point system and scoreboard"""
 import asyncio
 import json
+from bisect import bisect_left
+from bisect import insort
 
 import discord
 from discord.ext import commands
 from discord.ext import tasks
 
 from . import data_management
+from . import pinned_boards
 from . import user_name_record
 
 #########################################
 
 # Database Operations and Values
 
-SETTINGS_TABLE_NAME = "clubs_settings"
-SETTINGS_COLUMNS = ("guild_id", "club_prefix", "club_name", "club_manager_role_name", "club_channel_name",
-                    "added_works_json", "user_data_json", "banned_user_list", "reward_role_suffix", "checkpoints_roles")
+# Clubs used to keep their works and rewards as JSON blobs in this table. It is only read to migrate clubs that are
+# not in the club table yet, new clubs can still be added here and are picked up on the next load.
+LEGACY_SETTINGS_TABLE_NAME = "clubs_settings"
+LEGACY_SETTINGS_COLUMNS = ("guild_id", "club_prefix", "club_name", "club_manager_role_name", "club_channel_name",
+                           "added_works_json", "user_data_json", "banned_user_list", "reward_role_suffix",
+                           "checkpoints_roles")
+
+CLUB_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS club (
+        guild_id INTEGER NOT NULL,
+        club_prefix TEXT NOT NULL,
+        club_name TEXT,
+        club_manager_role_name TEXT,
+        club_channel_name TEXT,
+        reward_role_suffix TEXT,
+        banned_user_list TEXT NOT NULL DEFAULT '[]',
+        checkpoints_roles TEXT NOT NULL DEFAULT '[]',
+        PRIMARY KEY (guild_id, club_prefix))""",
+    """CREATE TABLE IF NOT EXISTS club_work (
+        guild_id INTEGER NOT NULL,
+        club_prefix TEXT NOT NULL,
+        work_id TEXT NOT NULL,
+        work_name TEXT NOT NULL,
+        beginning_period TEXT,
+        end_period TEXT,
+        additional_info TEXT,
+        PRIMARY KEY (guild_id, club_prefix, work_id))""",
+    """CREATE TABLE IF NOT EXISTS club_reward (
+        guild_id INTEGER NOT NULL,
+        club_prefix TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        work_id TEXT NOT NULL,
+        points INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, club_prefix, user_id, work_id))""",
+    """CREATE INDEX IF NOT EXISTS club_reward_by_work ON club_reward (guild_id, club_prefix, work_id, user_id, points)""",
+)
+
+
+def load_legacy_value(value, default_type):
+    if not value:
+        return default_type()
+    return json.loads(value)
+
+
+async def migrate_legacy_clubs():
+    """Copy clubs from the JSON blob table into the normalized tables. Clubs that were migrated before are skipped."""
+    await data_management.create_table(LEGACY_SETTINGS_TABLE_NAME, LEGACY_SETTINGS_COLUMNS)
+    legacy_rows = await data_management.fetch_rows(f"SELECT {', '.join(LEGACY_SETTINGS_COLUMNS)} "
+                                                   f"FROM {LEGACY_SETTINGS_TABLE_NAME}")
+    existing_clubs = set(await data_management.fetch_rows("SELECT guild_id, club_prefix FROM club"))
+    for legacy_row in legacy_rows:
+        (guild_id, club_prefix, club_name, club_manager_role_name, club_channel_name, works_json, user_data_json,
+         banned_users_json, reward_role_suffix, checkpoint_roles_json) = legacy_row
+        if not club_prefix:
+            continue
+        guild_id = int(guild_id)
+        club_prefix = json.loads(club_prefix)
+        if (guild_id, club_prefix) in existing_clubs:
+            continue
+
+        statements = [("INSERT INTO club VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (guild_id, club_prefix, load_legacy_value(club_name, str),
+                        load_legacy_value(club_manager_role_name, str), load_legacy_value(club_channel_name, str),
+                        load_legacy_value(reward_role_suffix, str),
+                        json.dumps(load_legacy_value(banned_users_json, list)),
+                        json.dumps(load_legacy_value(checkpoint_roles_json, list))))]
+        for work_id, work_data in load_legacy_value(works_json, dict).items():
+            statements.append(("INSERT INTO club_work VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (guild_id, club_prefix, work_id, *work_data)))
+        for user_id, reward_user_data in load_legacy_value(user_data_json, dict).items():
+            for work_id, points in reward_user_data:
+                statements.append(("INSERT OR IGNORE INTO club_reward VALUES (?, ?, ?, ?, ?)",
+                                   (guild_id, club_prefix, int(user_id), work_id, points)))
+
+        await data_management.execute_transaction(statements)
+        print(f"CLUBS: Migrated club {club_prefix} of guild {guild_id} with {len(statements) - 1} works and rewards")
 
 
 async def fetch_club_data(guild_id: int, club_prefix: str):
-    club_name = await data_management.fetch_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[2],
-                                                  guild_id=guild_id,
-                                                  club_prefix=club_prefix)
-    club_manager_role_name = await data_management.fetch_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[3],
-                                                               guild_id=guild_id,
-                                                               club_prefix=club_prefix)
-    club_channel_name = await data_management.fetch_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[4],
-                                                          guild_id=guild_id,
-                                                          club_prefix=club_prefix)
-    reward_role_suffix = await data_management.fetch_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[8],
-                                                           guild_id=guild_id,
-                                                           club_prefix=club_prefix)
-
-    return club_name, club_manager_role_name, club_channel_name, reward_role_suffix
+    club_row = await data_management.fetch_row("SELECT club_name, club_manager_role_name, club_channel_name, "
+                                               "reward_role_suffix FROM club WHERE guild_id = ? AND club_prefix = ?",
+                                               (guild_id, club_prefix))
+    if not club_row:
+        return None, None, None, None
+    return tuple(club_row)
 
 
 async def write_club_data(guild_id: int, club_prefix: str, club_name: str, club_manager_role_name: str,
                           club_channel_name, reward_role_suffix):
-    await data_management.update_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[2], club_name,
-                                       guild_id=guild_id,
-                                       club_prefix=club_prefix)
-    await data_management.update_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[3], club_manager_role_name,
-                                       guild_id=guild_id,
-                                       club_prefix=club_prefix)
-    await data_management.update_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[4], club_channel_name,
-                                       guild_id=guild_id,
-                                       club_prefix=club_prefix)
-    await data_management.update_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[8], reward_role_suffix,
-                                       guild_id=guild_id,
-                                       club_prefix=club_prefix)
+    await data_management.execute("INSERT INTO club (guild_id, club_prefix, club_name, club_manager_role_name, "
+                                  "club_channel_name, reward_role_suffix) VALUES (?, ?, ?, ?, ?, ?) "
+                                  "ON CONFLICT (guild_id, club_prefix) DO UPDATE SET club_name = excluded.club_name, "
+                                  "club_manager_role_name = excluded.club_manager_role_name, "
+                                  "club_channel_name = excluded.club_channel_name, "
+                                  "reward_role_suffix = excluded.reward_role_suffix",
+                                  (guild_id, club_prefix, club_name, club_manager_role_name, club_channel_name,
+                                   reward_role_suffix))
+
+
+async def fetch_club_json_column(guild_id: int, club_prefix: str, column: str):
+    club_row = await data_management.fetch_row(f"SELECT {column} FROM club WHERE guild_id = ? AND club_prefix = ?",
+                                               (guild_id, club_prefix))
+    return json.loads(club_row[0]) if club_row else list()
+
+
+async def write_club_json_column(guild_id: int, club_prefix: str, column: str, value):
+    await data_management.execute(f"UPDATE club SET {column} = ? WHERE guild_id = ? AND club_prefix = ?",
+                                  (json.dumps(value), guild_id, club_prefix))
 
 
 async def fetch_checkpoint_role_data(guild_id: int, club_prefix: str):
-    return await data_management.fetch_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[9],
-                                             guild_id=guild_id,
-                                             club_prefix=club_prefix)
+    return await fetch_club_json_column(guild_id, club_prefix, "checkpoints_roles")
 
 
-async def write_checkpoint_role_data(guild_id: int, club_prefix: str, checkpoint_role_data: dict):
-    await data_management.update_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[9], checkpoint_role_data,
-                                       guild_id=guild_id,
-                                       club_prefix=club_prefix)
+async def write_checkpoint_role_data(guild_id: int, club_prefix: str, checkpoint_role_data: list):
+    await write_club_json_column(guild_id, club_prefix, "checkpoints_roles", checkpoint_role_data)
 
 
 async def fetch_banned_user_list(guild_id: int, club_prefix: str):
-    return await data_management.fetch_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[7],
-                                             guild_id=guild_id,
-                                             club_prefix=club_prefix)
+    return await fetch_club_json_column(guild_id, club_prefix, "banned_user_list")
 
 
 async def write_banned_user_list(guild_id: int, club_prefix: str, banned_users: list):
-    await data_management.update_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[7], banned_users,
-                                       guild_id=guild_id,
-                                       club_prefix=club_prefix)
+    await write_club_json_column(guild_id, club_prefix, "banned_user_list", banned_users)
 
 
 async def fetch_club_works_data(guild_id: int, club_prefix: str):
-    return await data_management.fetch_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[5],
-                                             guild_id=guild_id,
-                                             club_prefix=club_prefix)
+    """All works of a club as work_id: (work_name, beginning_period, end_period, additional_info)."""
+    work_rows = await data_management.fetch_rows("SELECT work_id, work_name, beginning_period, end_period, "
+                                                 "additional_info FROM club_work "
+                                                 "WHERE guild_id = ? AND club_prefix = ? ORDER BY rowid",
+                                                 (guild_id, club_prefix))
+    return {work_id: tuple(work_data) for work_id, *work_data in work_rows}
 
 
-async def write_clubs_works_data(guild_id: int, club_prefix: str, work_data: dict):
-    await data_management.update_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[5], work_data,
-                                       guild_id=guild_id,
-                                       club_prefix=club_prefix)
+async def fetch_club_work(guild_id: int, club_prefix: str, work_id: str):
+    """(work_name, beginning_period, end_period, additional_info) of one work or None."""
+    return await data_management.fetch_row("SELECT work_name, beginning_period, end_period, additional_info "
+                                           "FROM club_work WHERE guild_id = ? AND club_prefix = ? AND work_id = ?",
+                                           (guild_id, club_prefix, work_id))
 
 
-async def fetch_club_user_data(guild_id: int, club_prefix: str):
-    return await data_management.fetch_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[6],
-                                             guild_id=guild_id,
-                                             club_prefix=club_prefix)
+async def add_club_work(guild_id: int, club_prefix: str, work_id: str, work_data: tuple):
+    """Returns False if there already is a work with that ID."""
+    changed_rows = await data_management.execute("INSERT OR IGNORE INTO club_work VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                                  (guild_id, club_prefix, work_id, *work_data))
+    return changed_rows == 1
 
 
-async def write_club_user_data(guild_id: int, club_prefix: str, user_data: dict):
-    await data_management.update_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[6], user_data,
-                                       guild_id=guild_id,
-                                       club_prefix=club_prefix)
+async def remove_club_work(guild_id: int, club_prefix: str, work_id: str):
+    """Delete a work and all rewards for it."""
+    await data_management.execute_transaction([
+        ("DELETE FROM club_reward WHERE guild_id = ? AND club_prefix = ? AND work_id = ?",
+         (guild_id, club_prefix, work_id)),
+        ("DELETE FROM club_work WHERE guild_id = ? AND club_prefix = ? AND work_id = ?",
+         (guild_id, club_prefix, work_id))])
+
+
+async def fetch_club_user_data(guild_id: int, club_prefix: str):
+    """All rewards of a club as str(user_id): [(work_id, points)]."""
+    reward_rows = await data_management.fetch_rows("SELECT user_id, work_id, points FROM club_reward "
+                                                   "WHERE guild_id = ? AND club_prefix = ? ORDER BY rowid",
+                                                   (guild_id, club_prefix))
+    all_user_data = dict()
+    for user_id, work_id, points in reward_rows:
+        all_user_data.setdefault(str(user_id), list()).append((work_id, points))
+    return all_user_data
+
+
+async def fetch_user_rewards(guild_id: int, club_prefix: str, user_id: int):
+    """(work_id, points, work_name) for every work rewarded to a user, in the order they were rewarded."""
+    return await data_management.fetch_rows("SELECT club_reward.work_id, points, "
+                                            "coalesce(work_name, club_reward.work_id) FROM club_reward "
+                                            "LEFT JOIN club_work USING (guild_id, club_prefix, work_id) "
+                                            "WHERE guild_id = ? AND club_prefix = ? AND user_id = ? "
+                                            "ORDER BY club_reward.rowid",
+                                            (guild_id, club_prefix, user_id))
+
+
+async def add_reward(guild_id: int, club_prefix: str, user_id: int, work_id: str, points: int):
+    """Returns False if the user already has been rewarded for the work."""
+    changed_rows = await data_management.execute("INSERT OR IGNORE INTO club_reward VALUES (?, ?, ?, ?, ?)",
+                                                  (guild_id, club_prefix, user_id, work_id, points))
+    return changed_rows == 1
+
+
+async def remove_reward(guild_id: int, club_prefix: str, user_id: int, work_id: str):
+    """Returns the points of the deleted reward or None if the user did not have it."""
+    reward_row = await data_management.fetch_row("SELECT points FROM club_reward WHERE guild_id = ? "
+                                                 "AND club_prefix = ? AND user_id = ? AND work_id = ?",
+                                                 (guild_id, club_prefix, user_id, work_id))
+    if not reward_row:
+        return None
+    await data_management.execute("DELETE FROM club_reward WHERE guild_id = ? AND club_prefix = ? "
+                                  "AND user_id = ? AND work_id = ?",
+                                  (guild_id, club_prefix, user_id, work_id))
+    return reward_row[0]
+
+
+async def remove_user_rewards(guild_id: int, club_prefix: str, user_id: int):
+    await data_management.execute("DELETE FROM club_reward WHERE guild_id = ? AND club_prefix = ? AND user_id = ?",
+                                  (guild_id, club_prefix, user_id))
 
 
 async def fetch_club_prefix_list(guild_id: int):
-    club_prefix_list = await data_management.fetch_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[1], guild_id=guild_id)
-    return club_prefix_list
+    club_rows = await data_management.fetch_rows("SELECT club_prefix FROM club WHERE guild_id = ? ORDER BY rowid",
+                                                 (guild_id,))
+    return [club_prefix for club_prefix, in club_rows]
+
+
+class ClubStandings:
+    """Rewards of a club indexed by user and by work, with the users' total points kept sorted.
+
+    Every change only touches the users it affects, the leaderboard never has to re-sum rewards."""
+
+    def __init__(self, all_user_data: dict):
+        self.works_by_user = dict()
+        self.users_by_work = dict()
+        self.totals = dict()
+        for user_id, reward_user_data in all_user_data.items():
+            self.works_by_user[user_id] = dict(reward_user_data)
+            for work_id, points in reward_user_data:
+                self.users_by_work.setdefault(work_id, set()).add(user_id)
+            self.totals[user_id] = sum(self.works_by_user[user_id].values())
+        self.sorted_entries = sorted((-total_points, user_id) for user_id, total_points in self.totals.items())
+
+    def set_total(self, user_id: str, total_points: int):
+        self.remove_total(user_id)
+        self.totals[user_id] = total_points
+        insort(self.sorted_entries, (-total_points, user_id))
+
+    def remove_total(self, user_id: str):
+        if user_id not in self.totals:
+            return
+        entry_index = bisect_left(self.sorted_entries, (-self.totals.pop(user_id), user_id))
+        del self.sorted_entries[entry_index]
+
+    def add_reward(self, user_id: str, work_id: str, points: int):
+        self.works_by_user.setdefault(user_id, dict())[work_id] = points
+        self.users_by_work.setdefault(work_id, set()).add(user_id)
+        self.set_total(user_id, self.totals.get(user_id, 0) + points)
+
+    def remove_reward(self, user_id: str, work_id: str):
+        user_works = self.works_by_user.get(user_id, dict())
+        if work_id not in user_works:
+            return
+        points = user_works.pop(work_id)
+        work_users = self.users_by_work.get(work_id, set())
+        work_users.discard(user_id)
+        if not work_users:
+            self.users_by_work.pop(work_id, None)
+        if user_works:
+            self.set_total(user_id, self.totals[user_id] - points)
+        else:
+            self.works_by_user.pop(user_id)
+            self.remove_total(user_id)
+
+    def remove_work(self, work_id: str):
+        for user_id in list(self.users_by_work.get(work_id, set())):
+            self.remove_reward(user_id, work_id)
+
+    def remove_user(self, user_id: str):
+        for work_id in list(self.works_by_user.get(user_id, dict())):
+            self.remove_reward(user_id, work_id)
+
+    def work_user_ids(self, work_id: str):
+        return self.users_by_work.get(work_id, set())
+
+    def ranked_users(self):
+        """Yield (user_id, total_points) from the highest total to the lowest."""
+        for negative_points, user_id in self.sorted_entries:
+            yield user_id, -negative_points
+
+
+club_standings = dict()
+
+
+async def fetch_club_standings(guild_id: int, club_prefix: str):
+    standings = club_standings.get((guild_id, club_prefix))
+    if standings is None:
+        standings = ClubStandings(await fetch_club_user_data(guild_id, club_prefix))
+        club_standings[(guild_id, club_prefix)] = standings
+    return standings
+
+
+class ClubWorkIndex:
+    """Works of a club with lowercased IDs and names for autocomplete.
+
+    Prefix matches come first and are found by binary search over the sorted IDs and names, substring matches fill
+    up the rest."""
+
+    def __init__(self, all_work_data: dict):
+        self.work_names = dict()
+        self.periods = dict()
+        self.lowered_keys = dict()
+        sorted_keys = []
+        for work_id, (work_name, beginning_period, end_period, additional_info) in all_work_data.items():
+            self.work_names[work_id] = work_name
+            self.periods[work_id] = f"{beginning_period}-{end_period}"
+            self.lowered_keys[work_id] = (work_id.lower(), work_name.lower())
+            sorted_keys.extend((lowered_key, work_id) for lowered_key in self.lowered_keys[work_id])
+        self.sorted_keys = sorted(sorted_keys)
+
+    def matches(self, work_id: str, lowered_input: str):
+        return any(lowered_input in lowered_key for lowered_key in self.lowered_keys.get(work_id, (work_id.lower(),)))
+
+    def matching_work_ids(self, current_input: str, limit: int):
+        lowered_input = current_input.lower()
+        work_ids = dict()
+        key_index = bisect_left(self.sorted_keys, (lowered_input, ""))
+        while key_index < len(self.sorted_keys) and len(work_ids) < limit:
+            lowered_key, work_id = self.sorted_keys[key_index]
+            if not lowered_key.startswith(lowered_input):
+                break
+            work_ids[work_id] = None
+            key_index += 1
+        for work_id in self.work_names:
+            if len(work_ids) >= limit:
+                break
+            if work_id not in work_ids and self.matches(work_id, lowered_input):
+                work_ids[work_id] = None
+        return list(work_ids)
+
+
+club_work_indexes = dict()
+
+
+async def fetch_club_work_index(guild_id: int, club_prefix: str):
+    work_index = club_work_indexes.get((guild_id, club_prefix))
+    if work_index is None:
+        work_index = ClubWorkIndex(await fetch_club_works_data(guild_id, club_prefix))
+        club_work_indexes[(guild_id, club_prefix)] = work_index
+    return work_index
+
+
+def invalidate_club_work_index(guild_id: int, club_prefix: str):
+    club_work_indexes.pop((guild_id, club_prefix), None)
 
 
 #########################################
@@ -130,17 +381,16 @@ async def time_period_autocomplete(interaction: discord.Interaction, current_inp
 
 async def works_autocomplete(interaction: discord.Interaction, current_input: str):
     challenge_prefix = interaction.command.name.split("_")[0]
-    work_data = await fetch_club_works_data(interaction.guild_id, challenge_prefix)
+    work_index = await fetch_club_work_index(interaction.guild_id, challenge_prefix)
 
     possible_choices = []
-    for short_id in work_data:
-        full_name = work_data[short_id][0]
-        relevant_period = work_data[short_id][1] + "-" + work_data[short_id][2]
-
-        if current_input.lower() in short_id.lower() or current_input.lower() in full_name.lower():
-            possible_choices.append(discord.app_commands.Choice(name=f"{short_id} ({relevant_period})", value=short_id))
-            possible_choices.append(
-                discord.app_commands.Choice(name=f"{full_name} ({relevant_period})", value=short_id))
+    # Every work is offered by its ID and by its full name.
+    for short_id in work_index.matching_work_ids(current_input, 13):
+        full_name = work_index.work_names[short_id]
+        relevant_period = work_index.periods[short_id]
+        possible_choices.append(discord.app_commands.Choice(name=f"{short_id} ({relevant_period})", value=short_id))
+        possible_choices.append(
+            discord.app_commands.Choice(name=f"{full_name} ({relevant_period})", value=short_id))
 
     return possible_choices[0:25]
 
@@ -148,13 +398,15 @@ async def works_autocomplete(interaction: discord.Interaction, current_input: st
 async def user_works_autocomplete(interaction: discord.Interaction, current_input: str):
     challenge_prefix = interaction.command.name.split("_")[0]
     member = interaction.namespace.member
-    all_user_data = await fetch_club_user_data(interaction.guild_id, challenge_prefix)
-    work_data = await fetch_club_works_data(interaction.guild_id, challenge_prefix)
-    reward_user_data = all_user_data.get(str(member.id), list())
+    if not member:
+        return []
+    standings = await fetch_club_standings(interaction.guild_id, challenge_prefix)
+    work_index = await fetch_club_work_index(interaction.guild_id, challenge_prefix)
+    lowered_input = current_input.lower()
     possible_choices = []
-    for work_id, points in reward_user_data:
-        work_name, beginning_period, end_period, additional_info = work_data[work_id]
-        if current_input.lower() in work_name.lower() or current_input.lower() in work_id.lower():
+    for work_id, points in standings.works_by_user.get(str(member.id), dict()).items():
+        if work_index.matches(work_id, lowered_input):
+            work_name = work_index.work_names.get(work_id, work_id)
             possible_choices.append(discord.app_commands.Choice(name=f"{work_name} ({points} Points)", value=work_id))
 
     return possible_choices[0:25]
@@ -164,149 +416,210 @@ async def user_works_autocomplete(interaction: discord.Interaction, current_inpu
 
 # Other functions
 
-async def generate_leaderboard_embeds(bot, all_user_data, guild, club_name):
+FIELD_CHARACTER_LIMIT = 1000
+EMBED_CHARACTER_LIMIT = 5000
+FIELD_NAME = "---"
+
+
+def generate_field_embeds(title: str, lines):
+    """Pack lines into fields of up to 1000 characters and the fields into embeds of about 5000 characters.
+
+    Lengths are tracked with running counters, so each line is only looked at once."""
     embeds_to_send = []
-    sorted_ids = sorted(all_user_data, key=lambda key: sum(entry[1] for entry in all_user_data[key]), reverse=True)
+    embed = discord.Embed(title=title)
+    embed_length = len(title)
+    field_lines = []
+    field_length = 0
+
+    def add_field():
+        nonlocal embed, embed_length
+        if embed_length >= EMBED_CHARACTER_LIMIT:
+            embeds_to_send.append(embed)
+            embed = discord.Embed(title=title)
+            embed_length = len(title)
+        embed.add_field(name=FIELD_NAME, value="\n".join(field_lines), inline=False)
+        embed_length += len(FIELD_NAME) + field_length
+
+    for line in lines:
+        added_length = len(line) + 1 if field_lines else len(line)
+        if field_lines and field_length + added_length > FIELD_CHARACTER_LIMIT:
+            add_field()
+            field_lines = [line]
+            field_length = len(line)
+        else:
+            field_lines.append(line)
+            field_length += added_length
+
+    if field_lines:
+        add_field()
+    embeds_to_send.append(embed)
+    return embeds_to_send
+
 
-    leaderboard_embed = discord.Embed(title=f"{club_name} Leaderboard")
-    leaderboard_description_strings = []
-    for index, user_id in enumerate(sorted_ids):
+async def generate_leaderboard_embeds(bot, standings: ClubStandings, guild, club_name):
+    leaderboard_lines = []
+    for index, (user_id, member_points) in enumerate(standings.ranked_users()):
         member = guild.get_member(int(user_id))
-        member_points = sum(entry[1] for entry in all_user_data[user_id])
         if not member:
             user_name = await user_name_record.fetch_user_name(bot, int(user_id))
-            leaderboard_description_strings.append(f"{index + 1}. <{user_name}> {member_points}点")
+            leaderboard_lines.append(f"{index + 1}. <{user_name}> {member_points}点")
         else:
-            leaderboard_description_strings.append(f"{index + 1}. {member.mention} {member_points}点")
-
-        if len("\n".join(leaderboard_description_strings)) > 1000:
-            current_member_line = leaderboard_description_strings.pop()
-
-            if len(leaderboard_embed) < 5000:
-                leaderboard_embed.add_field(name="---", value="\n".join(leaderboard_description_strings), inline=False)
-                leaderboard_description_strings = [current_member_line]
-            else:
-                embeds_to_send.append(leaderboard_embed)
-                leaderboard_embed = discord.Embed(title=f"{club_name} Leaderboard")
-                leaderboard_embed.add_field(name="---", value="\n".join(leaderboard_description_strings), inline=False)
-                leaderboard_description_strings = [current_member_line]
-
-    if leaderboard_description_strings:
-        if len(leaderboard_embed) < 5000:
-            leaderboard_embed.add_field(name="---", value="\n".join(leaderboard_description_strings), inline=False)
-        else:
-            embeds_to_send.append(leaderboard_embed)
-            leaderboard_embed = discord.Embed(title=f"{club_name} Leaderboard")
-            leaderboard_embed.add_field(name="---", value="\n".join(leaderboard_description_strings), inline=False)
-
-    embeds_to_send.append(leaderboard_embed)
+            leaderboard_lines.append(f"{index + 1}. {member.mention} {member_points}点")
 
-    return embeds_to_send
+    return generate_field_embeds(f"{club_name} Leaderboard", leaderboard_lines)
 
 
 async def generate_works_embeds(all_work_data, club_name):
-    embeds_to_send = []
     sorted_ids = sorted(all_work_data, key=lambda key: all_work_data[key][1])
 
-    works_embed = discord.Embed(title=f"{club_name} Past Works")
-    history_strings = []
+    history_lines = []
     for index, work_id in enumerate(sorted_ids):
         work_name, start_date, end_date, extra_info = all_work_data[work_id]
         if start_date == end_date:
-            history_strings.append(f"{index + 1}. **{start_date}** `{work_name}` {extra_info} | ID: `{work_id}`")
+            history_lines.append(f"{index + 1}. **{start_date}** `{work_name}` {extra_info} | ID: `{work_id}`")
         else:
-            history_strings.append(
+            history_lines.append(
                 f"{index + 1}. **{start_date}-{end_date}** `{work_name}` {extra_info} | ID: `{work_id}`")
 
-        if len("\n".join(history_strings)) > 1000:
-            current_work_line = history_strings.pop()
-
-            if len(works_embed) < 5000:
-                works_embed.add_field(name="---", value="\n".join(history_strings), inline=False)
-                history_strings = [current_work_line]
-            else:
-                embeds_to_send.append(works_embed)
-                works_embed = discord.Embed(title=f"{club_name} Past Works")
-                works_embed.add_field(name="---", value="\n".join(history_strings), inline=False)
-                history_strings = [current_work_line]
-
-    if history_strings:
-        if len(works_embed) < 5000:
-            works_embed.add_field(name="---", value="\n".join(history_strings), inline=False)
-        else:
-            embeds_to_send.append(works_embed)
-            works_embed = discord.Embed(title=f"{club_name} Past Works")
-            works_embed.add_field(name="---", value="\n".join(history_strings), inline=False)
+    return generate_field_embeds(f"{club_name} Past Works", history_lines)
 
-    embeds_to_send.append(works_embed)
 
-    return embeds_to_send
+ROLE_EDIT_INTERVAL_SECONDS = 1
+ROLE_CREATE_INTERVAL_SECONDS = 5
 
 
-async def give_out_reward_roles(guild: discord.Guild, club_prefix: str):
-    club_name, club_manager_role_name, club_channel_name, reward_role_suffix = await fetch_club_data(guild.id,
-                                                                                                     club_prefix)
-    all_user_data = await fetch_club_user_data(guild.id, club_prefix)
-    for member_id in all_user_data:
-        member = guild.get_member(int(member_id))
+def checkpoint_role_name_for(sorted_checkpoint_role_data: list, total_points: int):
+    role_name_to_give = None
+    for role_name, needed_points in sorted_checkpoint_role_data:
+        if total_points >= needed_points:
+            role_name_to_give = role_name
+    return role_name_to_give
+
+
+def wanted_club_role_names(guild: discord.Guild, standings: ClubStandings, reward_role_suffix: str,
+                           checkpoint_role_data: list):
+    """Names of the reward and checkpoint role every club member on the server should have.
+
+    Members without points are left out, their roles are not touched."""
+    sorted_checkpoint_role_data = sorted(checkpoint_role_data, key=lambda item: item[1])
+    wanted_role_names = dict()
+    for user_id, total_points in standings.totals.items():
+        member = guild.get_member(int(user_id))
+        if not member or total_points == 0:
+            continue
+        member_role_names = set()
+        if reward_role_suffix:
+            member_role_names.add(f"{total_points}{reward_role_suffix}")
+        checkpoint_role_name = checkpoint_role_name_for(sorted_checkpoint_role_data, total_points)
+        if checkpoint_role_name:
+            member_role_names.add(checkpoint_role_name)
+        wanted_role_names[member] = member_role_names
+    return wanted_role_names
+
+
+class ClubRolePlan:
+    """Club roles each member should end up with. Roles that are not club roles are never part of the plan."""
+
+    def __init__(self, reward_role_suffix: str, checkpoint_role_names: set):
+        self.reward_role_suffix = reward_role_suffix
+        self.checkpoint_role_names = checkpoint_role_names
+        self.club_roles = dict()
+
+    def is_club_role(self, role: discord.Role):
+        if role.name in self.checkpoint_role_names:
+            return True
+        return bool(self.reward_role_suffix) and role.name.endswith(self.reward_role_suffix)
+
+    def new_roles_for(self, member: discord.Member):
+        """Roles of the member as they are right now with only the club roles swapped, None if nothing changes."""
+        current_roles = [role for role in member.roles if not role.is_default()]
+        new_roles = [role for role in current_roles if not self.is_club_role(role)] + self.club_roles[member.id]
+        if set(new_roles) == set(current_roles):
+            return None
+        return new_roles
+
+
+def plan_role_changes(guild: discord.Guild, wanted_role_names: dict, reward_role_suffix: str,
+                      checkpoint_role_names: set, created_roles: list):
+    """Club roles for the members whose club roles differ from the wanted ones.
+
+    Roles that were just created are passed in, they only show up in guild.roles once Discord sends the event."""
+    roles_by_name = {role.name: role for role in guild.roles}
+    roles_by_name.update((role.name, role) for role in created_roles)
+
+    role_plan = ClubRolePlan(reward_role_suffix, checkpoint_role_names)
+    for member, member_role_names in wanted_role_names.items():
+        role_plan.club_roles[member.id] = [roles_by_name[role_name] for role_name in member_role_names
+                                           if role_name in roles_by_name]
+        if role_plan.new_roles_for(member) is None:
+            del role_plan.club_roles[member.id]
+    return role_plan
+
+
+async def apply_role_changes(guild: discord.Guild, role_plan: ClubRolePlan, reason: str):
+    """Edit the roles of one member after the other, each with a single request.
+
+    Every member is looked up again right before the edit, so roles given or taken by others while the edits are
+    running are kept. Returns the applied role lists of the edited members."""
+    applied_roles = dict()
+    for member_id in role_plan.club_roles:
+        member = guild.get_member(member_id)
         if not member:
             continue
-        total_points = sum([reward_data[1] for reward_data in all_user_data[member_id]])
-        if total_points == 0:
+        new_roles = role_plan.new_roles_for(member)
+        if new_roles is None:
             continue
-        role_name = f"{total_points}{reward_role_suffix}"
-        reward_role = discord.utils.get(guild.roles, name=role_name)
-        if not reward_role:
-            print(f"CLUBS: Creating nonexistent role {role_name}")
-            await asyncio.sleep(5)
-            reward_role = await guild.create_role(name=role_name, colour=discord.Colour.dark_grey())
-        other_reward_roles = [role for role in guild.roles if role.name.endswith(reward_role_suffix) and role is
-                              not reward_role]
-        if reward_role in member.roles:
+        try:
+            await member.edit(roles=new_roles, reason=reason)
+        except discord.HTTPException as error:
+            print(f"CLUBS: Unable to update the roles of {member}: {error}")
             continue
-        else:
-            await asyncio.sleep(5)
-            await member.remove_roles(*other_reward_roles)
-            print(f"CLUBS: Giving {member} the {reward_role.name} role for the {club_name}")
-            await asyncio.sleep(5)
-            await member.add_roles(reward_role)
-
-    # Role cleanup
-    roles_to_delete = [role for role in guild.roles if
-                       role.name.endswith(reward_role_suffix) and len(role.members) == 0]
-    for role in roles_to_delete:
-        print(f"Deleting role {role.name} as it has no members.")
-        await asyncio.sleep(5)
-        await role.delete(reason="No members for role.")
-
-
-async def give_out_checkpoint_roles(guild: discord.Guild, club_prefix):
-    all_user_data = await fetch_club_user_data(guild.id, club_prefix)
+        applied_roles[member] = new_roles
+        await asyncio.sleep(ROLE_EDIT_INTERVAL_SECONDS)
+    return applied_roles
+
+
+async def update_club_roles(guild: discord.Guild, club_prefix: str):
+    """Give every club member the reward role for their points and their checkpoint role, removing outdated ones.
+
+    Running it again without point changes does nothing. Returns the number of members whose roles were changed."""
+    club_name, club_manager_role_name, club_channel_name, reward_role_suffix = await fetch_club_data(guild.id,
+                                                                                                     club_prefix)
+    standings = await fetch_club_standings(guild.id, club_prefix)
     checkpoint_role_data = await fetch_checkpoint_role_data(guild.id, club_prefix)
-    all_checkpoint_roles = [discord.utils.get(role_data[0]) for role_data in checkpoint_role_data]
-    if not checkpoint_role_data:
-        return
-    sorted_checkpoint_role_data = sorted(checkpoint_role_data, key=lambda item: item[1])
-    for user_id in all_user_data:
-        member = guild.get_member(int(user_id))
-        if not member:
-            continue
-        total_points = sum([reward_data[1] for reward_data in all_user_data[user_id]])
-        role_name_to_give = None
-        for role_name, needed_points in sorted_checkpoint_role_data:
-            if total_points >= needed_points:
-                role_name_to_give = role_name
-        if role_name_to_give:
-            checkpoint_role = discord.utils.get(guild.roles, name=role_name_to_give)
-            if not checkpoint_role:
-                continue
-            if checkpoint_role in member.roles:
-                continue
-            print(f"CLUBS: Giving {checkpoint_role.name} to {member}")
-            await asyncio.sleep(5)
-            await member.remove_roles(*all_checkpoint_roles)
-            await asyncio.sleep(5)
-            await member.add_roles(checkpoint_role)
+    checkpoint_role_names = {role_name for role_name, needed_points in checkpoint_role_data}
+    wanted_role_names = wanted_club_role_names(guild, standings, reward_role_suffix, checkpoint_role_data)
+
+    # All missing reward roles are created up front, checkpoint roles have to be created by hand.
+    existing_role_names = {role.name for role in guild.roles}
+    missing_role_names = {role_name for member_role_names in wanted_role_names.values()
+                          for role_name in member_role_names
+                          if role_name not in existing_role_names and role_name not in checkpoint_role_names}
+    created_roles = []
+    for role_name in sorted(missing_role_names):
+        print(f"CLUBS: Creating nonexistent role {role_name}")
+        created_roles.append(await guild.create_role(name=role_name, colour=discord.Colour.dark_grey()))
+        await asyncio.sleep(ROLE_CREATE_INTERVAL_SECONDS)
+
+    role_plan = plan_role_changes(guild, wanted_role_names, reward_role_suffix, checkpoint_role_names,
+                                  created_roles)
+    applied_roles = await apply_role_changes(guild, role_plan, f"{club_name} points")
+    print(f"CLUBS: Changed the roles of {len(applied_roles)} of {len(role_plan.club_roles)} members "
+          f"for the {club_name}")
+
+    # Role cleanup, based on the applied roles since the member cache only catches up once Discord confirms the edits.
+    if reward_role_suffix:
+        used_roles = set()
+        for member in guild.members:
+            used_roles.update(applied_roles.get(member, member.roles))
+        roles_to_delete = [role for role in guild.roles
+                           if role.name.endswith(reward_role_suffix) and role not in used_roles]
+        for role in roles_to_delete:
+            print(f"Deleting role {role.name} as it has no members.")
+            await asyncio.sleep(ROLE_CREATE_INTERVAL_SECONDS)
+            await role.delete(reason="No members for role.")
+
+    return len(applied_roles)
 
 
 #########################################
@@ -335,9 +648,11 @@ class ToggleBanCommand(discord.app_commands.Command):
             await write_banned_user_list(interaction.guild_id, self.challenge_prefix, banned_ids)
 
             # Delete member data
-            all_user_data = await fetch_club_user_data(interaction.guild_id, self.challenge_prefix)
-            banned_user_data = all_user_data.pop(str(member.id))
-            await write_club_user_data(interaction.guild_id, self.challenge_prefix, all_user_data)
+            user_rewards = await fetch_user_rewards(interaction.guild_id, self.challenge_prefix, member.id)
+            banned_user_data = [(work_id, points) for work_id, points, work_name in user_rewards]
+            await remove_user_rewards(interaction.guild_id, self.challenge_prefix, member.id)
+            standings = await fetch_club_standings(interaction.guild_id, self.challenge_prefix)
+            standings.remove_user(str(member.id))
 
             await interaction.response.send_message(f"Banned {member} from the {self.challenge_name} and deleted their "
                                                     f"scores! Cleared user data: `{json.dumps(banned_user_data)}`")
@@ -369,13 +684,13 @@ class AddWorkToChallenge(discord.app_commands.Command):
     @discord.app_commands.default_permissions(administrator=True)
     async def add_work(self, interaction: discord.Interaction, work_name: str, short_id: str, beginning_period: str,
                        end_period: str, additional_info: str):
-        work_data = await fetch_club_works_data(interaction.guild_id, self.challenge_prefix)
-        if short_id in work_data:
+        work_added = await add_club_work(interaction.guild_id, self.challenge_prefix, short_id,
+                                         (work_name, beginning_period, end_period, additional_info))
+        if not work_added:
             await interaction.response.send_message("There is a work registered under that ID already. Delete it to add"
                                                     " a new one first.")
             return
-        work_data[short_id] = (work_name, beginning_period, end_period, additional_info)
-        await write_clubs_works_data(interaction.guild_id, self.challenge_prefix, work_data)
+        invalidate_club_work_index(interaction.guild_id, self.challenge_prefix)
         await interaction.response.send_message(f"Added `{work_name}` for the time period "
                                                 f"`{beginning_period}` to `{end_period}` with the unique ID "
                                                 f"`{short_id}` to the `{self.challenge_name}`.")
@@ -396,21 +711,16 @@ class RemoveWorkFromChallenge(discord.app_commands.Command):
     @discord.app_commands.autocomplete(work_id=works_autocomplete)
     @discord.app_commands.default_permissions(administrator=True)
     async def remove_work(self, interaction: discord.Interaction, work_id: str):
-        work_data = await fetch_club_works_data(interaction.guild_id, self.challenge_prefix)
-        if work_id not in work_data:
+        work_row = await fetch_club_work(interaction.guild_id, self.challenge_prefix, work_id)
+        if not work_row:
             await interaction.response.send_message("Unable to find work. Exiting...")
             return
 
-        work_name, beginning_period, end_period, additional_info = work_data.pop(work_id)
-        await write_clubs_works_data(interaction.guild_id, self.challenge_prefix, work_data)
-
-        all_user_data = await fetch_club_user_data(interaction.guild_id, self.challenge_prefix)
-
-        for user_id in all_user_data:
-            user_work_data = all_user_data[user_id]
-            all_user_data[user_id] = [work for work in user_work_data if work[0] != work_id]
-
-        await write_club_user_data(interaction.guild_id, self.challenge_prefix, all_user_data)
+        work_name, beginning_period, end_period, additional_info = work_row
+        standings = await fetch_club_standings(interaction.guild_id, self.challenge_prefix)
+        await remove_club_work(interaction.guild_id, self.challenge_prefix, work_id)
+        standings.remove_work(work_id)
+        invalidate_club_work_index(interaction.guild_id, self.challenge_prefix)
 
         await interaction.response.send_message(f"{interaction.user.mention} "
                                                 f"Removed `{work_name}` for the time period `{beginning_period}` to"
@@ -446,26 +756,22 @@ class RewardWorkToUser(discord.app_commands.Command):
             await interaction.response.send_message(f"User `{member}` is banned from the {self.challenge_name}!")
             return
 
-        all_user_data = await fetch_club_user_data(interaction.guild_id, self.challenge_prefix)
-        work_data = await fetch_club_works_data(interaction.guild_id, self.challenge_prefix)
-        if work_id not in work_data:
+        work_row = await fetch_club_work(interaction.guild_id, self.challenge_prefix, work_id)
+        if not work_row:
             await interaction.response.send_message(f"Unable to find work. Exiting.")
             return
-        work_name, beginning_period, end_period, additional_info = work_data[work_id]
-
-        reward_user_data = all_user_data.get(str(member.id), list())
-        for reward_data in reward_user_data:
-            if reward_data[0] == work_id:
-                await interaction.response.send_message(f"User `{member}` has already been rewarded for `{work_name}`. "
-                                                        f"Remove it from them first to reward it again.")
-                return
-
-        old_total_points = sum([reward_data[1] for reward_data in reward_user_data])
-        reward_tuple = (work_id, points)
-        reward_user_data.append(reward_tuple)
-        all_user_data[str(member.id)] = reward_user_data
-        await write_club_user_data(interaction.guild_id, self.challenge_prefix, all_user_data)
-        new_total_points = sum([reward_data[1] for reward_data in reward_user_data])
+        work_name, beginning_period, end_period, additional_info = work_row
+
+        standings = await fetch_club_standings(interaction.guild_id, self.challenge_prefix)
+        rewarded = await add_reward(interaction.guild_id, self.challenge_prefix, member.id, work_id, points)
+        if not rewarded:
+            await interaction.response.send_message(f"User `{member}` has already been rewarded for `{work_name}`. "
+                                                    f"Remove it from them first to reward it again.")
+            return
+
+        old_total_points = standings.totals.get(str(member.id), 0)
+        standings.add_reward(str(member.id), work_id, points)
+        new_total_points = standings.totals[str(member.id)]
         await interaction.response.send_message(
             f"Rewarded `{work_name}` to `{str(member)}` bringing their total points "
             f"from **{old_total_points}** to **{new_total_points}**")
@@ -487,18 +793,19 @@ class UnrewardWorkFromUser(discord.app_commands.Command):
     @discord.app_commands.autocomplete(work_id=user_works_autocomplete)
     @discord.app_commands.default_permissions(administrator=True)
     async def unreward_work(self, interaction: discord.Interaction, member: discord.Member, work_id: str):
-        all_user_data = await fetch_club_user_data(interaction.guild_id, self.challenge_prefix)
-        unreward_user_data = all_user_data.get(str(member.id), list())
-        old_total_points = sum([reward_data[1] for reward_data in unreward_user_data])
-        for reward_data in unreward_user_data[:]:
-            if work_id == reward_data[0]:
-                unreward_user_data.remove(reward_data)
-                all_user_data[str(member.id)] = unreward_user_data
-                new_total_points = sum(reward_data[1] for reward_data in unreward_user_data)
-                await write_club_user_data(interaction.guild_id, self.challenge_prefix, all_user_data)
-                await interaction.response.send_message(f"Removed work with the ID `{work_id}` from `{str(member)}`"
-                                                        f" bringing their total points from **{old_total_points}** to"
-                                                        f" **{new_total_points}**.")
+        standings = await fetch_club_standings(interaction.guild_id, self.challenge_prefix)
+        removed_points = await remove_reward(interaction.guild_id, self.challenge_prefix, member.id, work_id)
+        if removed_points is None:
+            await interaction.response.send_message(f"User `{member}` has not been rewarded for a work with the ID "
+                                                    f"`{work_id}`.")
+            return
+
+        old_total_points = standings.totals.get(str(member.id), removed_points)
+        standings.remove_reward(str(member.id), work_id)
+        new_total_points = standings.totals.get(str(member.id), 0)
+        await interaction.response.send_message(f"Removed work with the ID `{work_id}` from `{str(member)}`"
+                                                f" bringing their total points from **{old_total_points}** to"
+                                                f" **{new_total_points}**.")
 
 
 class PrintOutLeaderboard(discord.app_commands.Command):
@@ -514,9 +821,9 @@ class PrintOutLeaderboard(discord.app_commands.Command):
 
     @discord.app_commands.default_permissions(send_messages=True)
     async def leaderboard(self, interaction: discord.Interaction):
-        all_user_data = await fetch_club_user_data(interaction.guild_id, self.challenge_prefix)
+        standings = await fetch_club_standings(interaction.guild_id, self.challenge_prefix)
         await interaction.response.defer()
-        embeds_to_send = await generate_leaderboard_embeds(self.bot, all_user_data, interaction.guild,
+        embeds_to_send = await generate_leaderboard_embeds(self.bot, standings, interaction.guild,
                                                            self.challenge_name)
         await interaction.edit_original_response(embed=embeds_to_send[0],
                                                  allowed_mentions=discord.AllowedMentions.none())
@@ -564,23 +871,21 @@ class PrintOutListOfUserWithWork(discord.app_commands.Command):
     @discord.app_commands.describe(work_id="The name or the id of the work.")
     @discord.app_commands.autocomplete(work_id=works_autocomplete)
     async def get_work_users(self, interaction: discord.Interaction, work_id: str):
-        work_data = await fetch_club_works_data(interaction.guild_id, self.challenge_prefix)
-        all_user_data = await fetch_club_user_data(interaction.guild_id, self.challenge_prefix)
-
-        if work_id not in work_data:
+        work_row = await fetch_club_work(interaction.guild_id, self.challenge_prefix, work_id)
+        if not work_row:
             await interaction.response.send_message("Unknown work. Exiting...",
                                                     ephemeral=True,
                                                     allowed_mentions=discord.AllowedMentions.none())
             return
 
-        work_name, beginning_period, end_period, additional_info = work_data[work_id]
+        work_name, beginning_period, end_period, additional_info = work_row
         read_users_strings = []
-        for user_id in all_user_data:
+        standings = await fetch_club_standings(interaction.guild_id, self.challenge_prefix)
+        for user_id in standings.work_user_ids(work_id):
             member = interaction.guild.get_member(int(user_id))
             if not member:
                 continue
-            if work_id in [read_data[0] for read_data in all_user_data[user_id]]:
-                read_users_strings.append(f"{member} {member.mention}")
+            read_users_strings.append(f"{member} {member.mention}")
 
         read_users_embed = discord.Embed(title=f"{len(read_users_strings)} users for {work_name}. "
                                                f"Unlisted users have left the server.")
@@ -605,16 +910,13 @@ class PrintOutListOfWorksForUser(discord.app_commands.Command):
     @discord.app_commands.default_permissions(send_messages=True)
     @discord.app_commands.describe(member="Member you want to get works for")
     async def get_users_work(self, interaction: discord.Interaction, member: discord.Member):
-        work_data = await fetch_club_works_data(interaction.guild_id, self.challenge_prefix)
-        all_user_data = await fetch_club_user_data(interaction.guild_id, self.challenge_prefix)
-
-        if str(member.id) not in all_user_data:
+        user_rewards = await fetch_user_rewards(interaction.guild_id, self.challenge_prefix, member.id)
+        if not user_rewards:
             await interaction.response.send_message("User not found in data. Exiting...")
             return
 
         work_strings = []
-        for work_id, points in all_user_data[str(member.id)]:
-            work_name, beginning_period, end_period, additional_info = work_data[work_id]
+        for work_id, points, work_name in user_rewards:
             work_string = f"{work_name} (**{work_id}**) with {points} points."
             work_strings.append(work_string)
 
@@ -632,7 +934,8 @@ class Clubs(commands.Cog):
         self.bot = bot
 
     async def cog_load(self):
-        await data_management.create_table(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS)
+        await data_management.create_schema(CLUB_SCHEMA)
+        await migrate_legacy_clubs()
         for guild in self.bot.guilds:
             await self.add_slash_commands(guild)
         self.club_updates.start()
@@ -684,23 +987,9 @@ class Clubs(commands.Cog):
         if not club_channel:
             return
 
-        past_leaderboard_pins = [pin for pin in await club_channel.pins()
-                                 if pin.embeds and pin.embeds[0].title.endswith("Leaderboard")
-                                 and pin.author.id == self.bot.user.id]
-
-        all_user_data = await fetch_club_user_data(guild.id, club_prefix)
-        leaderboard_embeds = await generate_leaderboard_embeds(self.bot, all_user_data, guild, club_name)
-        for index, embed in enumerate(leaderboard_embeds):
-            try:
-                to_edit_message = past_leaderboard_pins[index]
-            except IndexError:
-                print(f"CLUBS: Creating new leaderboard message for {club_name}")
-                await asyncio.sleep(10)
-                to_edit_message = await club_channel.send(embed=discord.Embed(title=f"{club_name} Leaderboard"))
-                await to_edit_message.pin()
-            print(f"CLUBS: Editing leaderboard message for {club_name}")
-            await asyncio.sleep(10)
-            await to_edit_message.edit(embed=embed)
+        standings = await fetch_club_standings(guild.id, club_prefix)
+        leaderboard_embeds = await generate_leaderboard_embeds(self.bot, standings, guild, club_name)
+        await self.render_club_board(club_channel, f"{club_name} Leaderboard", leaderboard_embeds)
 
     async def update_past_works_pins(self, guild: discord.Guild, club_prefix):
         club_name, club_manager_role_name, club_channel_name, reward_role_suffix = await fetch_club_data(guild.id,
@@ -710,23 +999,16 @@ class Clubs(commands.Cog):
         if not club_channel:
             return
 
-        past_leaderboard_pins = [pin for pin in await club_channel.pins()
-                                 if pin.embeds and pin.embeds[0].title.endswith("Past Works")
-                                 and pin.author.id == self.bot.user.id]
-
         all_works_data = await fetch_club_works_data(guild.id, club_prefix)
         works_embeds = await generate_works_embeds(all_works_data, club_name)
-        for index, embed in enumerate(works_embeds):
-            try:
-                to_edit_message = past_leaderboard_pins[index]
-            except IndexError:
-                print(f"CLUBS: Creating new past works message for {club_name}")
-                await asyncio.sleep(10)
-                to_edit_message = await club_channel.send(embed=discord.Embed(title=f"{club_name} Past Works"))
-                await to_edit_message.pin()
-            print(f"CLUBS: Editing past works message for {club_name}")
-            await asyncio.sleep(10)
-            await to_edit_message.edit(embed=embed)
+        await self.render_club_board(club_channel, f"{club_name} Past Works", works_embeds)
+
+    async def render_club_board(self, club_channel: discord.TextChannel, board_title: str, embeds: list):
+        def is_board_pin(pin: discord.Message):
+            return pin.author.id == self.bot.user.id and pin.embeds and pin.embeds[0].title == board_title
+
+        await pinned_boards.render(club_channel, board_title, is_board_pin, embeds,
+                                   placeholder_embed=discord.Embed(title=board_title), edit_delay=10)
 
     @tasks.loop(minutes=10)
     async def club_updates(self):
@@ -736,10 +1018,7 @@ class Clubs(commands.Cog):
             for club_prefix in club_prefixes:
                 await self.update_leaderboard_pins(guild, club_prefix)
                 await self.update_past_works_pins(guild, club_prefix)
-                await give_out_reward_roles(guild, club_prefix)
-                await give_out_checkpoint_roles(guild, club_prefix)
-
-    # TODO: Add function that removes checkpoint roles if user loses points
+                await update_club_roles(guild, club_prefix)
 
 
 async def setup(bot):
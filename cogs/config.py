@@ -5,6 +5,8 @@ import pkgutil
 import discord
 from discord.ext import commands
 
+from . import message_router
+
 OWNER_ID = int(pkgutil.get_data(__package__, "config/owner_id.txt").decode())
 
 
@@ -55,6 +57,12 @@ class Config(commands.Cog):
         await self.bot.tree.sync()
         await ctx.send("Cleared global commands.")
 
+    @commands.command()
+    @commands.is_owner()
+    async def message_router_stats(self, ctx):
+        """Show how often each on_message handler ran and how long it took."""
+        await ctx.send("\n".join(message_router.stats_lines()))
+
     ##############################################
 
     # Dynamically reload cogs
@@ -17,7 +17,12 @@ if not os.path.exists('cogs/config'):
 # S3 Functions
 
 DEFAULT_BUCKET = pkgutil.get_data(__package__, "config/default_bucket.txt").decode()
-s3_client = boto3.client('s3')
+try:
+    # Optional, lets the bot talk to a local S3 compatible server instead of AWS.
+    S3_ENDPOINT_URL = pkgutil.get_data(__package__, "config/s3_endpoint_url.txt").decode().strip()
+except FileNotFoundError:
+    S3_ENDPOINT_URL = None
+s3_client = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL)
 
 
 async def download_from_s3(local_path: str, remote_path: str, bucket=DEFAULT_BUCKET):
@@ -31,11 +36,45 @@ async def download_from_s3(local_path: str, remote_path: str, bucket=DEFAULT_BUC
     return download_finished
 
 
+async def head_from_s3(remote_path: str, bucket=DEFAULT_BUCKET):
+    def head():
+        return s3_client.head_object(Bucket=bucket, Key=remote_path)
+
+    loop = asyncio.get_running_loop()
+    object_metadata = await loop.run_in_executor(None, head)
+    return object_metadata
+
+
+async def generate_presigned_url_s3(remote_path: str, bucket=DEFAULT_BUCKET, expires_in=3600):
+    def generate():
+        return s3_client.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": remote_path},
+                                                ExpiresIn=expires_in)
+
+    loop = asyncio.get_running_loop()
+    url = await loop.run_in_executor(None, generate)
+    return url
+
+
+async def list_objects_from_s3(folder_path="", bucket=DEFAULT_BUCKET):
+    """List all objects below a prefix with their size and ETag, following pagination past 1000 keys."""
+    def list_objects():
+        paginator = s3_client.get_paginator('list_objects_v2')
+        objects = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=folder_path):
+            objects.extend(page.get('Contents', []))
+        return objects
+
+    loop = asyncio.get_running_loop()
+    object_list = await loop.run_in_executor(None, list_objects)
+    return object_list
+
+
 async def list_files_from_s3(folder_path="", bucket=DEFAULT_BUCKET):
     def list_files():
-        files_response = s3_client.list_objects(Bucket=bucket, Prefix=folder_path)
+        paginator = s3_client.get_paginator('list_objects_v2')
         files = []
-        for result in files_response['Contents']:
+        for result in (content for page in paginator.paginate(Bucket=bucket, Prefix=folder_path)
+                       for content in page.get('Contents', [])):
             if "/" in result['Key'] and not result['Key'].endswith('/'):
                 files.append(result['Key'].split("/")[1])
             else:
@@ -241,3 +280,56 @@ async def delete_entry(table, guild_id, **kwargs):
     async with operation_lock:
         loop = asyncio.get_running_loop()
         await loop.run_in_executor(None, delete)
+
+
+########################################
+# Query helpers for tables with their own schema. Values are bound as parameters and stored as they are, not as JSON.
+
+async def create_schema(statements: tuple):
+    """Run CREATE TABLE/INDEX IF NOT EXISTS statements in one transaction."""
+    def create():
+        with connection:
+            for statement in statements:
+                cursor.execute(statement)
+
+    async with operation_lock:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, create)
+
+
+async def execute_transaction(statements: list):
+    """Run a list of (statement, parameters) pairs in one transaction and return the changed row count of each."""
+    def execute():
+        changed_rows = []
+        with connection:
+            for statement, parameters in statements:
+                changed_rows.append(cursor.execute(statement, parameters).rowcount)
+        return changed_rows
+
+    async with operation_lock:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, execute)
+
+
+async def execute(statement: str, parameters=()):
+    changed_rows = await execute_transaction([(statement, parameters)])
+    return changed_rows[0]
+
+
+async def fetch_rows(query: str, parameters=()):
+    def fetch():
+        return cursor.execute(query, parameters).fetchall()
+
+    async with operation_lock:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, fetch)
+
+
+async def fetch_row(query: str, parameters=()):
+    """First row of the result or None."""
+    def fetch():
+        return cursor.execute(query, parameters).fetchone()
+
+    async with operation_lock:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, fetch)
@@ -1,13 +1,14 @@
 """Create and backup emoji"""
 import asyncio
 import os
-import re
 import shutil
 
 import discord
 from discord.ext import commands
 
 from . import data_management
+from . import message_router
+from . import report_files
 
 #########################################
 
@@ -31,6 +32,10 @@ async def write_emoji_statistics(guild_id: int, emoji_statistics: dict):
                                        guild_id=guild_id)
 
 
+def contains_custom_emoji(traits):
+    return traits.in_guild and bool(traits.custom_emoji_names)
+
+
 #########################################
 
 class EmojiManager(commands.Cog):
@@ -40,6 +45,10 @@ class EmojiManager(commands.Cog):
 
     async def cog_load(self):
         await data_management.create_table(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS)
+        message_router.register(self.bot, "emoji_usage", contains_custom_emoji, self.emoji_usage_counter_message)
+
+    async def cog_unload(self):
+        message_router.unregister("emoji_usage")
 
     @discord.app_commands.command(
         name="add_emoji",
@@ -74,12 +83,10 @@ class EmojiManager(commands.Cog):
                 emoji_usage_dict[reaction.emoji.name] = emoji_usage_dict.get(reaction.emoji.name, 0) + 1
                 await write_emoji_statistics(member.guild.id, emoji_usage_dict)
 
-    @commands.Cog.listener(name="on_message")
-    async def emoji_usage_counter_message(self, message: discord.Message):
+    async def emoji_usage_counter_message(self, message: discord.Message, traits):
         if not message.guild:
             return
-        emoji_strings = re.findall(r"<:(.+?):\d+>", message.content)
-        unique_emoji_strings = set(emoji_strings)
+        unique_emoji_strings = traits.custom_emoji_names
         if unique_emoji_strings:
             for emoji_string in unique_emoji_strings:
                 emoji: discord.Emoji = discord.utils.get(message.guild.emojis, name=emoji_string)
@@ -97,6 +104,7 @@ class EmojiManager(commands.Cog):
     async def emoji_usage(self, interaction: discord.Interaction):
         emoji_usage_dict = await fetch_emoji_statistics(interaction.guild_id)
         emoji_report_lines = []
+        emoji_report_rows = []
 
         for emoji_data in sorted(emoji_usage_dict.items(), key=lambda x: x[1], reverse=True):
             emoji_name, uses = emoji_data
@@ -104,15 +112,18 @@ class EmojiManager(commands.Cog):
             if emoji:
                 emoji_line = f"{str(emoji)} {uses}回"
                 emoji_report_lines.append(emoji_line)
+                emoji_report_rows.append((emoji.name, uses))
 
         for emoji in interaction.guild.emojis:
             if emoji.name not in emoji_usage_dict:
                 emoji_line = f"{str(emoji)} 0回"
                 emoji_report_lines.append(emoji_line)
+                emoji_report_rows.append((emoji.name, 0))
 
         emoji_embed = discord.Embed(title=f"{interaction.guild.name} Emoji Usage Statistics.")
         current_field = []
         counter = 1
+        truncated = False
         for emoji_line in emoji_report_lines:
             current_field.append(f"{counter}. {emoji_line}")
             counter += 1
@@ -120,11 +131,17 @@ class EmojiManager(commands.Cog):
                 emoji_embed.add_field(name="Emoji:", value="\n".join(current_field))
                 current_field = []
                 if len(emoji_embed) > 5000:
+                    truncated = counter <= len(emoji_report_lines)
                     break
         if current_field:
             emoji_embed.add_field(name="Emoji:", value="\n".join(current_field))
 
-        await interaction.response.send_message(embed=emoji_embed, ephemeral=True)
+        if truncated:
+            # The embed only fits the most used emoji, the full statistics go into a file.
+            usage_file = report_files.csv_file(emoji_report_rows, "emoji_usage.csv", header=("emoji", "uses"))
+            await interaction.response.send_message(embed=emoji_embed, file=usage_file, ephemeral=True)
+        else:
+            await interaction.response.send_message(embed=emoji_embed, ephemeral=True)
 
     @discord.app_commands.command(
         name="_backup_emoji",
@@ -6,6 +6,7 @@ import openai
 from discord.ext import commands
 
 from . import data_management
+from . import message_router
 
 #########################################
 
@@ -136,6 +137,10 @@ async def delete_current_api_key(guild: discord.Guild):
     await write_key_list(guild.id, key_list)
 
 
+def addresses_bot(traits):
+    return traits.in_guild and not traits.is_own and (traits.mentions_bot or traits.replies_to_bot)
+
+
 #########################################
 
 
@@ -146,6 +151,10 @@ class GPTInteraction(commands.Cog):
 
     async def cog_load(self):
         await data_management.create_table(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS)
+        message_router.register(self.bot, "openai_reply", addresses_bot, self.openai_reply)
+
+    async def cog_unload(self):
+        message_router.unregister("openai_reply")
 
     @discord.app_commands.command(
         name="_edit_openai_prompt",
@@ -227,8 +236,7 @@ class GPTInteraction(commands.Cog):
             pass
         return history_strings
 
-    @commands.Cog.listener(name="on_message")
-    async def openai_reply(self, message: discord.Message):
+    async def openai_reply(self, message: discord.Message, traits):
         """
         Reply to @mentions or when the 'reply' interface is used.
         """
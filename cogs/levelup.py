@@ -1,13 +1,16 @@
 """Rank system interfacing with Kotoba bot"""
 import asyncio
-import os
+import random
 import re
+import time
 
 import aiohttp
 import discord
 from discord.ext import commands
 
 from . import data_management
+from . import message_router
+from . import report_files
 
 #########################################
 
@@ -34,6 +37,8 @@ async def fetch_failure_channels(guild_id: int):
 
 async def write_rank_system(guild_id: int, rank_system: list):
     await data_management.update_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[1], rank_system, guild_id=guild_id)
+    rank_indexes[guild_id] = RankSystemIndex(rank_system)
+    rank_distributions.pop(guild_id, None)
 
 
 async def write_announce_channel(guild_id: int, announce_channel_name: str):
@@ -45,9 +50,200 @@ async def write_failure_channels(guild_id: int, failure_channels: list):
     await data_management.update_entry(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS[3], failure_channels, guild_id=guild_id)
 
 
+class RankSystemIndex:
+    """Lookup tables compiled from a guild's rank system.
+
+    Rank entries are found by the name of the role a member has to lose. The rank system stores role names, so the
+    index is keyed by names as well."""
+
+    def __init__(self, rank_system: list):
+        self.rank_system = rank_system
+        self.entries_by_role_to_lose = dict()
+        self.role_names = []
+        for position, rank_data in enumerate(rank_system):
+            role_name_to_get, role_name_to_lose = rank_data[5], rank_data[6]
+            # Later entries win, as they did when the rank system was scanned in order.
+            self.entries_by_role_to_lose[role_name_to_lose] = (position, rank_data)
+            for role_name in (role_name_to_lose, role_name_to_get):
+                if role_name not in self.role_names:
+                    self.role_names.append(role_name)
+        self.role_name_set = set(self.role_names)
+
+    def entry_for_member(self, member: discord.Member):
+        """Return the rank entry for the next quiz of a member, or None if they have no rank to lose."""
+        matches = [self.entries_by_role_to_lose[role.name] for role in member.roles
+                   if role.name in self.entries_by_role_to_lose]
+        if not matches:
+            return None
+        return max(matches, key=lambda match: match[0])[1]
+
+    def rank_role_names_of(self, member: discord.Member):
+        return [role.name for role in member.roles if role.name in self.role_name_set]
+
+
+rank_indexes = dict()
+
+
+async def fetch_rank_index(guild_id: int):
+    rank_index = rank_indexes.get(guild_id)
+    if rank_index is None:
+        rank_index = RankSystemIndex(await fetch_rank_system(guild_id))
+        rank_indexes[guild_id] = rank_index
+    return rank_index
+
+
+class RankDistribution:
+    """Number of members per rank role of a guild, plus members with several or no rank roles.
+
+    Built once from the member cache and then updated from member events."""
+
+    def __init__(self, rank_index: RankSystemIndex):
+        self.rank_index = rank_index
+        self.rank_counts = {role_name: 0 for role_name in rank_index.role_names}
+        self.member_rank_names = dict()
+        self.duplicate_role_members = set()
+        self.missing_role_members = set()
+
+    @classmethod
+    def from_guild(cls, guild: discord.Guild, rank_index: RankSystemIndex):
+        rank_distribution = cls(rank_index)
+        for member in guild.members:
+            rank_distribution.update_member(member)
+        return rank_distribution
+
+    def remove_member(self, member_id: int):
+        for role_name in self.member_rank_names.pop(member_id, ()):
+            self.rank_counts[role_name] -= 1
+        self.duplicate_role_members.discard(member_id)
+        self.missing_role_members.discard(member_id)
+
+    def update_member(self, member: discord.Member):
+        if member.bot:
+            return
+        self.remove_member(member.id)
+        rank_names = self.rank_index.rank_role_names_of(member)
+        self.member_rank_names[member.id] = rank_names
+        for role_name in rank_names:
+            self.rank_counts[role_name] += 1
+        if not rank_names:
+            self.missing_role_members.add(member.id)
+        elif len(rank_names) > 1:
+            self.duplicate_role_members.add(member.id)
+
+    def total_members(self):
+        return len(self.member_rank_names)
+
+
+rank_distributions = dict()
+
+
+async def fetch_rank_distribution(guild: discord.Guild):
+    rank_distribution = rank_distributions.get(guild.id)
+    if rank_distribution is None:
+        rank_distribution = RankDistribution.from_guild(guild, await fetch_rank_index(guild.id))
+        rank_distributions[guild.id] = rank_distribution
+    return rank_distribution
+
+
 #########################################
 
 KOTOBA_BOT_ID = 251239170058616833
+KOTOBA_REPORT_URL = "https://kotobaweb.com/api/game_reports/{}"
+# Kotoba posts the result embed slightly before the report is available.
+REPORT_READY_DELAY_SECONDS = 1
+REPORT_TIMEOUT = aiohttp.ClientTimeout(total=15, connect=5)
+REPORT_MAX_CONNECTIONS = 4
+REPORT_ATTEMPTS = 3
+REPORT_BACKOFF_SECONDS = 1.0
+REPORT_CACHE_TTL_SECONDS = 600
+REPORT_CACHE_SIZE = 256
+REPORT_KEYS = ("participants", "settings", "decks", "questions", "scores", "isLoaded")
+
+
+class KotobaReportClient:
+    """Fetches kotobaweb game reports with bounded connections, timeouts and retries.
+
+    Reports are cached for a short while and concurrent requests for the same report share one download."""
+
+    def __init__(self):
+        self.session = None
+        self.reports = dict()
+        self.in_flight = dict()
+        self.downloads = 0
+        self.failures = 0
+
+    def start(self):
+        connector = aiohttp.TCPConnector(limit=REPORT_MAX_CONNECTIONS)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=REPORT_TIMEOUT)
+
+    async def close(self):
+        for download in list(self.in_flight.values()):
+            download.cancel()
+        if self.session:
+            await self.session.close()
+
+    def cached_report(self, quiz_id: str):
+        stored_at, report = self.reports.get(quiz_id, (0, None))
+        if report and time.monotonic() - stored_at < REPORT_CACHE_TTL_SECONDS:
+            return report
+        self.reports.pop(quiz_id, None)
+        return None
+
+    def store_report(self, quiz_id: str, report: dict):
+        self.reports[quiz_id] = (time.monotonic(), report)
+        if len(self.reports) > REPORT_CACHE_SIZE:
+            oldest_quiz_id = min(self.reports, key=lambda cached_quiz_id: self.reports[cached_quiz_id][0])
+            del self.reports[oldest_quiz_id]
+
+    async def fetch_report(self, quiz_id: str):
+        """Return the game report of a quiz. Raises ValueError if it can't be fetched or is malformed."""
+        report = self.cached_report(quiz_id)
+        if report:
+            return report
+
+        download = self.in_flight.get(quiz_id)
+        if download is None:
+            download = asyncio.create_task(self.download_report(quiz_id))
+            self.in_flight[quiz_id] = download
+            # Forgotten as soon as it finishes, even if every waiter was cancelled before.
+            download.add_done_callback(lambda finished_download: self.forget_in_flight(quiz_id, finished_download))
+        return await asyncio.shield(download)
+
+    def forget_in_flight(self, quiz_id: str, finished_download: asyncio.Task):
+        if self.in_flight.get(quiz_id) is finished_download:
+            del self.in_flight[quiz_id]
+
+    async def download_report(self, quiz_id: str):
+        await asyncio.sleep(REPORT_READY_DELAY_SECONDS)
+        last_error = None
+        for attempt in range(REPORT_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(REPORT_BACKOFF_SECONDS * 2 ** (attempt - 1) * random.uniform(1.0, 1.5))
+            self.downloads += 1
+            try:
+                async with self.session.get(KOTOBA_REPORT_URL.format(quiz_id)) as response:
+                    if response.status == 404 or response.status >= 500:
+                        # The report may not be written yet or kotobaweb has trouble, both are worth a retry.
+                        last_error = f"status {response.status}"
+                        continue
+                    response.raise_for_status()
+                    report = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                last_error = repr(error)
+                continue
+            except ValueError as error:
+                self.failures += 1
+                raise ValueError(f"Game report {quiz_id} is not valid JSON: {error}")
+
+            if not isinstance(report, dict) or any(key not in report for key in REPORT_KEYS) \
+                    or not report["participants"] or not report["scores"]:
+                self.failures += 1
+                raise ValueError(f"Game report {quiz_id} is malformed.")
+            self.store_report(quiz_id, report)
+            return report
+
+        self.failures += 1
+        raise ValueError(f"Unable to fetch game report {quiz_id} after {REPORT_ATTEMPTS} attempts: {last_error}")
 
 
 #########################################
@@ -128,17 +324,8 @@ async def verify_quiz_settings(user_rank_data, quiz_data, member: discord.Member
 
 async def verify_if_rank_quiz(member: discord.Member, quiz_data):
     """Determines if a quiz is a rank quiz. If so returns the rank data for the reward rank."""
-    rank_system = await fetch_rank_system(member.guild.id)
-    user_rank_data = False
-
-    # Get corresponding data.
-    for rank_data in rank_system:
-        (quiz_name, answer_count, answer_time_limit, font,
-         font_size, role_name_to_get, role_name_to_lose, fail_count, command, file_path) = rank_data
-        for role in member.roles:
-            if role.name == role_name_to_lose:
-                user_rank_data = rank_data
-
+    rank_index = await fetch_rank_index(member.guild.id)
+    user_rank_data = rank_index.entry_for_member(member)
     if not user_rank_data:
         return False
 
@@ -151,15 +338,17 @@ async def verify_if_rank_quiz(member: discord.Member, quiz_data):
             return  # Review quiz without deck name
     combined_deck_string = "+".join(deck_strings)
 
-    (quiz_name, answer_count, answer_time_limit, font,
-     font_size, role_name_to_get, role_name_to_lose, fail_count, command, file_path) = user_rank_data
-
-    if combined_deck_string == quiz_name:
+    # Several ranks can share a deck, so the quiz is checked against the member's own rank only.
+    if combined_deck_string == user_rank_data[0]:
         return user_rank_data
     else:
         return False
 
 
+def is_kotoba_embed(traits):
+    return traits.author_id == KOTOBA_BOT_ID and traits.has_embeds
+
+
 async def get_quiz_id(message: discord.Message):
     """Extract the ID of a quiz to use with the API."""
     try:
@@ -172,14 +361,11 @@ async def get_quiz_id(message: discord.Message):
 
 
 async def fetch_user_rank_name(member: discord.Member):
-    rank_system = await fetch_rank_system(member.guild.id)
-    rank_names = set([rank_info[5] for rank_info in rank_system]) | set(rank_info[4] for rank_info in rank_system)
-    user_rank_names = [role.name for role in member.roles]
-    try:
-        user_rank_name = list(rank_names & set(user_rank_names))[0]
-    except IndexError:
-        user_rank_name = "No Rank"
-    return user_rank_name
+    rank_index = await fetch_rank_index(member.guild.id)
+    user_rank_names = rank_index.rank_role_names_of(member)
+    if user_rank_names:
+        return user_rank_names[0]
+    return "No Rank"
 
 
 #########################################
@@ -188,15 +374,25 @@ async def fetch_user_rank_name(member: discord.Member):
 class LevelUp(commands.Cog):
 
     def __init__(self, bot):
-        self.aiosession = None
+        self.report_client = KotobaReportClient()
         self.bot = bot
 
     async def cog_load(self):
         await data_management.create_table(SETTINGS_TABLE_NAME, SETTINGS_COLUMNS)
-        self.aiosession = aiohttp.ClientSession()
+        self.report_client.start()
+        message_router.register(self.bot, "levelup", is_kotoba_embed, self.level_up_routine)
+        if self.bot.is_ready():
+            # Loaded into a running bot, on_ready already happened.
+            await self.build_rank_distributions()
+
+    async def build_rank_distributions(self):
+        rank_distributions.clear()
+        for guild in self.bot.guilds:
+            await fetch_rank_distribution(guild)
 
     async def cog_unload(self):
-        await self.aiosession.close()
+        message_router.unregister("levelup")
+        await self.report_client.close()
 
     @discord.app_commands.command(
         name="_add_ordered_rank",
@@ -300,14 +496,8 @@ class LevelUp(commands.Cog):
         description="Get the next levelup command.")
     @discord.app_commands.guild_only()
     async def levelup(self, interaction: discord.Interaction):
-        user_rank_data = None
-        rank_system = await fetch_rank_system(interaction.guild_id)
-        for rank_data in rank_system:
-            (quiz_name, answer_count, answer_time_limit, font,
-             font_size, role_name_to_get, role_name_to_lose, fail_count, command, file_path) = rank_data
-            for role in interaction.user.roles:
-                if role.name == role_name_to_lose:
-                    user_rank_data = rank_data
+        rank_index = await fetch_rank_index(interaction.guild_id)
+        user_rank_data = rank_index.entry_for_member(interaction.user)
 
         if user_rank_data:
             (quiz_name, answer_count, answer_time_limit, font,
@@ -322,9 +512,14 @@ class LevelUp(commands.Cog):
         description="See all level up commands.")
     @discord.app_commands.guild_only()
     async def levelup_all(self, interaction: discord.Interaction):
-        rank_system = await fetch_rank_system(interaction.guild_id)
-        command_list = [rank_data[-2] for rank_data in rank_system]
-        await interaction.response.send_message("\n".join(command_list), ephemeral=True)
+        rank_index = await fetch_rank_index(interaction.guild_id)
+        command_list = [rank_data[-2] for rank_data in rank_index.rank_system]
+        command_string = "\n".join(command_list)
+        if report_files.fits_in_message(command_string):
+            await interaction.response.send_message(command_string, ephemeral=True)
+        else:
+            await interaction.response.send_message("Here you go:", ephemeral=True,
+                                                    file=report_files.text_file(command_string, "levelup_commands.txt"))
 
     @discord.app_commands.command(
         name="rankusers",
@@ -343,11 +538,9 @@ class LevelUp(commands.Cog):
         else:
             member_string = [str(member) for member in role.members]
             member_string.append(f"\nTotal {member_count} members.")
-            with open("data/rank_user_count.txt", "w") as text_file:
-                text_file.write("\n".join(member_string))
             await interaction.response.send_message("Here you go:",
-                                                    file=discord.File("data/rank_user_count.txt"))
-            os.remove("data/rank_user_count.txt")
+                                                    file=report_files.text_file("\n".join(member_string),
+                                                                                "rank_user_count.txt"))
 
     @discord.app_commands.command(
         name="ranktable",
@@ -355,72 +548,107 @@ class LevelUp(commands.Cog):
     @discord.app_commands.guild_only()
     @discord.app_commands.default_permissions(administrator=True)
     async def ranktable(self, interaction: discord.Interaction):
-        rank_system = await fetch_rank_system(interaction.guild_id)
-        role_name_list = []
-        for rank_data in rank_system:
-            (quiz_name, answer_count, answer_time_limit, font,
-             font_size, role_name_to_get, role_name_to_lose, fail_count, command, file_path) = rank_data
-            if role_name_to_lose not in role_name_list:
-                role_name_list.append(role_name_to_lose)
-            if role_name_to_get not in role_name_list:
-                role_name_list.append(role_name_to_get)
-
-        rank_roles = [discord.utils.get(interaction.guild.roles, name=role_name) for role_name in role_name_list]
-        duplicate_role_members = []
-        missing_role_members = []
-        total_members = 0
-        rank_count = dict()
-        for member in interaction.guild.members:
-            role_count = 0
-            if member.bot:
-                continue
-            total_members += 1
-            for role in member.roles:
-                if role in rank_roles:
-                    role_count += 1
-                    rank_count[role.name] = rank_count.get(role.name, 0) + 1
-            if role_count == 0:
-                missing_role_members.append(member)
-            elif role_count > 1:
-                duplicate_role_members.append(member)
+        rank_distribution = await fetch_rank_distribution(interaction.guild)
 
         ranktable_message = ["**Role Distribution**"]
-        for role_name in role_name_list:
-            ranktable_message.append(f"{role_name}: {rank_count[role_name]}")
+        for role_name in rank_distribution.rank_index.role_names:
+            ranktable_message.append(f"{role_name}: {rank_distribution.rank_counts[role_name]}")
 
-        if duplicate_role_members:
-            duplicate_mention_string = " ".join([member.mention for member in duplicate_role_members])
+        if rank_distribution.duplicate_role_members:
+            duplicate_mention_string = " ".join([f"<@{member_id}>" for member_id
+                                                 in sorted(rank_distribution.duplicate_role_members)])
             ranktable_message.append(f"\nMembers with duplicate roles:\n {duplicate_mention_string}")
 
-        if missing_role_members:
-            missing_mention_string = " ".join([member.mention for member in missing_role_members])
+        if rank_distribution.missing_role_members:
+            missing_mention_string = " ".join([f"<@{member_id}>" for member_id
+                                               in sorted(rank_distribution.missing_role_members)])
             ranktable_message.append(f"\nMembers with missing roles:\n {missing_mention_string}")
 
-        ranktable_message.append(f"\nTotal member count: {total_members}")
+        ranktable_message.append(f"\nTotal member count: {rank_distribution.total_members()}")
         ranktable_string = "\n".join(ranktable_message)
 
-        await interaction.response.send_message(ranktable_string,
-                                                allowed_mentions=discord.AllowedMentions.none())
+        if report_files.fits_in_message(ranktable_string):
+            await interaction.response.send_message(ranktable_string,
+                                                    allowed_mentions=discord.AllowedMentions.none())
+            return
 
-    @commands.Cog.listener(name="on_message")
-    async def level_up_routine(self, message: discord.Message):
-        if not message.author.id == KOTOBA_BOT_ID:
+        # Too many members to mention, send the counts and list the members in a file instead.
+        summary_lines = ranktable_message[:len(rank_distribution.rank_index.role_names) + 1]
+        summary_lines.append(f"\n{len(rank_distribution.duplicate_role_members)} members with duplicate roles, "
+                             f"{len(rank_distribution.missing_role_members)} members with missing roles. "
+                             f"\nTotal member count: {rank_distribution.total_members()}")
+        member_rows = []
+        for problem, member_ids in (("duplicate roles", rank_distribution.duplicate_role_members),
+                                    ("missing roles", rank_distribution.missing_role_members)):
+            for member_id in sorted(member_ids):
+                member = interaction.guild.get_member(member_id)
+                member_rows.append((member_id, str(member) if member else "", problem,
+                                    " | ".join(rank_distribution.member_rank_names.get(member_id, ()))))
+        await interaction.response.send_message("\n".join(summary_lines),
+                                                file=report_files.csv_file(member_rows, "ranktable.csv",
+                                                                           header=("member_id", "member", "problem",
+                                                                                   "rank_roles")))
+
+    @commands.Cog.listener(name="on_ready")
+    async def prebuild_rank_distributions(self):
+        # The member cache is only complete once the guilds are chunked. After a reconnect member events may have
+        # been missed, so the counts are rebuilt then as well.
+        await self.build_rank_distributions()
+
+    @commands.Cog.listener(name="on_member_update")
+    async def update_rank_distribution(self, before: discord.Member, after: discord.Member):
+        if before.roles == after.roles or after.guild.id not in rank_distributions:
+            return
+        rank_distributions[after.guild.id].update_member(after)
+
+    @commands.Cog.listener(name="on_member_join")
+    async def add_to_rank_distribution(self, member: discord.Member):
+        if member.guild.id in rank_distributions:
+            rank_distributions[member.guild.id].update_member(member)
+
+    @commands.Cog.listener(name="on_member_remove")
+    async def remove_from_rank_distribution(self, member: discord.Member):
+        if member.guild.id in rank_distributions:
+            rank_distributions[member.guild.id].remove_member(member.id)
+
+    @commands.Cog.listener(name="on_guild_role_update")
+    async def rename_rank_role(self, before: discord.Role, after: discord.Role):
+        if before.name != after.name:
+            # Ranks are matched by name, a renamed role may join or leave the rank system.
+            rank_distributions.pop(after.guild.id, None)
+
+    @commands.Cog.listener(name="on_guild_role_delete")
+    async def delete_rank_role(self, role: discord.Role):
+        # Members of a deleted role get no member updates, so the counts are rebuilt on the next use.
+        rank_distributions.pop(role.guild.id, None)
+
+    async def level_up_routine(self, message: discord.Message, traits):
+        if not message.guild:
             return
 
         quiz_id = await get_quiz_id(message)
         if not quiz_id:
             return
 
-        quiz_data = await self.extract_quiz_data_from_id(quiz_id)
-
-        member = message.guild.get_member(int(quiz_data["participants"][0]["discordUser"]["id"]))
-        user_rank_data = await verify_if_rank_quiz(member, quiz_data)
+        try:
+            quiz_data = await self.report_client.fetch_report(quiz_id)
+            member = message.guild.get_member(int(quiz_data["participants"][0]["discordUser"]["id"]))
+        except (ValueError, KeyError, TypeError) as error:
+            print(f"Unable to verify quiz {quiz_id}: {error!r}")
+            return
+        if not member:
+            return
 
-        if user_rank_data:
-            passed, info = await verify_quiz_settings(user_rank_data, quiz_data, member)
-        else:
-            passed = False
-            info = "Wrong quiz for your current level."
+        try:
+            user_rank_data = await verify_if_rank_quiz(member, quiz_data)
+            if user_rank_data:
+                passed, info = await verify_quiz_settings(user_rank_data, quiz_data, member)
+            else:
+                passed = False
+                info = "Wrong quiz for your current level."
+        except (KeyError, TypeError, IndexError) as error:
+            print(f"Game report {quiz_id} is missing data: {error!r}")
+            return
 
         if passed:
             (quiz_name, answer_count, answer_time_limit, font,
@@ -435,12 +663,6 @@ class LevelUp(commands.Cog):
             if message.channel.name in failure_channel_names:
                 await message.channel.send(f"{member.mention} {info}")
 
-    async def extract_quiz_data_from_id(self, quiz_id):
-        jsonurl = f"https://kotobaweb.com/api/game_reports/{quiz_id}"
-        await asyncio.sleep(1)
-        async with self.aiosession.get(jsonurl) as resp:
-            return await resp.json()
-
 
 async def setup(bot):
     await bot.add_cog(LevelUp(bot))
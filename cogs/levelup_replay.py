@@ -0,0 +1,177 @@
+"""Offline replay harness for the Kotoba quiz verification of the levelup cog.
+
+Replays a folder of recorded kotobaweb game_reports JSON files through verify_if_rank_quiz and verify_quiz_settings
+with synthetic members, without Discord or kotobaweb. Prints the decision for every report and per-stage timings:
+    python -m cogs.levelup_replay <report_folder> <rank_system.json>
+    python -m cogs.levelup_replay <report_folder> <rank_system.json> --record expected.json
+    python -m cogs.levelup_replay <report_folder> <rank_system.json> --expected expected.json --repeat 100
+
+The rank system file holds the rank_system list as stored by /_add_ordered_rank. Unless --members maps participant
+IDs to their role names, members get the role to lose of a rank whose deck matches the report. Several ranks can
+share a deck, so ranks whose score limit and answer time limit also match the report are preferred, otherwise the
+first rank on the deck is used. Only ranks that the verification resolves the role back to are considered: it keeps
+the last rank per role to lose, just like for real members. With --expected the
+exit code is 1 if any decision differs from the recorded one.
+
+The config files read by data_management have to exist, placeholder values are fine.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+REPLAY_GUILD_ID = 0
+STAGES = ("parse", "rank_lookup", "settings_check")
+
+
+def percentile(sorted_values: list, fraction: float):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def load_reports(report_folder: str):
+    reports = []
+    for file_name in sorted(os.listdir(report_folder)):
+        if file_name.endswith(".json"):
+            with open(f"{report_folder}/{file_name}", "rb") as report_file:
+                reports.append((file_name, report_file.read()))
+    return reports
+
+
+def make_member(member_id: int, role_names: list):
+    """Stand-in for discord.Member with the attributes the verification reads."""
+    guild = SimpleNamespace(id=REPLAY_GUILD_ID)
+    roles = [SimpleNamespace(name=role_name) for role_name in role_names]
+    return SimpleNamespace(id=member_id, guild=guild, roles=roles, mention=f"<@{member_id}>", bot=False)
+
+
+def synthetic_role_names(rank_index, quiz_data: dict):
+    """Give the participant the role to lose of a rank that matches the quiz, or no rank role at all."""
+    deck_string = "+".join(deck.get("shortName", "") for deck in quiz_data.get("decks", []))
+    settings = quiz_data.get("settings", dict())
+    candidates = [rank_data for rank_data in rank_index.rank_system
+                  if rank_data[0] == deck_string and rank_index.entries_by_role_to_lose[rank_data[6]][1] is rank_data]
+    for rank_data in candidates:
+        if rank_data[1] == settings.get("scoreLimit") and rank_data[2] == settings.get("answerTimeLimitInMs"):
+            return [rank_data[6]]
+    return [candidates[0][6]] if candidates else []
+
+
+async def replay_report(levelup, raw_report: bytes, rank_index, member_roles: dict, stage_times: dict):
+    """Run one report through the verification. Returns (passed, info) like level_up_routine would decide it."""
+    start = time.perf_counter()
+    try:
+        quiz_data = json.loads(raw_report)
+        participant_id = int(quiz_data["participants"][0]["discordUser"]["id"])
+    except (ValueError, KeyError, TypeError, IndexError) as error:
+        stage_times["parse"].append(time.perf_counter() - start)
+        return False, f"Malformed report: {error!r}"
+    stage_times["parse"].append(time.perf_counter() - start)
+
+    role_names = member_roles.get(str(participant_id))
+    if role_names is None:
+        role_names = synthetic_role_names(rank_index, quiz_data)
+    member = make_member(participant_id, role_names)
+
+    try:
+        start = time.perf_counter()
+        user_rank_data = await levelup.verify_if_rank_quiz(member, quiz_data)
+        stage_times["rank_lookup"].append(time.perf_counter() - start)
+        if not user_rank_data:
+            return False, "Wrong quiz for your current level."
+
+        start = time.perf_counter()
+        passed, info = await levelup.verify_quiz_settings(user_rank_data, quiz_data, member)
+        stage_times["settings_check"].append(time.perf_counter() - start)
+        return passed, info
+    except (KeyError, TypeError, IndexError) as error:
+        return False, f"Report is missing data: {error!r}"
+
+
+async def replay(levelup, reports: list, rank_system: list, member_roles: dict, repeat: int):
+    rank_index = levelup.RankSystemIndex(rank_system)
+    levelup.rank_indexes[REPLAY_GUILD_ID] = rank_index
+    stage_times = {stage_name: [] for stage_name in STAGES}
+    decisions = dict()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for file_name, raw_report in reports:
+            decisions[file_name] = await replay_report(levelup, raw_report, rank_index, member_roles, stage_times)
+    total_seconds = time.perf_counter() - start
+    return decisions, stage_times, total_seconds
+
+
+def format_timings(stage_times: dict, total_seconds: float, report_count: int):
+    lines = []
+    for stage_name, times in stage_times.items():
+        if not times:
+            continue
+        sorted_times = sorted(time_seconds * 1000000 for time_seconds in times)
+        lines.append(f"{stage_name}: {len(sorted_times)} runs | p50 {statistics.median(sorted_times):.1f}us | "
+                     f"p95 {percentile(sorted_times, 0.95):.1f}us | p99 {percentile(sorted_times, 0.99):.1f}us")
+    if total_seconds:
+        lines.append(f"Throughput: {report_count / total_seconds:.0f} reports per second")
+    return "\n".join(lines)
+
+
+def run_replay(arguments):
+    reports = load_reports(arguments.report_folder)
+    with open(arguments.rank_system) as rank_system_file:
+        rank_system = json.load(rank_system_file)
+    member_roles = dict()
+    if arguments.members:
+        with open(arguments.members) as members_file:
+            member_roles = json.load(members_file)
+
+    work_folder = tempfile.mkdtemp(prefix="levelup_replay_")
+    original_folder = os.getcwd()
+    try:
+        # data_management creates its database relative to the working directory and expects cogs/ to exist there.
+        os.makedirs(f"{work_folder}/cogs/config", exist_ok=True)
+        os.chdir(work_folder)
+        from . import levelup
+        decisions, stage_times, total_seconds = asyncio.run(replay(levelup, reports, rank_system, member_roles,
+                                                                   arguments.repeat))
+    finally:
+        os.chdir(original_folder)
+        shutil.rmtree(work_folder, ignore_errors=True)
+    return decisions, format_timings(stage_times, total_seconds, len(reports) * arguments.repeat)
+
+
+def main(arguments: list):
+    parser = argparse.ArgumentParser(description="Replay recorded Kotoba game reports through quiz verification.")
+    parser.add_argument("report_folder")
+    parser.add_argument("rank_system", help="JSON file with the rank system list.")
+    parser.add_argument("--members", help="JSON file mapping participant IDs to lists of role names.")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay all reports this many times.")
+    parser.add_argument("--expected", help="JSON file with recorded decisions to compare against.")
+    parser.add_argument("--record", help="Write the decisions to this file.")
+    parsed_arguments = parser.parse_args(arguments)
+
+    decisions, timing_report = run_replay(parsed_arguments)
+    for file_name, (passed, info) in decisions.items():
+        print(f"{'PASS' if passed else 'FAIL'} {file_name}: {info.splitlines()[0]}")
+    print(timing_report)
+
+    if parsed_arguments.record:
+        with open(parsed_arguments.record, "w") as record_file:
+            json.dump({file_name: passed for file_name, (passed, info) in decisions.items()}, record_file, indent=2)
+
+    if not parsed_arguments.expected:
+        return 0
+    with open(parsed_arguments.expected) as expected_file:
+        expected_decisions = json.load(expected_file)
+    mismatches = [file_name for file_name, passed in expected_decisions.items()
+                  if file_name not in decisions or decisions[file_name][0] != passed]
+    for file_name in mismatches:
+        print(f"Decision changed: {file_name}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
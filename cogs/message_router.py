@@ -0,0 +1,108 @@
+"""Routes on_message events to the cogs that care about them.
+
+Each message is classified once. Only handlers whose predicate matches the classification run, so most messages touch
+no cog logic at all. Cogs register their handlers in cog_load and remove them in cog_unload."""
+import asyncio
+import re
+import statistics
+import time
+import traceback
+from collections import deque
+
+import discord
+
+CUSTOM_EMOJI_PATTERN = re.compile(r"<:(.+?):\d+>")
+
+
+class MessageTraits:
+    """What handlers need to know to decide whether a message concerns them."""
+
+    def __init__(self, message: discord.Message, bot_user: discord.ClientUser):
+        self.author_id = message.author.id
+        self.in_guild = message.guild is not None
+        self.is_own = bot_user is not None and message.author.id == bot_user.id
+        self.mentions_bot = bot_user is not None and bot_user.id in message.raw_mentions
+        reference = message.reference
+        replied_message = reference.cached_message if reference else None
+        self.replies_to_bot = bool(replied_message and bot_user and replied_message.author.id == bot_user.id)
+        self.custom_emoji_names = set(CUSTOM_EMOJI_PATTERN.findall(message.content))
+        self.has_embeds = bool(message.embeds)
+
+
+class MessageHandler:
+
+    def __init__(self, name: str, predicate, callback):
+        self.name = name
+        self.predicate = predicate
+        self.callback = callback
+        self.invocations = 0
+        self.failures = 0
+        self.latencies = deque(maxlen=500)
+
+    def stats_string(self):
+        if self.latencies:
+            sorted_latencies = sorted(self.latencies)
+            p95_latency = sorted_latencies[min(len(sorted_latencies) - 1, int(len(sorted_latencies) * 0.95))]
+            latency_string = f"p50 {statistics.median(sorted_latencies) * 1000:.1f}ms, p95 {p95_latency * 1000:.1f}ms"
+        else:
+            latency_string = "no runs yet"
+        return f"{self.name}: {self.invocations} runs, {self.failures} failed, {latency_string}"
+
+
+class MessageRouter:
+
+    def __init__(self):
+        self.bot = None
+        self.handlers = dict()
+        self.running_tasks = set()
+        self.messages_seen = 0
+        self.messages_routed = 0
+
+    def register(self, bot, name: str, predicate, callback):
+        """Run callback(message, traits) for every message for which predicate(traits) is true."""
+        if self.bot is None:
+            self.bot = bot
+            bot.add_listener(self.route, "on_message")
+        self.handlers[name] = MessageHandler(name, predicate, callback)
+
+    def unregister(self, name: str):
+        self.handlers.pop(name, None)
+        if not self.handlers and self.bot is not None:
+            self.bot.remove_listener(self.route, "on_message")
+            self.bot = None
+
+    async def route(self, message: discord.Message):
+        self.messages_seen += 1
+        traits = MessageTraits(message, self.bot.user)
+        matching_handlers = [handler for handler in self.handlers.values() if handler.predicate(traits)]
+        if matching_handlers:
+            self.messages_routed += 1
+        for handler in matching_handlers:
+            # Separate tasks, like separate listeners, so that a slow handler does not hold up the others.
+            handler_task = asyncio.create_task(self.run_handler(handler, message, traits))
+            self.running_tasks.add(handler_task)
+            handler_task.add_done_callback(self.running_tasks.discard)
+
+    @staticmethod
+    async def run_handler(handler: MessageHandler, message: discord.Message, traits: MessageTraits):
+        handler.invocations += 1
+        start = time.perf_counter()
+        try:
+            await handler.callback(message, traits)
+        except Exception:
+            handler.failures += 1
+            print(f"Message handler {handler.name} failed:")
+            traceback.print_exc()
+        finally:
+            handler.latencies.append(time.perf_counter() - start)
+
+    def stats_lines(self):
+        stats_lines = [f"{self.messages_seen} messages seen, {self.messages_routed} routed to at least one handler"]
+        stats_lines.extend(handler.stats_string() for handler in self.handlers.values())
+        return stats_lines
+
+
+router = MessageRouter()
+register = router.register
+unregister = router.unregister
+stats_lines = router.stats_lines
@@ -0,0 +1,81 @@
+"""Keeps boards of pinned bot messages, like leaderboards, up to date without re-editing unchanged pages.
+
+Pins are looked up once per board and then cached. Every page remembers the digest of the embed it shows, so pages
+that did not change are skipped and a tick without changes makes no requests at all."""
+import asyncio
+import hashlib
+import json
+
+import discord
+
+
+def embed_digest(embed: discord.Embed):
+    """Digest of what an embed shows. Works the same for rendered embeds and embeds read back from a message."""
+    shown_content = {"title": embed.title,
+                     "description": embed.description,
+                     "fields": [(field.name, field.value, bool(field.inline)) for field in embed.fields]}
+    return hashlib.sha256(json.dumps(shown_content, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class PinnedBoardRenderer:
+
+    def __init__(self):
+        self.board_pins = dict()
+        self.page_digests = dict()
+
+    async def fetch_board_pins(self, channel: discord.TextChannel, board_key: str, pin_filter):
+        board_pins = self.board_pins.get((channel.id, board_key))
+        if board_pins is None:
+            board_pins = [pin for pin in await channel.pins() if pin_filter(pin)]
+            for pin in board_pins:
+                if pin.embeds:
+                    self.page_digests[pin.id] = embed_digest(pin.embeds[0])
+            self.board_pins[(channel.id, board_key)] = board_pins
+        return board_pins
+
+    def forget_board(self, channel: discord.TextChannel, board_key: str):
+        for pin in self.board_pins.pop((channel.id, board_key), list()):
+            self.page_digests.pop(pin.id, None)
+
+    async def render(self, channel: discord.TextChannel, board_key: str, pin_filter, embeds: list,
+                     placeholder_content=None, placeholder_embed=None, edit_delay=0):
+        """Show one embed per pinned message, sending and pinning new messages if the board grew.
+
+        pin_filter selects the pins that belong to the board the first time it is rendered. Returns the number of
+        messages that were edited."""
+        board_pins = await self.fetch_board_pins(channel, board_key, pin_filter)
+        edited_pages = 0
+        for index, embed in enumerate(embeds):
+            digest = embed_digest(embed)
+            if index < len(board_pins):
+                to_edit_message = board_pins[index]
+                if self.page_digests.get(to_edit_message.id) == digest:
+                    continue
+            else:
+                print(f"PINNED BOARDS: Creating new message for {board_key} in {channel.name}")
+                await asyncio.sleep(edit_delay)
+                to_edit_message = await channel.send(content=placeholder_content, embed=placeholder_embed)
+                await to_edit_message.pin()
+                board_pins.append(to_edit_message)
+
+            print(f"PINNED BOARDS: Editing page {index + 1} of {board_key} in {channel.name}")
+            await asyncio.sleep(edit_delay)
+            try:
+                edited_message = await to_edit_message.edit(content=None, embed=embed)
+            except discord.NotFound:
+                # The pin was deleted by hand, look the board up again on the next render.
+                self.forget_board(channel, board_key)
+                return edited_pages
+            if not edited_message.pinned:
+                # Unpinned by hand, the cached board would otherwise keep editing a message nobody finds.
+                print(f"PINNED BOARDS: Pinning page {index + 1} of {board_key} in {channel.name} again")
+                await asyncio.sleep(edit_delay)
+                await edited_message.pin()
+            self.page_digests[to_edit_message.id] = digest
+            edited_pages += 1
+        return edited_pages
+
+
+renderer = PinnedBoardRenderer()
+render = renderer.render
+forget_board = renderer.forget_board
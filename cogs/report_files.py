@@ -0,0 +1,37 @@
+"""Builds attachments for generated reports in memory, so commands never write temporary files."""
+import csv
+import gzip
+import io
+
+import discord
+
+# Discord rejects large uploads, reports above this size are sent gzip compressed.
+GZIP_THRESHOLD_BYTES = 4 * 1024 * 1024
+MESSAGE_CHARACTER_LIMIT = 2000
+
+
+def bytes_file(data: bytes, file_name: str, compress=None):
+    """Wrap data in a discord.File. Compresses if asked to or, by default, if the data is large."""
+    if compress is None:
+        compress = len(data) > GZIP_THRESHOLD_BYTES
+    if compress:
+        data = gzip.compress(data)
+        file_name = f"{file_name}.gz"
+    return discord.File(io.BytesIO(data), filename=file_name)
+
+
+def text_file(text: str, file_name: str, compress=None):
+    return bytes_file(text.encode("utf-8"), file_name, compress)
+
+
+def csv_file(rows, file_name: str, header=None, compress=None):
+    csv_buffer = io.StringIO()
+    csv_writer = csv.writer(csv_buffer)
+    if header:
+        csv_writer.writerow(header)
+    csv_writer.writerows(rows)
+    return text_file(csv_buffer.getvalue(), file_name, compress)
+
+
+def fits_in_message(text: str):
+    return len(text) <= MESSAGE_CHARACTER_LIMIT